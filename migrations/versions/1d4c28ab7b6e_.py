@@ -0,0 +1,41 @@
+"""Add table authcounter to count the authentications of the users for the
+policies authmaxsuccess and authmaxfail.
+
+Revision ID: 1d4c28ab7b6e
+Revises: b9bd0d9ef4be
+Create Date: 2018-11-20 10:12:43.417923
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d4c28ab7b6e'
+down_revision = 'b9bd0d9ef4be'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_table('authcounter',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('username', sa.Unicode(length=64), nullable=False),
+                        sa.Column('realm', sa.Unicode(length=120), nullable=False),
+                        sa.Column('success', sa.Boolean(), nullable=False),
+                        sa.Column('bucket', sa.Integer(), nullable=False),
+                        sa.Column('counter', sa.Integer(), nullable=True),
+                        sa.PrimaryKeyConstraint('id'),
+                        sa.UniqueConstraint('username', 'realm', 'success',
+                                            'bucket', name='authctr_1'),
+                        mysql_row_format='DYNAMIC'
+                        )
+        op.create_index(op.f('ix_authcounter_bucket'), 'authcounter',
+                        ['bucket'], unique=False)
+    except Exception as exx:
+        print("Could not create table authcounter. Probably already exists!")
+        print(exx)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_authcounter_bucket'), table_name='authcounter')
+    op.drop_table('authcounter')
@@ -0,0 +1,31 @@
+"""Add index on the expiration of the challenges to speed up the cleanup.
+
+Revision ID: 4b3d9b5a3bd5
+Revises: 5cb310101a1f
+Create Date: 2018-11-14 09:42:17.180342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b3d9b5a3bd5'
+down_revision = '5cb310101a1f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_index(op.f('ix_challenge_expiration'), 'challenge',
+                        ['expiration'], unique=False)
+    except Exception as exx:
+        print("Could not add index in table challenge.")
+        print(exx)
+
+
+def downgrade():
+    try:
+        op.drop_index(op.f('ix_challenge_expiration'), table_name='challenge')
+    except Exception as exx:
+        print("Could not delete index in table challenge.")
+        print(exx)
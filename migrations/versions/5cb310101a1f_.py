@@ -0,0 +1,26 @@
+"""Add column for the timing of the request phases in Audit Table.
+
+Revision ID: 5cb310101a1f
+Revises: c1da4d137425
+Create Date: 2018-11-09 10:21:34.518732
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5cb310101a1f'
+down_revision = 'c1da4d137425'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.add_column('pidea_audit', sa.Column('timing', sa.String(length=255), nullable=True))
+    except Exception as exx:
+        print('Adding of column "timing" in table pidea_audit failed: {!r}'.format(exx))
+        print('This is expected behavior if this column already exists.')
+
+
+def downgrade():
+    op.drop_column('pidea_audit', 'timing')
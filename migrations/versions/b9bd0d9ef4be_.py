@@ -0,0 +1,33 @@
+"""Enlarge the column authentication of the authcache table to store
+salted hashes.
+
+Revision ID: b9bd0d9ef4be
+Revises: 4b3d9b5a3bd5
+Create Date: 2018-11-16 14:03:51.862015
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b9bd0d9ef4be'
+down_revision = '4b3d9b5a3bd5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.alter_column('authcache', 'authentication',
+                        existing_type=sa.Unicode(length=64),
+                        type_=sa.Unicode(length=255),
+                        existing_nullable=True)
+    except Exception as exx:
+        print("Could not enlarge column 'authcache.authentication'")
+        print(exx)
+
+
+def downgrade():
+    op.alter_column('authcache', 'authentication',
+                    existing_type=sa.Unicode(length=255),
+                    type_=sa.Unicode(length=64),
+                    existing_nullable=True)
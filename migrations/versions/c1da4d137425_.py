@@ -0,0 +1,60 @@
+"""Add an id and a shard column to the table eventcounter
+
+Revision ID: c1da4d137425
+Revises: a63df077051a
+Create Date: 2018-11-05 10:12:31.423871
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c1da4d137425'
+down_revision = 'a63df077051a'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.schema import Sequence
+
+
+def upgrade():
+    try:
+        # The primary key changes, so we need to recreate the table and
+        # copy the existing counters.
+        bind = op.get_bind()
+        counters = bind.execute(sa.text("SELECT counter_name, counter_value "
+                                        "FROM eventcounter")).fetchall()
+        op.drop_table('eventcounter')
+        table = op.create_table('eventcounter',
+                                sa.Column('id', sa.Integer(),
+                                          Sequence("eventcounter_seq"),
+                                          nullable=False),
+                                sa.Column('counter_name', sa.Unicode(length=80), nullable=False),
+                                sa.Column('counter_value', sa.Integer(), nullable=True),
+                                sa.Column('shard', sa.Integer(), nullable=False),
+                                sa.PrimaryKeyConstraint('id'),
+                                sa.UniqueConstraint('counter_name', 'shard',
+                                                    name='evctr_1'),
+                                mysql_row_format='DYNAMIC'
+                                )
+        if counters:
+            op.bulk_insert(table, [{"counter_name": name,
+                                    "counter_value": value,
+                                    "shard": 0} for name, value in counters])
+    except Exception as exx:
+        print("Could not migrate table eventcounter.")
+        print(exx)
+
+
+def downgrade():
+    bind = op.get_bind()
+    counters = bind.execute(sa.text("SELECT counter_name, SUM(counter_value) "
+                                    "FROM eventcounter "
+                                    "GROUP BY counter_name")).fetchall()
+    op.drop_table('eventcounter')
+    table = op.create_table('eventcounter',
+                            sa.Column('counter_name', sa.Unicode(length=80), nullable=False),
+                            sa.Column('counter_value', sa.Integer(), nullable=True),
+                            sa.PrimaryKeyConstraint('counter_name')
+                            )
+    if counters:
+        op.bulk_insert(table, [{"counter_name": name,
+                                "counter_value": value} for name, value in counters])
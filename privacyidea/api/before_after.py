@@ -67,6 +67,11 @@ from ..lib.error import (privacyIDEAError,
                          PolicyError, ResourceNotFoundError)
 from privacyidea.lib.utils import get_client_ip
 from privacyidea.lib.user import User
+from privacyidea.lib import metrics
+from privacyidea.lib.timing import (start_request_timing, span,
+                                    log_timing_to_audit,
+                                    add_server_timing_header)
+from privacyidea.models import db
 
 log = logging.getLogger(__name__)
 
@@ -77,14 +82,27 @@ log = logging.getLogger(__name__)
 @token_blueprint.before_app_request
 def log_begin_request():
     log.debug(u"Begin handling of request {!r}".format(request.full_path))
+    start_request_timing()
 
 
 @token_blueprint.teardown_app_request
 def teardown_request(exc):
     call_finalizers()
+    record_db_pool_metrics()
     log.debug(u"End handling of request {!r}".format(request.full_path))
 
 
+def record_db_pool_metrics():
+    """
+    Write the usage of the database connection pool to the metrics.
+    Not all pool classes provide these numbers.
+    """
+    pool = db.engine.pool
+    if hasattr(pool, "checkedout") and hasattr(pool, "size"):
+        metrics.set_gauge("privacyidea_db_pool_checkedout", pool.checkedout())
+        metrics.set_gauge("privacyidea_db_pool_size", pool.size())
+
+
 # NOTE: This can be commented in to debug SQL pooling issues
 #@token_blueprint.before_app_request
 #def log_pools():
@@ -129,6 +147,7 @@ def before_admin_request():
     before_request()
 
 
+@span("before_request")
 def before_request():
     """
     This is executed before the request.
@@ -244,11 +263,13 @@ def after_request(response):
     # In certain error cases the before_request was not handled
     # completely so that we do not have an audit_object
     if "audit_object" in g:
-        g.audit_object.finalize_log()
+        log_timing_to_audit(g.audit_object)
+        with span("finalize_log"):
+            g.audit_object.finalize_log()
 
     # No caching!
     response.headers['Cache-Control'] = 'no-cache'
-    return response
+    return add_server_timing_header(response)
 
 
 @system_blueprint.errorhandler(AuthError)
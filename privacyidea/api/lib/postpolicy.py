@@ -59,6 +59,7 @@ from privacyidea.lib.auth import ROLE
 from privacyidea.lib.user import (split_user, User)
 from privacyidea.lib.realm import get_default_realm
 from privacyidea.lib.subscriptions import subscription_status
+from privacyidea.lib.timing import span
 
 
 optional = True
@@ -100,7 +101,8 @@ class postpolicy(object):
         @functools.wraps(wrapped_function)
         def policy_wrapper(*args, **kwds):
             response = wrapped_function(*args, **kwds)
-            return self.function(self.request, response, *args, **kwds)
+            with span(u"postpolicy.{0!s}".format(self.function.__name__)):
+                return self.function(self.request, response, *args, **kwds)
 
         return policy_wrapper
 
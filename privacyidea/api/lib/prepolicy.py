@@ -73,14 +73,13 @@ from privacyidea.lib.utils import (generate_password, get_client_ip,
 from privacyidea.lib.auth import ROLE
 from privacyidea.api.lib.utils import getParam
 from privacyidea.lib.clientapplication import save_clientapplication
+from privacyidea.lib.timing import span
 from privacyidea.lib.config import (get_token_class, get_from_config, SYSCONF)
 import functools
 import jwt
 import re
 import importlib
 # Token specific imports!
-from privacyidea.lib.tokens.u2ftoken import (U2FACTION, parse_registration_data)
-from privacyidea.lib.tokens.u2f import x509name_to_string
 
 optional = True
 required = False
@@ -120,8 +119,9 @@ class prepolicy(object):
         """
         @functools.wraps(wrapped_function)
         def policy_wrapper(*args, **kwds):
-            self.function(request=self.request,
-                          action=self.action)
+            with span(u"prepolicy.{0!s}".format(self.function.__name__)):
+                self.function(request=self.request,
+                              action=self.action)
             return wrapped_function(*args, **kwds)
 
         return policy_wrapper
@@ -1210,6 +1210,7 @@ def u2ftoken_verify_cert(request, action):
     :param action:
     :return:
     """
+    from privacyidea.lib.tokens.u2ftoken import U2FACTION
     # Get the registration data of the 2nd step of enrolling a U2F device
     ttype = request.all_data.get("type")
     if ttype and ttype.lower() == "u2f":
@@ -1257,6 +1258,9 @@ def u2ftoken_allowed(request, action):
     :param action: 
     :return: 
     """
+    from privacyidea.lib.tokens.u2ftoken import (U2FACTION,
+                                                 parse_registration_data)
+    from privacyidea.lib.tokens.u2f import x509name_to_string
     policy_object = g.policy_object
     # Get the registration data of the 2nd step of enrolling a U2F device
     reg_data = request.all_data.get("regdata")
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+#
+#  2018-11-20 Cache the verified authentication tokens
+#
 #  privacyIDEA is a fork of LinOTP
 #  May 08, 2014 Cornelius Kölbel
 #  License:  AGPLv3
@@ -26,9 +29,11 @@
 from ...lib.error import (ParameterError,
                           AuthError, ERROR)
 from ...lib.log import log_with
+from ...lib.framework import get_app_local_store, get_app_config_value
 from privacyidea.lib import _
 import time
 import threading
+from collections import OrderedDict
 import pkg_resources
 import logging
 import json
@@ -264,12 +269,61 @@ def get_priority_from_param(param):
     return priority
 
 
+class AuthTokenCache(object):
+    """
+    The authentication tokens, which were verified by this process. The
+    entries are stored by the signature of the token and are removed, when
+    the token expires.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, auth_token):
+        """
+        Return the claims of the verified token or None.
+        """
+        signature = auth_token.rsplit(".", 1)[-1]
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is None or entry[0] != auth_token:
+                return None
+            if int(entry[1]["exp"]) <= time.time():
+                del self._entries[signature]
+                return None
+            # Move the entry to the end of the LRU list
+            del self._entries[signature]
+            self._entries[signature] = entry
+        return entry[1]
+
+    def put(self, auth_token, claims, size):
+        signature = auth_token.rsplit(".", 1)[-1]
+        with self._lock:
+            self._entries.pop(signature, None)
+            self._entries[signature] = (auth_token, claims)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+
+def _get_auth_token_cache():
+    store = get_app_local_store()
+    cache = store.get("auth_token_cache")
+    if cache is None:
+        cache = store.setdefault("auth_token_cache", AuthTokenCache())
+    return cache
+
+
 def verify_auth_token(auth_token, required_role=None):
     """
     Check if a given auth token is valid.
 
     Return a dictionary describing the authenticated user.
 
+    Verified tokens are kept in memory until they expire.
+    ``PI_AUTH_TOKEN_CACHE_SIZE`` is the number of tokens per process
+    (default 1000, 0 verifies the signature with each request).
+
     :param auth_token: The Auth Token
     :param required_role: list of "user" and "admin"
     :return: dict with authtype, realm, rights, role, username, exp, nonce
@@ -279,14 +333,23 @@ def verify_auth_token(auth_token, required_role=None):
     if auth_token is None:
         raise AuthError(_("Authentication failure. Missing Authorization header."),
                         id=ERROR.AUTHENTICATE_AUTH_HEADER)
-    try:
-        r = jwt.decode(auth_token, current_app.secret_key)
-    except jwt.DecodeError as err:
-        raise AuthError(_("Authentication failure. Error during decoding your token: {0!s}").format(err),
-                        id=ERROR.AUTHENTICATE_DECODING_ERROR)
-    except jwt.ExpiredSignature as err:
-        raise AuthError(_("Authentication failure. Your token has expired: {0!s}").format(err),
-                        id=ERROR.AUTHENTICATE_TOKEN_EXPIRED)
+    size = int(get_app_config_value("PI_AUTH_TOKEN_CACHE_SIZE", 1000))
+    r = None
+    if size > 0:
+        r = _get_auth_token_cache().get(auth_token)
+    if r is None:
+        try:
+            r = jwt.decode(auth_token, current_app.secret_key)
+        except jwt.DecodeError as err:
+            raise AuthError(_("Authentication failure. Error during decoding your token: {0!s}").format(err),
+                            id=ERROR.AUTHENTICATE_DECODING_ERROR)
+        except jwt.ExpiredSignature as err:
+            raise AuthError(_("Authentication failure. Your token has expired: {0!s}").format(err),
+                            id=ERROR.AUTHENTICATE_TOKEN_EXPIRED)
+        # Only tokens, which expire, are kept in memory
+        if size > 0 and "exp" in r:
+            _get_auth_token_cache().put(auth_token, r, size)
+    r = dict(r)
     if required_role and r.get("role") not in required_role:
         # If we require a certain role like "admin", but the users role does
         # not match
@@ -2,6 +2,7 @@
 #
 # http://www.privacyidea.org
 #
+# 2018-11-07 Add the endpoint /monitoring/metrics for the live metrics
 # 2018-08-01 Cornelius Kölbel, <cornelius.koelbel@netknights.it>
 #            Initial writeup
 #
@@ -23,13 +24,14 @@ This endpoint is used fetch monitoring/statistics data
 
 The code of this module is tested in tests/test_api_monitoring.py
 """
-from flask import (Blueprint, request)
+from flask import (Blueprint, request, Response)
 from privacyidea.api.lib.utils import getParam, send_result
 from privacyidea.api.lib.prepolicy import prepolicy, check_base_action
 from privacyidea.lib.utils import parse_legacy_time
 from privacyidea.lib.log import log_with
 from privacyidea.lib.monitoringstats import (get_stats_keys, get_values,
                                    get_last_value, delete_stats)
+from privacyidea.lib.metrics import generate_prometheus_text
 from privacyidea.lib.tokenclass import AUTH_DATE_FORMAT
 from flask import g
 import logging
@@ -42,6 +44,33 @@ log = logging.getLogger(__name__)
 monitoring_blueprint = Blueprint('monitoring_blueprint', __name__)
 
 
+@monitoring_blueprint.route('/metrics', methods=['GET'])
+@log_with(log)
+@prepolicy(check_base_action, request, ACTION.STATISTICSREAD)
+def get_metrics():
+    """
+    Return the live metrics of all privacyIDEA processes of this node in the
+    Prometheus text exposition format.
+
+    .. note:: Consequently a statistics key named "metrics" can not be
+       read via ``GET /monitoring/metrics``.
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+       HTTP/1.1 200 OK
+       Content-Type: text/plain; version=0.0.4
+
+       # HELP privacyidea_validate_requests_total Number of authentication requests by result
+       # TYPE privacyidea_validate_requests_total counter
+       privacyidea_validate_requests_total{result="accept"} 12
+    """
+    g.audit_object.log({"success": True})
+    return Response(generate_prometheus_text(),
+                    mimetype="text/plain; version=0.0.4")
+
+
 @monitoring_blueprint.route('/', methods=['GET'])
 @monitoring_blueprint.route('/<stats_key>', methods=['GET'])
 @log_with(log)
@@ -3,6 +3,7 @@
 # http://www.privacyidea.org
 # (c) cornelius kölbel, privacyidea.org
 #
+# 2018-11-20 Import the tokens in batches
 # 2018-06-07 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #            Add tantoken wrapper
 # 2017-04-22 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -68,12 +69,12 @@ from ..lib.token import (init_token, get_tokens_paginate, assign_token,
                          copy_token_user, copy_token_pin, lost_token,
                          get_serial_by_otp, get_tokens,
                          set_validity_period_end, set_validity_period_start, add_tokeninfo,
-                         delete_tokeninfo, import_token)
+                         delete_tokeninfo, import_tokens)
 from werkzeug.datastructures import FileStorage
 from cgi import FieldStorage
 from privacyidea.lib.error import (ParameterError, TokenAdminError)
-from privacyidea.lib.importotp import (parseOATHcsv, parseSafeNetXML,
-                                       parseYubicoCSV, parsePSKCdata, GPGImport)
+from privacyidea.lib.importotp import iterparse_token_file, GPGImport
+from io import BytesIO
 import logging
 from .lib.utils import getParam
 from privacyidea.lib.policy import ACTION
@@ -824,6 +825,13 @@ def loadtokens_api(filename=None):
     :jsonparam psk: Pre Shared Key, when importing PSKC
     :return: The number of the imported tokens
     :rtype: int
+
+    The tokens are written to the database in batches. The import is not
+    atomic: If it fails, the error message contains the number of the
+    tokens, that were already imported. A broken XML file is rejected,
+    before any token is imported. Files with many thousand tokens, which
+    take longer than the HTTP request may take, can be imported with
+    ``pi-manage token load``.
     """
     if not filename:
         filename = getParam(request.all_data, "filename", required)
@@ -841,7 +849,6 @@ def loadtokens_api(filename=None):
     if trealms:
         tokenrealms = trealms.split(",")
 
-    TOKENS = {}
     token_file = request.files['file']
     file_contents = ""
     # In case of form post requests, it is a "instance" of FieldStorage
@@ -874,37 +881,22 @@ def loadtokens_api(filename=None):
         GPG = GPGImport(current_app.config)
         file_contents = GPG.decrypt(file_contents)
 
-    # Parse the tokens from file and get dictionary
-    if file_type == "aladdin-xml":
-        TOKENS = parseSafeNetXML(file_contents)
-    elif file_type in ["oathcsv", "OATH CSV"]:
-        TOKENS = parseOATHcsv(file_contents)
-    elif file_type in ["yubikeycsv", "Yubikey CSV"]:
-        TOKENS = parseYubicoCSV(file_contents)
-    elif file_type in ["pskc"]:
-        TOKENS = parsePSKCdata(file_contents, preshared_key_hex=aes_psk,
-                               password=aes_password)
-
-    # Now import the Tokens from the dictionary
-    ret = ""
-    for serial in TOKENS:
-        log.debug("importing token {0!s}".format(TOKENS[serial]))
-
-        log.info("initialize token. serial: {0!s}, realm: {1!s}".format(serial,
-                                                              tokenrealms))
-
-        import_token(serial,
-                     TOKENS[serial],
-                     tokenrealms=tokenrealms,
-                     default_hashlib=hashlib)
+    # The XML files are parsed incrementally and the tokens are imported
+    # in batches
+    tokens = iterparse_token_file(BytesIO(file_contents), file_type,
+                                  preshared_key_hex=aes_psk,
+                                  password=aes_password)
+    log.info("import tokens. realms: {0!s}".format(tokenrealms))
+    serials = import_tokens(tokens, tokenrealms=tokenrealms,
+                            default_hashlib=hashlib)
 
     g.audit_object.log({'info': u"{0!s}, {1!s} (imported: {2:d})".format(file_type,
                                                            token_file,
-                                                           len(TOKENS)),
-                        'serial': ', '.join(TOKENS)})
+                                                           len(serials)),
+                        'serial': ', '.join(serials)})
     # logTokenNum()
 
-    return send_result(len(TOKENS))
+    return send_result(len(set(serials)))
 
 
 @token_blueprint.route('/copypin', methods=['POST'])
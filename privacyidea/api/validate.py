@@ -3,6 +3,7 @@
 # http://www.privacyidea.org
 # (c) cornelius kölbel, privacyidea.org
 #
+# 2018-11-20 Count the authentications for the timelimit policies
 # 2018-01-22 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #            Add offline refill
 # 2016-12-20 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -98,11 +99,15 @@ from privacyidea.api.recover import recover_blueprint
 from privacyidea.lib.utils import get_client_ip
 from privacyidea.lib.event import event
 from privacyidea.lib.subscriptions import CheckSubscription
+from privacyidea.lib.authcounter import record_authentication
 from privacyidea.api.auth import admin_required
 from privacyidea.lib.policy import ACTION
 from privacyidea.lib.token import get_tokens
 from privacyidea.lib.machine import list_token_machines
 from privacyidea.lib.applications.offline import MachineApplication
+from privacyidea.lib import metrics
+from privacyidea.lib.timing import (span, log_timing_to_audit,
+                                    add_server_timing_header)
 import json
 
 log = logging.getLogger(__name__)
@@ -113,6 +118,7 @@ validate_blueprint = Blueprint('validate_blueprint', __name__)
 @validate_blueprint.before_request
 @register_blueprint.before_request
 @recover_blueprint.before_request
+@span("before_request")
 def before_request():
     """
     This is executed before the request
@@ -155,11 +161,13 @@ def after_request(response):
     # In certain error cases the before_request was not handled
     # completely so that we do not have an audit_object
     if "audit_object" in g:
-        g.audit_object.finalize_log()
+        log_timing_to_audit(g.audit_object)
+        with span("finalize_log"):
+            g.audit_object.finalize_log()
 
     # No caching!
     response.headers['Cache-Control'] = 'no-cache'
-    return response
+    return add_server_timing_header(response)
 
 
 @validate_blueprint.route('/offlinerefill', methods=['POST'])
@@ -355,6 +363,18 @@ def check():
                         "success": result,
                         "serial": serial or details.get("serial"),
                         "tokentype": details.get("type")})
+    if user.login:
+        # Count the authentication for the policies authmaxsuccess and
+        # authmaxfail
+        record_authentication(user.login, user.realm, result)
+    if result:
+        auth_result = "accept"
+    elif details.get("transaction_id"):
+        auth_result = "challenge"
+    else:
+        auth_result = "reject"
+    metrics.inc("privacyidea_validate_requests_total",
+                labels={"result": auth_result})
     return send_result(result, details=details)
 
 
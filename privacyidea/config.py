@@ -52,6 +52,10 @@ class TestingConfig(Config):
     PI_NODE = "Node1"
     PI_NODES = ["Node2"]
     PI_ENGINE_REGISTRY_CLASS = "null"
+    # The tests expect, that expired challenges are deleted immediately
+    PI_CHALLENGE_CLEANUP_INTERVAL = 0
+    # and that the client applications are written immediately
+    PI_CLIENTAPPLICATION_FLUSH_INTERVAL = 0
 
 
 class ProductionConfig(Config):
@@ -25,5 +25,7 @@ An application must be inherited from the MachineApplicationBase class.
 """
 from .base import MachineApplication as MachineApplicationBase
 from .base import get_auth_item
+from .base import get_auth_item_list
+from .base import is_application_cache_auth_items
 from .base import is_application_allow_bulk_call
 from .base import get_application_types
@@ -80,6 +80,11 @@ class MachineApplication(object):
     very host he is starting the request.
     '''
     allow_bulk_call = False
+    '''If cache_auth_items is true, the authentication items may be
+    cached, since they do not contain one time values and
+    do not change the token.
+    '''
+    cache_auth_items = False
 
     @classmethod
     def get_name(cls):
@@ -102,6 +107,27 @@ class MachineApplication(object):
         """
         return "nothing"
 
+    @classmethod
+    def get_authentication_items(cls, machinetokens, challenge=None,
+                                 filter_param=None):
+        """
+        returns the authentication items of several machine tokens.
+        An application can overwrite this method to use the tokens, which
+        were already loaded with the machine tokens.
+
+        :param machinetokens: list of machine tokens like returned by
+            list_machine_tokens. The key "token" contains the tokenclass
+            object.
+        :type machinetokens: list of dicts
+        :return: list of authentication items in the order of machinetokens
+        """
+        return [cls.get_authentication_item(mtoken.get("type"),
+                                            mtoken.get("serial"),
+                                            challenge=challenge,
+                                            options=mtoken.get("options"),
+                                            filter_param=filter_param)
+                for mtoken in machinetokens]
+
     @staticmethod
     def get_options():
         """
@@ -128,6 +154,31 @@ def get_auth_item(application, token_type,serial,
     return auth_item
 
 
+def get_auth_item_list(application, machinetokens, challenge=None,
+                       filter_param=None):
+    """
+    Return the authentication items of several machine tokens of one
+    application.
+
+    :param application: The name of the application
+    :param machinetokens: list of machine tokens including the tokenclass
+        objects
+    :return: list of authentication items in the order of machinetokens
+    """
+    auth_class = get_machine_application_class_dict().get(application)
+    return auth_class.get_authentication_items(machinetokens,
+                                               challenge=challenge,
+                                               filter_param=filter_param)
+
+
+def is_application_cache_auth_items(application):
+    """
+    Return True, if the authentication items of the application may be cached.
+    """
+    auth_class = get_machine_application_class_dict().get(application)
+    return bool(auth_class and auth_class.cache_auth_items)
+
+
 @log_with(log)
 def is_application_allow_bulk_call(application_module):
     mod = import_module(application_module)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Find the refill OTP without changing the token counter
+#  2018-11-15 Hash the OTP values in a process pool
 #  2015-04-08 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add options ROUNDS to avoid timeouts during OTP hash calculation
 #  2015-04-03 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -26,12 +28,97 @@
 from privacyidea.lib.applications import MachineApplicationBase
 from privacyidea.lib.crypto import geturandom
 from privacyidea.lib.error import ValidateError, ParameterError
+from privacyidea.lib.framework import get_app_config_value
+import atexit
 import logging
+import multiprocessing
+import os
+import threading
+import traceback
 import passlib.hash
 from privacyidea.lib.token import get_tokens
 log = logging.getLogger(__name__)
 ROUNDS = 6549
 REFILLTOKEN_LENGTH = 40
+# The time in seconds to wait for the hashing processes
+HASH_TIMEOUT = 300
+# The hash pool of this process as tuple of pid and pool
+_hash_pool = (None, None)
+_hash_pool_lock = threading.Lock()
+
+
+def _hash_password(password_rounds):
+    """
+    Return the PBKDF2 hash of a password. This is executed in the processes
+    of the hash pool.
+
+    :param password_rounds: tuple of the password and the number of rounds
+    """
+    password, rounds = password_rounds
+    return passlib.hash.pbkdf2_sha512.encrypt(password, rounds=rounds,
+                                              salt_size=10)
+
+
+def _get_hash_pool():
+    """
+    Return the process pool of this process to hash the OTP values or None,
+    if ``PI_OFFLINE_HASH_PROCESSES`` is not set. The pool is started once
+    per process and is closed, when the process exits.
+    """
+    global _hash_pool
+    processes = int(get_app_config_value("PI_OFFLINE_HASH_PROCESSES", 0))
+    if processes <= 0:
+        return None
+    with _hash_pool_lock:
+        pid, pool = _hash_pool
+        if pid != os.getpid():
+            # The pool of the parent process can not be used after a fork
+            pool = multiprocessing.Pool(processes)
+            _hash_pool = (os.getpid(), pool)
+        return pool
+
+
+@atexit.register
+def close_hash_pool():
+    """
+    Stop the processes of the hash pool of this process.
+    """
+    global _hash_pool
+    with _hash_pool_lock:
+        pid, pool = _hash_pool
+        _hash_pool = (None, None)
+    if pool is not None and pid == os.getpid():
+        pool.terminate()
+        pool.join()
+
+
+def hash_otps(passwords, rounds=ROUNDS):
+    """
+    Hash the given passwords with PBKDF2. If ``PI_OFFLINE_HASH_PROCESSES`` is
+    set, the passwords are hashed in parallel in a pool of processes.
+    If the pool fails, the passwords are hashed in the current process.
+
+    :param passwords: dictionary of counters and passwords (PIN + OTP)
+    :param rounds: Number of PBKDF2 rounds
+    :return: dictionary of counters and the hashed passwords
+    """
+    keys = list(passwords)
+    args = [(passwords[key], rounds) for key in keys]
+    hashes = None
+    if len(args) > 1:
+        try:
+            pool = _get_hash_pool()
+            if pool:
+                hashes = pool.map_async(_hash_password,
+                                        args).get(HASH_TIMEOUT)
+        except Exception as exx:  # pragma: no cover
+            log.warning(u"Could not hash the OTP values in the process "
+                        u"pool: {0!r}".format(exx))
+            log.debug(u"{0!s}".format(traceback.format_exc()))
+            close_hash_pool()
+    if hashes is None:
+        hashes = [_hash_password(arg) for arg in args]
+    return dict(zip(keys, hashes))
 
 
 class MachineApplication(MachineApplicationBase):
@@ -49,6 +136,7 @@ class MachineApplication(MachineApplicationBase):
     options options:
       * user: a username.
       * count: is the number of OTP values returned
+      * rounds: is the number of PBKDF2 rounds to hash the OTP values
 
     """
     application_name = "offline"
@@ -79,12 +167,9 @@ class MachineApplication(MachineApplicationBase):
             raise ParameterError("Invalid refill amount: {!r}".format(amount))
         (res, err, otp_dict) = token_obj.get_multi_otp(count=amount, counter_index=True)
         otps = otp_dict.get("otp")
-        for key in otps.keys():
-            # Return the hash of OTP PIN and OTP values
-            otps[key] = passlib.hash. \
-                pbkdf2_sha512.encrypt(otppin + otps.get(key),
-                                      rounds=rounds,
-                                      salt_size=10)
+        # Return the hash of OTP PIN and OTP values
+        otps = hash_otps(dict((key, otppin + otp) for key, otp in
+                              otps.items()), rounds)
         # We do not disable the token, so if all offline OTP values
         # are used, the token can be used the authenticate online again.
         # token_obj.enable(False)
@@ -106,6 +191,7 @@ class MachineApplication(MachineApplicationBase):
         :param options: dict that might contain "count" and "rounds"
         :return: a dictionary of auth items
         """
+        from privacyidea.lib.tokens.HMAC import HmacOtp
         options = options or {}
         count = int(options.get("count", 100))
         rounds = int(options.get("rounds", ROUNDS))
@@ -116,10 +202,12 @@ class MachineApplication(MachineApplicationBase):
         first_offline_counter = current_token_counter - count
         if first_offline_counter < 0:
             first_offline_counter = 0
-        # find the value in the offline OTP values! This resets the token.count!
-        matching_count = token_obj.check_otp(otpval, first_offline_counter, count)
-        token_obj.set_otp_count(current_token_counter)
-        # Raise an exception *after* we reset the token counter
+        # find the value in the offline OTP values. The counter of the token
+        # is not changed, since these values are already consumed.
+        hmac2otp = HmacOtp(token_obj.token.get_otpkey(),
+                           first_offline_counter, int(token_obj.token.otplen),
+                           token_obj.get_hashlib(token_obj.hashlib))
+        matching_count = hmac2otp.checkOtp(otpval, count)
         if matching_count < 0:
             raise ValidateError("You provided a wrong OTP value.")
         # We have to add 1 here: Assume *first_offline_counter* is the counter value of the first offline OTP
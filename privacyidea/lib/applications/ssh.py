@@ -24,6 +24,7 @@ This file is tested in tests/test_lib_machinetokens.py
 from privacyidea.lib.applications import MachineApplicationBase
 import logging
 from privacyidea.lib.token import get_tokens
+from privacyidea.lib.user import get_usernames
 log = logging.getLogger(__name__)
 
 
@@ -43,6 +44,7 @@ class MachineApplication(MachineApplicationBase):
     If we would support OTP with SSH, this might be sensitive information!
     '''
     allow_bulk_call = True
+    cache_auth_items = True
 
     @staticmethod
     def get_authentication_item(token_type,
@@ -90,6 +92,75 @@ class MachineApplication(MachineApplicationBase):
 
         return ret
 
+    @classmethod
+    def get_authentication_items(cls, machinetokens, challenge=None,
+                                 filter_param=None):
+        """
+        Return the SSH pub keys of several machine tokens. The tokens and
+        their tokeninfo were already loaded with the machine tokens. The
+        owners of the tokens are resolved with one request per resolver.
+
+        :param machinetokens: list of machine tokens including the
+            tokenclass objects
+        :return: list of auth_items
+        """
+        filter_param = filter_param or {}
+        user_filter = filter_param.get("user")
+        tokens = []
+        for mtoken in machinetokens:
+            tokclass = mtoken.get("token")
+            options = mtoken.get("options") or {}
+            if mtoken.get("type", "").lower() != "sshkey":
+                log.info("Token %r, type %r is not supported by"
+                         "SSH application module" % (mtoken.get("serial"),
+                                                     mtoken.get("type")))
+                tokclass = None
+            elif user_filter and user_filter != options.get("user"):
+                log.info("The requested user %s does not match the user "
+                         "option (%s) of the SSH application." % (
+                    user_filter, options.get("user")))
+                tokclass = None
+            elif not tokclass.token.active:
+                tokclass = None
+            tokens.append(tokclass)
+
+        owners = {}
+        for tokclass in tokens:
+            if tokclass and tokclass.token.user_id and tokclass.token.resolver:
+                owners.setdefault(tokclass.token.resolver,
+                                  set()).add(tokclass.token.user_id)
+        usernames = {}
+        for resolvername, userids in owners.items():
+            try:
+                usernames[resolvername] = get_usernames(list(userids),
+                                                        resolvername)
+            except Exception as exx:  # pragma: no cover
+                # The owners of this resolver are resolved per token
+                log.warning("Could not resolve the token owners of resolver "
+                            "{0!s}: {1!s}".format(resolvername, exx))
+
+        ret = []
+        for tokclass in tokens:
+            auth_item = {}
+            if tokclass:
+                auth_item["sshkey"] = tokclass.get_sshkey()
+                resolvername = tokclass.token.resolver
+                if resolvername in usernames:
+                    username = usernames[resolvername].get(
+                        tokclass.token.user_id)
+                    # The token owner needs a unique realm like in
+                    # TokenClass.user
+                    if username and len(tokclass.token.realm_list) == 1:
+                        auth_item["username"] = username
+                elif tokclass.token.user_id and resolvername:
+                    user_object = tokclass.user
+                    if user_object:
+                        uInfo = user_object.info
+                        if "username" in uInfo:
+                            auth_item["username"] = uInfo.get("username")
+            ret.append(auth_item)
+        return ret
+
     @staticmethod
     def get_options():
         """
@@ -44,6 +44,7 @@ from privacyidea.lib.crypto import Sign
 from privacyidea.lib.pooling import get_engine
 from privacyidea.lib.utils import censor_connect_string
 from privacyidea.lib.lifecycle import register_finalizer
+from privacyidea.lib.metrics import timed
 from privacyidea.lib.utils import truncate_comma_list
 from sqlalchemy import MetaData, cast, String
 from sqlalchemy import asc, desc, and_, or_
@@ -139,8 +140,9 @@ class Audit(AuditBase):
             if column in self.audit_data:
                 data = self.audit_data[column]
                 if isinstance(data, string_types):
-                    if column == "policies":
-                        # The policies column is shortend per comma entry
+                    if column in ["policies", "timing"]:
+                        # The policies and timing columns are shortend per
+                        # comma entry
                         data = truncate_comma_list(data, l)
                     else:
                         data = data[:l]
@@ -212,6 +214,7 @@ class Audit(AuditBase):
             self.session.close()
         return count
 
+    @timed("privacyidea_audit_write_seconds")
     def finalize_log(self):
         """
         This method is used to log the data.
@@ -235,7 +238,8 @@ class Audit(AuditBase):
                           client=self.audit_data.get("client", ""),
                           loglevel=self.audit_data.get("log_level"),
                           clearance_level=self.audit_data.get("clearance_level"),
-                          policies=self.audit_data.get("policies")
+                          policies=self.audit_data.get("policies"),
+                          timing=self.audit_data.get("timing")
                           )
             self.session.add(le)
             self.session.commit()
@@ -357,6 +361,7 @@ class Audit(AuditBase):
                     'client': LogEntry.client,
                     'loglevel': LogEntry.loglevel,
                     'policies': LogEntry.policies,
+                    'timing': LogEntry.timing,
                     'clearance_level': LogEntry.clearance_level}
         return sortname.get(key)
 
@@ -503,6 +508,7 @@ class Audit(AuditBase):
                       'info': audit_entry.info,
                       'privacyidea_server': audit_entry.privacyidea_server,
                       'policies': audit_entry.policies,
+                      'timing': audit_entry.timing,
                       'client': audit_entry.client,
                       'log_level': audit_entry.loglevel,
                       'clearance_level': audit_entry.clearance_level
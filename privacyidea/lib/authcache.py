@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-16 Add an in-process cache in front of the authcache table,
+#             write the last_auth of cached authentications later and
+#             store salted hashes of the passwords
 #  2017-08-11 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             initial writeup
 #
@@ -20,17 +23,151 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+__doc__ = """The authentication cache stores hashes of successfully verified
+credentials in the database table ``authcache``.
+
+Each process keeps the recently verified entries in memory, so that cached
+authentications are answered without accessing the database. The memory cache
+is configured in pi.cfg:
+
+``PI_AUTH_CACHE_MEMORY_SIZE`` is the number of entries (default 1000).
+0 disables the memory cache.
+``PI_AUTH_CACHE_MEMORY_TTL`` is the number of seconds (default 60), for which
+an entry is used from memory, before it is read from the database again. The
+``last_auth`` of authentications, that were answered from memory, is written
+to the database in the same interval.
+
+This module is tested in tests/test_lib_authcache.py
+"""
 from ..models import AuthCache, db
+from .framework import get_app_local_store, get_app_config_value
+from .utils import to_utf8
 from sqlalchemy import and_
 from hashlib import sha256
 from binascii import hexlify
+from collections import OrderedDict
+from threading import Lock
 import datetime
+import hmac
 import logging
+import os
+import time
 
 log = logging.getLogger(__name__)
 
+SALT_LENGTH = 8
+
+
+def hash_password(password, salt=None):
+    """
+    Return the salted SHA256 hash of the password, which is stored in the
+    ``authentication`` column of the authcache table.
+
+    :param password: The password
+    :param salt: The salt as hex string. A random salt is used, if no salt
+        is given.
+    :return: The hash in the format ``salt$hash``
+    """
+    if salt is None:
+        salt = hexlify(os.urandom(SALT_LENGTH))
+    return u"{0!s}${1!s}".format(salt, hexlify(sha256(
+        salt + to_utf8(password)).digest()))
+
+
+def _verify_password(password, auth_hash):
+    """
+    Verify the password against a salted hash or against an unsalted hash of
+    an older entry.
+    """
+    if u"$" in auth_hash:
+        salt = auth_hash.split(u"$", 1)[0].encode("ascii")
+        expected = hash_password(password, salt)
+    else:
+        expected = hexlify(sha256(to_utf8(password)).digest())
+    return hmac.compare_digest(to_utf8(expected), to_utf8(auth_hash))
+
+
+class MemoryAuthCache(object):
+    """
+    The cached authentications of this process and the last_auth
+    timestamps, that still need to be written to the database.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._secret = os.urandom(16)
+        self.last_flush = time.time()
+
+    def key(self, username, realm, resolver, password):
+        data = u"\x00".join([u"{0!r}".format(part) for part in
+                              [username, realm, resolver]])
+        return hmac.new(self._secret, to_utf8(data) + b"\x00" +
+                        to_utf8(password), sha256).hexdigest()
+
+    def get(self, key, ttl):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry["loaded"] > ttl:
+                del self._entries[key]
+                entry = None
+            return entry
+
+    def put(self, key, entry, size):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def remove_user(self, username, realm, resolver):
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry["user"] == (username, realm, resolver):
+                    del self._entries[key]
+
+    def set_last_auth(self, entry, last_auth):
+        with self._lock:
+            entry["last_auth"] = last_auth
+            self._pending[entry["id"]] = last_auth
+
+    def pop_pending(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self.last_flush = time.time()
+        return pending
+
+
+def _get_memory_cache():
+    store = get_app_local_store()
+    memory_cache = store.get("auth_cache")
+    if memory_cache is None:
+        memory_cache = store.setdefault("auth_cache", MemoryAuthCache())
+    return memory_cache
+
+
+def flush_last_auth():
+    """
+    Write the last_auth of the authentications, which were answered from
+    memory, to the database.
+    """
+    pending = _get_memory_cache().pop_pending()
+    if pending:
+        db.session.bulk_update_mappings(AuthCache, [
+            {"id": cache_id, "last_auth": last_auth}
+            for cache_id, last_auth in pending.items()])
+        db.session.commit()
+
 
 def add_to_cache(username, realm, resolver, auth_hash):
+    """
+    Add an entry to the authcache table.
+
+    :param auth_hash: The hash of the password as returned by hash_password
+    :return: The id of the entry
+    """
     # Can not store timezone aware timestamps!
     first_auth = datetime.datetime.utcnow()
     record = AuthCache(username, realm, resolver, auth_hash, first_auth)
@@ -48,6 +185,7 @@ def update_cache_last_auth(cache_id):
 
 
 def delete_from_cache(username, realm, resolver, auth_hash):
+    _get_memory_cache().remove_user(username, realm, resolver)
     r = db.session.query(AuthCache).filter(AuthCache.username == username,
                                        AuthCache.realm == realm,
                                        AuthCache.resolver == resolver,
@@ -62,6 +200,9 @@ def verify_in_cache(username, realm, resolver, password,
                     last_auth = None):
     """
     Verify if the given credentials are cached and if the time is correct.
+
+    The credentials are first looked up in the memory of the process. If
+    they are not found there, they are looked up in the database.
     
     :param username: 
     :param realm: 
@@ -73,29 +214,54 @@ def verify_in_cache(username, realm, resolver, password,
         verified. Only find newer entries 
     :return: 
     """
+    size = int(get_app_config_value("PI_AUTH_CACHE_MEMORY_SIZE", 1000))
+    ttl = float(get_app_config_value("PI_AUTH_CACHE_MEMORY_TTL", 60))
+    memory_cache = _get_memory_cache()
+    key = None
+    if size > 0:
+        key = memory_cache.key(username, realm, resolver, password)
+        entry = memory_cache.get(key, ttl)
+        if entry and (not first_auth or entry["first_auth"] > first_auth) \
+                and (not last_auth or (entry["last_auth"] and
+                                       entry["last_auth"] > last_auth)):
+            memory_cache.set_last_auth(entry, datetime.datetime.utcnow())
+            if time.time() - memory_cache.last_flush >= ttl:
+                flush_last_auth()
+            return True
+    # The database must know the last_auth of the authentications, which
+    # were answered from memory.
+    flush_last_auth()
+
     conditions = []
     conditions.append(AuthCache.username == username)
     conditions.append(AuthCache.realm == realm)
     conditions.append(AuthCache.resolver == resolver)
-    auth_hash = hexlify(sha256(password).digest())
-    conditions.append(AuthCache.authentication == auth_hash)
+    candidates = [r for r in AuthCache.query.filter(and_(*conditions)).all()
+                  if _verify_password(password, r.authentication or u"")]
 
-    if first_auth:
-        conditions.append(AuthCache.first_auth > first_auth)
-    if last_auth:
-        conditions.append(AuthCache.last_auth > last_auth)
-
-    filter_condition = and_(*conditions)
-    r = AuthCache.query.filter(filter_condition).first()
+    r = None
+    for candidate in candidates:
+        if (not first_auth or candidate.first_auth > first_auth) and \
+                (not last_auth or (candidate.last_auth and
+                                   candidate.last_auth > last_auth)):
+            r = candidate
+            break
     result = bool(r)
 
     if result:
         # Update the last_auth
         update_cache_last_auth(r.id)
+        if key:
+            memory_cache.put(key, {"id": r.id,
+                                   "user": (username, realm, resolver),
+                                   "first_auth": r.first_auth,
+                                   "last_auth": datetime.datetime.utcnow(),
+                                   "loaded": time.time()}, size)
 
     else:
         # Delete older entries
-        delete_from_cache(username, realm, resolver, auth_hash)
+        for candidate in candidates:
+            db.session.delete(candidate)
+        db.session.commit()
 
     return result
-
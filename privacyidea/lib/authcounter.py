@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+#  2018-11-20 Count the authentications of the users in time buckets
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """The policies authmaxsuccess and authmaxfail limit the number of
+successful and failed authentications of a user in a time window.
+
+This module counts the authentications of /validate/check per user, realm
+and result in the table "authcounter", so that the policies do not need to
+count the entries of the audit log. The authentications are counted in time
+buckets of ``PI_AUTH_COUNTER_BUCKET`` seconds (default 10). A time window
+is counted with all buckets, which overlap with the window. Thus the window
+can be up to one bucket longer.
+
+``PI_AUTH_COUNTER_FLUSH_INTERVAL`` collects the authentications in the
+process for the given number of seconds and writes them to the database in
+one statement per user (default 0, write immediately).
+
+Buckets, which are older than ``PI_AUTH_COUNTER_RETENTION`` seconds (default
+one day), are deleted. Time windows, which are longer, are counted in the
+audit log. ``PI_AUTH_COUNTER`` can be set to False to always count the
+audit log.
+
+This module is tested in tests/test_lib_authcounter.py
+"""
+import logging
+import time
+from threading import Lock
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from privacyidea.models import AuthCounter, db
+from privacyidea.lib.framework import (get_app_local_store,
+                                       get_app_config_value)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKET = 10
+DEFAULT_RETENTION = 86400
+#: The number of seconds between two deletions of old buckets per process
+CLEANUP_INTERVAL = 3600
+
+
+class AuthCounterAccumulator(object):
+    """
+    Collects the authentications of this process, which are written to the
+    database later.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts = {}
+        self.last_flush = time.time()
+
+    def add(self, key, value=1):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + value
+
+    def get(self, username, realm, success, start_bucket):
+        """
+        Return the number of collected authentications of the user since
+        the given bucket.
+        """
+        with self._lock:
+            return sum([value for (c_username, c_realm, c_success, bucket), value
+                        in self._counts.items()
+                        if (c_username, c_realm, c_success) ==
+                        (username, realm, success) and bucket >= start_bucket])
+
+    def pop(self):
+        """
+        Remove and return the collected authentications.
+
+        :return: dict of (username, realm, success, bucket) and counts
+        """
+        with self._lock:
+            counts = self._counts
+            self._counts = {}
+            self.last_flush = time.time()
+        return counts
+
+
+def _get_accumulator():
+    store = get_app_local_store()
+    accumulator = store.get("authcounter_accumulator")
+    if accumulator is None:
+        accumulator = store.setdefault("authcounter_accumulator",
+                                       AuthCounterAccumulator())
+    return accumulator
+
+
+def _get_bucket(timestamp):
+    bucket_size = int(get_app_config_value("PI_AUTH_COUNTER_BUCKET",
+                                           DEFAULT_BUCKET))
+    return int(timestamp) // bucket_size * bucket_size
+
+
+def _add(username, realm, success, bucket, value):
+    """
+    Add the value to the counter of the bucket by an atomic UPDATE
+    statement. The counter is created, if it does not exist yet.
+    """
+    query = AuthCounter.query.filter_by(username=username, realm=realm,
+                                        success=success, bucket=bucket)
+    if not query.update({"counter": AuthCounter.counter + value},
+                        synchronize_session=False):
+        try:
+            db.session.add(AuthCounter(username, realm, success, bucket,
+                                       value))
+            db.session.commit()
+            return
+        except IntegrityError:
+            # The counter was created by a concurrent process
+            db.session.rollback()
+            query.update({"counter": AuthCounter.counter + value},
+                         synchronize_session=False)
+    db.session.commit()
+
+
+def flush_auth_counters():
+    """
+    Write the authentications, that were collected in this process, to the
+    database.
+    """
+    for (username, realm, success, bucket), value in \
+            _get_accumulator().pop().items():
+        _add(username, realm, success, bucket, value)
+
+
+def cleanup_auth_counters():
+    """
+    Delete the buckets, which are older than ``PI_AUTH_COUNTER_RETENTION``
+    seconds.
+
+    :return: The number of deleted buckets
+    """
+    retention = int(get_app_config_value("PI_AUTH_COUNTER_RETENTION",
+                                         DEFAULT_RETENTION))
+    r = AuthCounter.query.filter(
+        AuthCounter.bucket < _get_bucket(time.time() - retention)).delete()
+    db.session.commit()
+    return r
+
+
+def _cleanup_auth_counters_limited():
+    store = get_app_local_store()
+    now = time.time()
+    last_cleanup = store.get("authcounter_cleanup")
+    if last_cleanup is not None and now - last_cleanup < CLEANUP_INTERVAL:
+        return
+    store["authcounter_cleanup"] = now
+    cleanup_auth_counters()
+
+
+def record_authentication(username, realm, success):
+    """
+    Count an authentication of the user.
+
+    :param username: The login name of the user
+    :param realm: The realm of the user
+    :param success: The result of the authentication
+    :type success: bool
+    """
+    if not get_app_config_value("PI_AUTH_COUNTER", True):
+        return
+    try:
+        bucket = _get_bucket(time.time())
+        flush_interval = int(get_app_config_value(
+            "PI_AUTH_COUNTER_FLUSH_INTERVAL", 0))
+        if flush_interval:
+            accumulator = _get_accumulator()
+            accumulator.add((username, realm, bool(success), bucket))
+            if time.time() - accumulator.last_flush >= flush_interval:
+                flush_auth_counters()
+        else:
+            _add(username, realm, bool(success), bucket, 1)
+        _cleanup_auth_counters_limited()
+    except Exception as exx:  # pragma: no cover
+        db.session.rollback()
+        log.warning("Could not count the authentication of {0!s}@{1!s}: "
+                    "{2!s}".format(username, realm, exx))
+
+
+def get_auth_count(username, realm, success, tdelta):
+    """
+    Return the number of successful or failed authentications of the user
+    within the given time window.
+
+    :param username: The login name of the user
+    :param realm: The realm of the user
+    :param success: Count the successful or the failed authentications
+    :type success: bool
+    :param tdelta: The time window
+    :type tdelta: timedelta
+    :return: The number of authentications or None, if the authentications
+        are not counted for this time window. In this case the audit log
+        needs to be counted.
+    """
+    if not get_app_config_value("PI_AUTH_COUNTER", True):
+        return None
+    retention = int(get_app_config_value("PI_AUTH_COUNTER_RETENTION",
+                                         DEFAULT_RETENTION))
+    if tdelta.total_seconds() > retention:
+        return None
+    start_bucket = _get_bucket(time.time() - tdelta.total_seconds())
+    success = bool(success)
+    try:
+        count = db.session.query(func.sum(AuthCounter.counter)).filter(
+            AuthCounter.username == username,
+            AuthCounter.realm == realm,
+            AuthCounter.success == success,
+            AuthCounter.bucket >= start_bucket).scalar() or 0
+    except Exception as exx:  # pragma: no cover
+        db.session.rollback()
+        log.warning("Could not read the authentication counters: "
+                    "{0!s}".format(exx))
+        return None
+    return count + _get_accumulator().get(username, realm, success,
+                                          start_bucket)
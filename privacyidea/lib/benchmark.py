@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+#
+#  2018-11-20 Memory allocated per request
+#  2018-11-20 Benchmark of the worker startup
+#  2018-11-12 Benchmark of the authentication paths
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """This module contains a benchmark of the authentication paths.
+
+It seeds users in a flat file resolver, tokens, policies and event handlers
+and measures the throughput and the latency percentiles of
+
+ * /validate/check with HOTP, TOTP and SPASS tokens,
+ * /validate/check triggering a challenge of email and SMS tokens,
+ * /token/ listing,
+ * /audit/ search and
+ * policy lookups.
+
+With ``allocations`` the peak memory, that is allocated during each
+request, is traced with the module tracemalloc of Python 3.
+
+``measure_startup`` measures the cold start of a new worker process, i.e.
+importing the application, creating it and answering the first request.
+
+No external services are required. Emails and SMS are sent to a stub SMTP
+server. The results are returned as a dict, that can be written as JSON, so
+that the results of different releases can be compared.
+
+The benchmark is run with the tool ``privacyidea-benchmark``.
+
+This module is tested in tests/test_lib_benchmark.py
+"""
+import binascii
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import smtplib
+from flask import current_app
+
+from privacyidea.lib.auth import create_db_admin
+from privacyidea.lib.config import set_privacyidea_config
+from privacyidea.lib.event import set_event
+from privacyidea.lib.policy import PolicyClass, set_policy, SCOPE, ACTION
+from privacyidea.lib.realm import set_realm, set_default_realm
+from privacyidea.lib.resolver import save_resolver
+from privacyidea.lib.smsprovider.SMSProvider import set_smsgateway
+from privacyidea.lib.smtpserver import add_smtpserver
+from privacyidea.lib.token import init_token
+from privacyidea.lib.tokens.HMAC import HmacOtp
+from privacyidea.lib.tokens.totptoken import TotpTokenClass
+from privacyidea.lib.user import User
+
+log = logging.getLogger(__name__)
+
+REALM = u"benchmark"
+RESOLVER = u"benchmark"
+IDENTIFIER = u"benchmark"
+OTPKEY = u"3132333435363738393031323334353637383930"
+PIN = u"pin"
+ADMIN = u"benchmark"
+TOKENTYPES = ["hotp", "totp", "spass", "email", "sms"]
+SCENARIOS = ["validate_hotp", "validate_totp", "validate_spass",
+             "challenge_email", "challenge_sms", "token_list", "audit_search",
+             "policy_lookup"]
+PERCENTILES = [50, 90, 95, 99]
+STARTUP_PHASES = ["import", "create_app", "first_request", "total"]
+
+# The script, that is run in a new process to measure the startup
+STARTUP_SCRIPT = """
+import json
+import sys
+import time
+start = time.time()
+from privacyidea.app import create_app
+imported = time.time()
+app = create_app(config_name=sys.argv[1], config_file=sys.argv[2],
+                 silent=True)
+created = time.time()
+try:
+    app.test_client().post("/validate/check", data={"user": "startup",
+                                                    "pass": "startup"})
+except Exception as exx:
+    # The request is only measured
+    sys.stderr.write("The first request failed: {0!r}\\n".format(exx))
+finished = time.time()
+print(json.dumps({
+    "import": imported - start,
+    "create_app": created - imported,
+    "first_request": finished - created,
+    "total": finished - start,
+    "modules": len(sys.modules),
+    "token_modules": sorted(name for name, module in sys.modules.items()
+                            if module and
+                            name.startswith("privacyidea.lib.tokens."))}))
+"""
+
+
+class StubSMTP(object):
+    """
+    An SMTP client, that does not connect to a server but only records the
+    sent messages.
+    """
+    messages = []
+
+    def __init__(self, host="", port=0, *args, **kwds):
+        pass
+
+    def ehlo(self, *args):
+        return 250, "OK"
+
+    def starttls(self, *args, **kwds):
+        return 220, "OK"
+
+    def login(self, *args):
+        return 235, "OK"
+
+    def sendmail(self, sender, recipients, msg):
+        StubSMTP.messages.append((sender, recipients, msg))
+        return {}
+
+    def quit(self):
+        return 221, "OK"
+
+
+@contextmanager
+def stub_smtp():
+    """
+    Replace the SMTP client during the benchmark, so that emails and SMS are
+    not sent.
+    """
+    smtp_class = smtplib.SMTP
+    smtplib.SMTP = StubSMTP
+    del StubSMTP.messages[:]
+    try:
+        yield StubSMTP.messages
+    finally:
+        smtplib.SMTP = smtp_class
+
+
+def username(tokentype, number):
+    return u"{0!s}{1:05d}".format(tokentype, number)
+
+
+def percentile(values, percent):
+    """
+    Return the percentile of the sorted values by the nearest rank method.
+    """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+def seed(directory, users=10, policies=10, events=0, rounds=1):
+    """
+    Create the users, tokens, policies and event handlers of the benchmark in
+    the database of the current application.
+
+    For each tokentype ``users`` users are created, that own one token of
+    this type with the PIN "pin".
+
+    :param directory: The directory, in which the passwd file of the flat
+        file resolver is written
+    :param users: The number of users per tokentype
+    :param policies: The number of additional policies, that do not match
+        the benchmark users
+    :param events: The number of event handlers for /validate/check
+    :param rounds: The number of authentications per user. TOTP tokens get
+        a time window, that allows this number of authentications.
+    :return: The admin password
+    """
+    filename = os.path.join(directory, "benchmark-passwd")
+    with open(filename, "w") as f:
+        uid = 1000
+        for tokentype in TOKENTYPES:
+            for i in range(users):
+                uid += 1
+                f.write("{0!s}:x:{1:d}:{1:d}:Benchmark User,,,+49 1234 {1:d},"
+                        "{0!s}@example.com:/home/{0!s}:/bin/false\n".format(
+                            username(tokentype, i), uid))
+    save_resolver({"resolver": RESOLVER, "type": "passwdresolver",
+                   "fileName": filename})
+    set_realm(REALM, [RESOLVER])
+    set_default_realm(REALM)
+
+    add_smtpserver(IDENTIFIER, u"localhost", sender=u"pi@example.com")
+    set_smsgateway(IDENTIFIER,
+                   u"privacyidea.lib.smsprovider.SmtpSMSProvider"
+                   u".SmtpSMSProvider",
+                   options={"SMTPIDENTIFIER": IDENTIFIER,
+                            "MAILTO": u"{phone}@sms.example.com"})
+    set_privacyidea_config("email.identifier", IDENTIFIER)
+    set_privacyidea_config("sms.identifier", IDENTIFIER)
+
+    for tokentype in TOKENTYPES:
+        for i in range(users):
+            param = {"type": tokentype, "pin": PIN,
+                     "serial": u"B{0!s}".format(username(tokentype, i)).upper()}
+            if tokentype in ["hotp", "totp", "email", "sms"]:
+                param["otpkey"] = OTPKEY
+            if tokentype == "totp":
+                param["timeStep"] = 30
+                param["timeWindow"] = 30 * (rounds + 2)
+            if tokentype == "email":
+                param["email"] = u"{0!s}@example.com".format(
+                    username(tokentype, i))
+            if tokentype == "sms":
+                param["phone"] = u"+49 1234 {0:d}".format(i)
+            init_token(param, user=User(username(tokentype, i), REALM))
+
+    # The benchmark administrator may read the tokens and the audit log
+    set_policy(u"benchmark_admin", scope=SCOPE.ADMIN, action=ACTION.AUDIT)
+    # Policies of other realms, that need to be checked in each request
+    scopes = [SCOPE.AUTH, SCOPE.AUTHZ, SCOPE.ADMIN, SCOPE.USER]
+    for i in range(policies):
+        set_policy(u"benchmark{0:d}".format(i), scope=scopes[i % len(scopes)],
+                   action=u"{0!s}=userstore".format(ACTION.OTPPIN),
+                   realm=u"otherrealm{0:d}".format(i))
+
+    for i in range(events):
+        set_event(u"benchmark{0:d}".format(i), event=["validate_check"],
+                  handlermodule="Counter", action="increase_counter",
+                  options={"counter_name": u"benchmark{0:d}".format(i)})
+
+    password = binascii.hexlify(os.urandom(12))
+    create_db_admin(current_app, ADMIN, password=password)
+    return password
+
+
+def _otp(counter):
+    return HmacOtp(digits=6).generate(counter=counter, inc_counter=False,
+                                      key=binascii.unhexlify(OTPKEY))
+
+
+class Benchmark(object):
+    """
+    The benchmark of the seeded users and tokens.
+
+    :param app: The flask application
+    :param users: The number of users per tokentype, that were seeded
+    :param password: The password of the benchmark administrator
+    """
+
+    def __init__(self, app, users, password):
+        self.app = app
+        self.users = users
+        self.client = app.test_client()
+        self.hotp_counter = {}
+        self.totp_counter = None
+        self.authorization = self._authenticate(password)
+
+    def _authenticate(self, password):
+        res = self.client.post("/auth", data={"username": ADMIN,
+                                              "password": password})
+        return json.loads(res.data).get("result").get("value").get("token")
+
+    def _validate(self, user, password, expected):
+        res = self.client.post("/validate/check",
+                               data={"user": user, "realm": REALM,
+                                     "pass": password})
+        result = json.loads(res.data).get("result")
+        if expected == "challenge":
+            return res.status_code == 200 and \
+                   "transaction_id" in json.loads(res.data).get("detail", {})
+        return res.status_code == 200 and result.get("value") is True
+
+    def validate_hotp(self, i):
+        user = username("hotp", i % self.users)
+        counter = self.hotp_counter.get(user, 0)
+        self.hotp_counter[user] = counter + 1
+        return self._validate(user, PIN + _otp(counter), "accept")
+
+    def validate_totp(self, i):
+        if self.totp_counter is None:
+            self.totp_counter = TotpTokenClass._time2counter(time.time(), 30)
+        # Each authentication of a user uses the next time step
+        counter = self.totp_counter + 1 + i // self.users
+        return self._validate(username("totp", i % self.users),
+                              PIN + _otp(counter), "accept")
+
+    def validate_spass(self, i):
+        return self._validate(username("spass", i % self.users), PIN, "accept")
+
+    def challenge_email(self, i):
+        return self._validate(username("email", i % self.users), PIN,
+                              "challenge")
+
+    def challenge_sms(self, i):
+        return self._validate(username("sms", i % self.users), PIN,
+                              "challenge")
+
+    def token_list(self, i):
+        res = self.client.get("/token/", query_string={"page": i % 5 + 1},
+                              headers={"Authorization": self.authorization})
+        return res.status_code == 200
+
+    def audit_search(self, i):
+        res = self.client.get("/audit/", query_string={
+            "user": username(TOKENTYPES[i % len(TOKENTYPES)],
+                             i % self.users)},
+                              headers={"Authorization": self.authorization})
+        return res.status_code == 200
+
+    def policy_lookup(self, i):
+        with self.app.app_context():
+            PolicyClass().get_action_values(
+                ACTION.OTPPIN, scope=SCOPE.AUTH, realm=REALM,
+                user=username("hotp", i % self.users), unique=True,
+                allow_white_space_in_action=True)
+        return True
+
+    def run_scenario(self, name, requests, allocations=False):
+        """
+        Run the scenario ``name`` for the given number of requests.
+
+        :param allocations: Trace the memory allocated by the requests
+        :return: dict with the number of requests and errors, the throughput
+            and the latency percentiles in milliseconds
+        """
+        scenario = getattr(self, name)
+        tracemalloc = None
+        if allocations:
+            try:
+                import tracemalloc
+            except ImportError:  # pragma: no cover
+                log.warning(u"The allocations can only be traced with "
+                            u"Python 3.")
+        latencies = []
+        peaks = []
+        errors = 0
+        start = time.time()
+        for i in range(requests):
+            if tracemalloc:
+                tracemalloc.start()
+            request_start = time.time()
+            try:
+                success = scenario(i)
+            except Exception as exx:  # pragma: no cover
+                log.warning(u"Benchmark request failed: {0!r}".format(exx))
+                success = False
+            latencies.append((time.time() - request_start) * 1000)
+            if tracemalloc:
+                peaks.append(tracemalloc.get_traced_memory()[1] / 1024.0)
+                tracemalloc.stop()
+            if not success:
+                errors += 1
+        duration = time.time() - start
+        latencies.sort()
+        latency = {"min": latencies[0] if latencies else 0.0,
+                   "max": latencies[-1] if latencies else 0.0,
+                   "mean": sum(latencies) / len(latencies) if latencies
+                   else 0.0}
+        for percent in PERCENTILES:
+            latency["p{0:d}".format(percent)] = percentile(latencies, percent)
+        results = {"requests": requests,
+                   "errors": errors,
+                   "duration": duration,
+                   "throughput": requests / duration if duration else 0.0,
+                   "latency_ms": latency}
+        if allocations:
+            peaks.sort()
+            results["allocated_kb"] = {
+                "mean": sum(peaks) / len(peaks), "p50": percentile(peaks, 50),
+                "max": peaks[-1]} if peaks else None
+        return results
+
+
+def run_benchmark(app, directory, users=10, requests=100, policies=10,
+                  events=0, scenarios=None, allocations=False):
+    """
+    Seed the database of the application and run the benchmark.
+
+    :param app: The flask application with an empty database
+    :param directory: A directory for the files of the benchmark
+    :param users: The number of users per tokentype
+    :param requests: The number of requests per scenario
+    :param policies: The number of additional policies
+    :param events: The number of event handlers for /validate/check
+    :param scenarios: The list of scenarios to run. Defaults to all scenarios.
+    :param allocations: Trace the peak memory allocated per request
+    :return: The results as dict
+    """
+    scenarios = scenarios or SCENARIOS
+    users = max(int(users), 1)
+    requests = int(requests)
+    with app.app_context():
+        password = seed(directory, users=users, policies=int(policies),
+                        events=int(events),
+                        rounds=requests // users + 1)
+    benchmark = Benchmark(app, users, password)
+    results = {}
+    with stub_smtp():
+        for name in scenarios:
+            results[name] = benchmark.run_scenario(name, requests,
+                                                   allocations=allocations)
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution("privacyidea").version
+    except Exception:  # pragma: no cover
+        version = "unknown"
+    return {"privacyidea": version,
+            "python": platform.python_version(),
+            "database": app.config.get("SQLALCHEMY_DATABASE_URI",
+                                       "").split(":")[0],
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters": {"users": users, "requests": requests,
+                           "policies": int(policies), "events": int(events)},
+            "scenarios": results}
+
+
+def measure_startup(config_name="production", config_file=None, rounds=5):
+    """
+    Measure the cold start of a worker. Each round runs a new Python process,
+    which imports and creates the application and answers a first
+    /validate/check request.
+
+    :param config_name: The config name like "production" or "testing"
+    :param config_file: The pi.cfg of the application
+    :param rounds: The number of started processes
+    :return: dict with the median duration of the phases in milliseconds,
+        the number of imported modules and the imported token modules
+    """
+    from privacyidea.app import ENV_KEY
+    env = dict(os.environ)
+    # The process must not read the configuration of the installation
+    env.pop(ENV_KEY, None)
+    runs = []
+    for _i in range(max(int(rounds), 1)):
+        output = subprocess.check_output([sys.executable, "-c",
+                                          STARTUP_SCRIPT, config_name,
+                                          config_file or ""], env=env)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    results = {}
+    for phase in STARTUP_PHASES:
+        results[phase + "_ms"] = percentile(
+            sorted(run[phase] * 1000 for run in runs), 50)
+    results["modules"] = runs[-1]["modules"]
+    results["token_modules"] = runs[-1]["token_modules"]
+    results["rounds"] = len(runs)
+    return results
+
+
+def compare_results(old, new, threshold=10):
+    """
+    Compare two benchmark results.
+
+    :param old: The results of the reference run
+    :param new: The results of the current run
+    :param threshold: The change of the throughput or the p95 latency in
+        percent, that is regarded as regression
+    :return: list of dicts with the scenario, the changes in percent and
+        whether this is a regression
+    """
+    comparison = []
+    for name in sorted(new.get("scenarios", {})):
+        if name not in old.get("scenarios", {}):
+            continue
+        o = old["scenarios"][name]
+        n = new["scenarios"][name]
+        throughput = _change(o["throughput"], n["throughput"])
+        p95 = _change(o["latency_ms"]["p95"], n["latency_ms"]["p95"])
+        comparison.append({"scenario": name,
+                           "throughput_change": throughput,
+                           "p95_change": p95,
+                           "regression": throughput < -threshold or
+                           p95 > threshold})
+    return comparison
+
+
+def _change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) * 100.0 / old
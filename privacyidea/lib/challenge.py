@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 #  privacyIDEA is a fork of LinOTP
 #
+#  2018-11-14 Rate limited cleanup of the expired challenges and
+#             chunked cleanup for the periodic task
 #  2014-12-07 Cornelius Kölbel <cornelius@privacyidea.org>
 #
 #  Copyright (C) 2014 Cornelius Kölbel
@@ -27,11 +29,18 @@ The method is tested in test_lib_challenges
 """
 
 import logging
+import time
 from .log import log_with
-from ..models import Challenge
+from .framework import get_app_local_store, get_app_config_value
+from .sqlutils import delete_matching_rows
+from ..models import Challenge, db
 from datetime import datetime
 log = logging.getLogger(__name__)
 
+#: Default number of seconds between two cleanups of the expired challenges
+#: during the authentication requests.
+DEFAULT_CLEANUP_INTERVAL = 60
+
 
 @log_with(log)
 def get_challenges(serial=None, transaction_id=None):
@@ -145,3 +154,44 @@ def _create_challenge_query(serial=None, transaction_id=None):
             sql_query = sql_query.filter(Challenge.transaction_id == transaction_id)
 
     return sql_query
+
+
+def cleanup_expired_challenges(chunksize=None):
+    """
+    Delete all challenges, that have expired.
+
+    :param chunksize: If given, the challenges are deleted in chunks of this
+        size and the transaction is committed after each chunk.
+    :type chunksize: int or None
+    :return: The number of deleted challenges
+    """
+    return delete_matching_rows(db.session, Challenge.__table__,
+                                Challenge.expiration < datetime.now(),
+                                chunksize)
+
+
+def cleanup_expired_challenges_limited():
+    """
+    Delete the expired challenges, but only if the last cleanup of this
+    process was at least ``PI_CHALLENGE_CLEANUP_INTERVAL`` seconds ago.
+    This is called during the authentication requests, so that not every
+    request has to delete from the challenge table.
+
+    A negative interval disables the cleanup during the requests. In this
+    case the expired challenges need to be deleted by the periodic task
+    ``ChallengeCleanup``.
+
+    :return: The number of deleted challenges or None, if the cleanup was
+        skipped.
+    """
+    interval = float(get_app_config_value("PI_CHALLENGE_CLEANUP_INTERVAL",
+                                          DEFAULT_CLEANUP_INTERVAL))
+    if interval < 0:
+        return None
+    store = get_app_local_store()
+    now = time.time()
+    last_cleanup = store.get("challenge_cleanup")
+    if last_cleanup is not None and now - last_cleanup < interval:
+        return None
+    store["challenge_cleanup"] = now
+    return cleanup_expired_challenges()
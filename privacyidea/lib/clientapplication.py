@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-15 Collect the sightings of the clients in the process and
+#             write them to the database periodically
 #  2016-08-30 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Save client application information for authentication requests
 #
@@ -22,24 +24,177 @@
 __doc__ = """Save and list client application information.
 Client Application information was saved during authentication requests.
 
+The authentication requests only record the sighting of a client in the
+process. A thread of the process writes the latest sighting of each client
+to the database every ``PI_CLIENTAPPLICATION_FLUSH_INTERVAL`` seconds
+(default 60) in one transaction. If the thread can not run, the next request
+after the interval writes them. The pending sightings are also written, when
+the process exits. If the interval is 0, each sighting is written
+immediately.
+
 The code is tested in tests/test_lib_clientapplication.py.
 """
 
+import atexit
 import logging
 import datetime
+import os
+import threading
+import time
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
 from .log import log_with
-from ..models import ClientApplication, Subscription
+from .framework import get_app_local_store, get_app_config_value
+from ..models import ClientApplication, Subscription, db
 from netaddr import IPAddress
 
 
 log = logging.getLogger(__name__)
 
+DEFAULT_FLUSH_INTERVAL = 60
+
+# The buffers, whose sightings are written, when the process exits
+_buffers = set()
+
+
+class ClientApplicationBuffer(object):
+    """
+    Collects the latest sighting of each (ip, clienttype) of this process,
+    which are written to the database later by a thread of the process.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._sightings = {}
+        self.last_flush = time.time()
+        self.flush_pid = None
+
+    def add(self, ip, clienttype, lastseen):
+        with self._lock:
+            self._sightings[(ip, clienttype)] = lastseen
+            if self.flush_pid != os.getpid():
+                # The thread of the parent process does not run after a fork
+                self.flush_pid = os.getpid()
+                thread = threading.Thread(target=self._flush_periodically)
+                thread.daemon = True
+                thread.start()
+                _buffers.add(self)
+
+    def pop(self):
+        """
+        Remove and return the pending sightings.
+
+        :return: dict of (ip, clienttype) and the time of the last sighting
+        """
+        with self._lock:
+            sightings = self._sightings
+            self._sightings = {}
+            self.last_flush = time.time()
+        return sightings
+
+    def flush(self):
+        """
+        Write the pending sightings within an application context.
+        """
+        try:
+            with self.app.app_context():
+                flush_clientapplications()
+        except Exception as exx:  # pragma: no cover
+            log.warning(u"Could not write the client applications: "
+                        u"{0!r}".format(exx))
+
+    def _flush_periodically(self):
+        while True:
+            interval = int(self.app.config.get(
+                "PI_CLIENTAPPLICATION_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL))
+            if interval <= 0:
+                # The sightings are written immediately now
+                with self._lock:
+                    self.flush_pid = None
+                self.flush()
+                return
+            # Check every second, so that a changed interval is used soon
+            time.sleep(min(interval, 1))
+            if time.time() - self.last_flush >= interval:
+                self.flush()
+
+
+def _get_buffer():
+    store = get_app_local_store()
+    client_buffer = store.get("clientapplication_buffer")
+    if client_buffer is None:
+        client_buffer = store.setdefault(
+            "clientapplication_buffer",
+            ClientApplicationBuffer(current_app._get_current_object()))
+    return client_buffer
+
+
+@atexit.register
+def flush_clientapplications_at_exit():
+    """
+    Write the pending sightings of this process, when the process exits.
+    """
+    for client_buffer in list(_buffers):
+        if client_buffer.flush_pid == os.getpid():
+            client_buffer.flush()
+
+
+def _write_sightings(sightings):
+    """
+    Update the lastseen of the existing clients and insert the new clients
+    in one transaction.
+
+    :param sightings: dict of (ip, clienttype) and lastseen
+    """
+    ips = set([ip for ip, _clienttype in sightings])
+    existing = {}
+    for row in db.session.query(ClientApplication.id, ClientApplication.ip,
+                                ClientApplication.clienttype).filter(
+            ClientApplication.ip.in_(ips)):
+        existing[(row.ip, row.clienttype)] = row.id
+    updates = []
+    inserts = []
+    for (ip, clienttype), lastseen in sightings.items():
+        if (ip, clienttype) in existing:
+            updates.append({"id": existing[(ip, clienttype)],
+                            "lastseen": lastseen})
+        else:
+            inserts.append({"ip": ip, "clienttype": clienttype,
+                            "lastseen": lastseen})
+    if updates:
+        db.session.bulk_update_mappings(ClientApplication, updates)
+    if inserts:
+        db.session.bulk_insert_mappings(ClientApplication, inserts)
+    db.session.commit()
+
+
+def flush_clientapplications():
+    """
+    Write the sightings of the clients, that were collected in this process,
+    to the database.
+    """
+    sightings = _get_buffer().pop()
+    if sightings:
+        try:
+            _write_sightings(sightings)
+        except IntegrityError:
+            # A concurrent process inserted one of the new clients.
+            # Write the sightings one by one.
+            db.session.rollback()
+            for (ip, clienttype), lastseen in sightings.items():
+                ClientApplication(ip=ip, clienttype=clienttype,
+                                  lastseen=lastseen).save()
+
 
 @log_with(log)
 def save_clientapplication(ip, clienttype):
     """
     Save (or update) the IP and the clienttype to the database table.
 
+    Unless ``PI_CLIENTAPPLICATION_FLUSH_INTERVAL`` is 0, the client is only
+    recorded in the process and None is returned.
+
     :param ip: The IP address of the requesting client.
     :type ip: well formatted string or IPAddress
     :param clienttype: The type of the client
@@ -48,6 +203,15 @@ def save_clientapplication(ip, clienttype):
     """
     # Check for a valid IP address
     ip = IPAddress(ip)
+    flush_interval = int(get_app_config_value(
+        "PI_CLIENTAPPLICATION_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL))
+    if flush_interval:
+        client_buffer = _get_buffer()
+        client_buffer.add(u"{0!s}".format(ip), clienttype,
+                          datetime.datetime.now())
+        if time.time() - client_buffer.last_flush >= flush_interval:
+            flush_clientapplications()
+        return None
     # TODO: resolve hostname
     id = ClientApplication(ip="{0!s}".format(ip),
                            clienttype=clienttype).save()
@@ -70,6 +234,7 @@ def get_clientapplication(ip=None, clienttype=None, group_by="clienttype"):
      "SAML": [ { <client2> } ]
     }
     """
+    flush_clientapplications()
     clients = {}
     sql_query = ClientApplication.query
     if ip:
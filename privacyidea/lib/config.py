@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Build the registries of the token and resolver types once
+#  2018-11-20 Import the token and resolver modules on first use
 #  2016-04-08 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Avoid consecutive if-statements
 #  2015-12-12 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -45,7 +47,7 @@ from .crypto import encryptPassword
 from .crypto import decryptPassword
 from .resolvers.UserIdResolver import UserIdResolver
 from .machines.base import BaseMachineResolver
-from .caconnectors.localca import BaseCAConnector
+from .caconnectors.baseca import BaseCAConnector
 from .utils import reload_db, is_true
 import importlib
 import datetime
@@ -60,6 +62,57 @@ this = sys.modules[__name__]
 
 this.config = {}
 
+#: The modules of the token types. The module of a token type is only
+#: imported, when the token type is used.
+TOKEN_MODULES = {
+    "4eyes": "privacyidea.lib.tokens.foureyestoken",
+    "certificate": "privacyidea.lib.tokens.certificatetoken",
+    "daplug": "privacyidea.lib.tokens.daplugtoken",
+    "email": "privacyidea.lib.tokens.emailtoken",
+    "hotp": "privacyidea.lib.tokens.hotptoken",
+    "motp": "privacyidea.lib.tokens.motptoken",
+    "ocra": "privacyidea.lib.tokens.ocratoken",
+    "paper": "privacyidea.lib.tokens.papertoken",
+    "pw": "privacyidea.lib.tokens.passwordtoken",
+    "question": "privacyidea.lib.tokens.questionnairetoken",
+    "radius": "privacyidea.lib.tokens.radiustoken",
+    "registration": "privacyidea.lib.tokens.registrationtoken",
+    "remote": "privacyidea.lib.tokens.remotetoken",
+    "sms": "privacyidea.lib.tokens.smstoken",
+    "spass": "privacyidea.lib.tokens.spasstoken",
+    "sshkey": "privacyidea.lib.tokens.sshkeytoken",
+    "tan": "privacyidea.lib.tokens.tantoken",
+    "tiqr": "privacyidea.lib.tokens.tiqrtoken",
+    "totp": "privacyidea.lib.tokens.totptoken",
+    "u2f": "privacyidea.lib.tokens.u2ftoken",
+    "vasco": "privacyidea.lib.tokens.vascotoken",
+    "yubico": "privacyidea.lib.tokens.yubicotoken",
+    "yubikey": "privacyidea.lib.tokens.yubikeytoken"}
+
+#: The modules of the resolver types
+RESOLVER_MODULES = {
+    "ldapresolver": "privacyidea.lib.resolvers.LDAPIdResolver",
+    "passwdresolver": "privacyidea.lib.resolvers.PasswdIdResolver",
+    "scimresolver": "privacyidea.lib.resolvers.SCIMIdResolver",
+    "sqlresolver": "privacyidea.lib.resolvers.SQLIdResolver",
+    "UserIdResolver": "privacyidea.lib.resolvers.UserIdResolver"}
+
+#: The modules of the machine resolver types
+MACHINE_RESOLVER_MODULES = {
+    "hosts": "privacyidea.lib.machines.hosts",
+    "ldap": "privacyidea.lib.machines.ldap"}
+
+#: Other names of token types
+TOKEN_TYPE_ALIASES = {"hmac": "hotp"}
+
+# The classes, prefixes and class infos of the types are determined once per
+# process and stored in this.config under these keys.
+TYPE_CACHE_KEYS = ["pi_token_class", "pi_token_classes", "pi_token_types",
+                   "pi_token_prefixes", "pi_token_class_info",
+                   "pi_enabled_token_types", "pi_resolver_class",
+                   "pi_resolver_classes", "pi_resolver_types",
+                   "pi_machine_resolver_class", "pi_machine_resolver_classes"]
+
 
 class Singleton(type):
     """
@@ -268,15 +321,12 @@ def get_from_config(key=None, default=None, role="admin", return_bool=False):
 def get_resolver_types():
     """
     Return a simple list of the type names of the resolvers.
+    The resolver modules are not imported.
+
     :return: array of resolvertypes like 'passwdresolver'
     :rtype: array
     """
-    if "pi_resolver_types" not in this.config:
-        (r_classes, r_types) = get_resolver_class_dict()
-        this.config["pi_resolver_classes"] = r_classes
-        this.config["pi_resolver_types"] = r_types
-
-    return list(this.config["pi_resolver_types"].values())
+    return sorted(RESOLVER_MODULES)
 
 
 def get_caconnector_types():
@@ -346,40 +396,205 @@ def get_token_class_dict():
     return tokenclass_dict, tokentype_dict
 
 
-#@cache.cached(key_prefix="classes")
+def _import_class(mod_name, is_class_of_type):
+    """
+    Import the module and return the class of the module, for which
+    is_class_of_type returns True.
+
+    :param mod_name: The name of the module
+    :param is_class_of_type: function, that checks a class of the module
+    :return: The class or None
+    """
+    try:
+        module = importlib.import_module(mod_name)
+    except Exception as exx:  # pragma: no cover
+        log.warning('unable to load module : {0!r} ({1!r})'.format(mod_name, exx))
+        return None
+    for name in dir(module):
+        obj = getattr(module, name)
+        # We must not process imported classes!
+        if inspect.isclass(obj) and obj.__module__ == module.__name__ \
+                and is_class_of_type(obj):
+            return obj
+    return None
+
+
+def _clear_type_caches():
+    for key in TYPE_CACHE_KEYS:
+        this.config.pop(key, None)
+
+
+def register_token_type(tokentype, mod_name):
+    """
+    Register the module of an additional token type. This is the hook for
+    token types, which are not part of privacyIDEA.
+
+    :param tokentype: The type like "mytoken"
+    :param mod_name: The name of the module, which contains the token class
+    """
+    TOKEN_MODULES[tokentype.lower()] = mod_name
+    _clear_type_caches()
+
+
+def register_resolver_type(resolvertype, mod_name):
+    """
+    Register the module of an additional resolver type.
+
+    :param resolvertype: The type like "myresolver"
+    :param mod_name: The name of the module, which contains the resolver class
+    """
+    RESOLVER_MODULES[resolvertype] = mod_name
+    _clear_type_caches()
+
+
+def register_machine_resolver_type(resolvertype, mod_name):
+    """
+    Register the module of an additional machine resolver type.
+
+    :param resolvertype: The type like "mymachines"
+    :param mod_name: The name of the module, which contains the machine
+        resolver class
+    """
+    MACHINE_RESOLVER_MODULES[resolvertype] = mod_name
+    _clear_type_caches()
+
+
+def _get_enabled_token_types():
+    """
+    Return the enabled token types as tuple and as frozenset. They are only
+    determined again, if ``PI_TOKEN_TYPES`` changes.
+    """
+    tokentypes = get_app_config_value("PI_TOKEN_TYPES")
+    cached = this.config.get("pi_enabled_token_types")
+    if cached is not None and cached[0] == tokentypes:
+        return cached[1], cached[2]
+    if not tokentypes:
+        enabled = sorted(TOKEN_MODULES)
+    else:
+        enabled = []
+        for tokentype in (tokentypes.split(",") if isinstance(
+                tokentypes, string_types) else tokentypes):
+            tokentype = tokentype.strip().lower()
+            if tokentype in TOKEN_MODULES:
+                enabled.append(tokentype)
+            elif tokentype:
+                log.warning("Unknown token type {0!r} in PI_TOKEN_TYPES".format(tokentype))
+    enabled = tuple(enabled)
+    this.config["pi_enabled_token_types"] = (tokentypes, enabled,
+                                             frozenset(enabled))
+    return enabled, frozenset(enabled)
+
+
+def get_enabled_token_types():
+    """
+    Return the token types, that are enabled with ``PI_TOKEN_TYPES`` in
+    pi.cfg. The modules of the other token types are never imported. By
+    default all token types are enabled.
+
+    :return: list of token types like "hotp"
+    """
+    return list(_get_enabled_token_types()[0])
+
+
 def get_token_class(tokentype):
     """
     This takes a token type like "hotp" and returns a class
     like <class privacidea.lib.tokens.hotptoken.HotpTokenClass>
+
+    Only the module of this token type is imported. The classes are
+    looked up in a dictionary, that is filled once per process.
+
     :return: The tokenclass for the given type
     :rtype: tokenclass
     """
-    if tokentype.lower() == "hmac":
-        tokentype = "hotp"
+    tokentype = tokentype.lower()
+    tokentype = TOKEN_TYPE_ALIASES.get(tokentype, tokentype)
+    if tokentype not in _get_enabled_token_types()[1]:
+        return None
+    token_classes = this.config.setdefault("pi_token_class", {})
+    if tokentype not in token_classes:
+        from .tokenclass import TokenClass
+        token_classes[tokentype] = _import_class(
+            TOKEN_MODULES[tokentype],
+            lambda obj: issubclass(obj, TokenClass) and
+            obj.get_class_type().lower() == tokentype)
+    return token_classes[tokentype]
+
+
+def get_token_class_info(tokentype, section=None):
+    """
+    Return the class info of the token type like
+    TokenClass.get_class_info. The class info is determined once per
+    process and language. It must not be changed.
+
+    :param tokentype: The type like "hotp"
+    :param section: The section of the class info like "policy"
+    :return: The class info or the section. An empty dict, if the token type
+        or the section does not exist.
+    """
+    from flask_babel import get_locale
+    key = (tokentype.lower(), u"{0!s}".format(get_locale()))
+    class_infos = this.config.setdefault("pi_token_class_info", {})
+    if key not in class_infos:
+        tokenclass = get_token_class(tokentype)
+        class_infos[key] = tokenclass.get_class_info() if tokenclass else {}
+    if section:
+        return class_infos[key].get(section, {})
+    return class_infos[key]
+
+
+def get_resolver_class_of_type(resolvertype):
+    """
+    Return the class of the resolver type like "ldapresolver". Only the
+    module of this resolver type is imported.
 
-    tokenclass = None
-    tokenclasses = get_token_classes()
-    for tclass in tokenclasses:
-        if tclass.get_class_type().lower() == tokentype.lower():
-            tokenclass = tclass
-            break
+    :return: The resolver class or None
+    """
+    resolver_classes = this.config.setdefault("pi_resolver_class", {})
+    if resolvertype in resolver_classes:
+        return resolver_classes[resolvertype]
+    mod_name = RESOLVER_MODULES.get(resolvertype)
+    if not mod_name:
+        return None
+    if resolvertype not in resolver_classes:
+        resolver_classes[resolvertype] = _import_class(
+            mod_name,
+            lambda obj: issubclass(obj, UserIdResolver) and
+            obj.getResolverClassType() == resolvertype)
+    return resolver_classes[resolvertype]
+
+
+def get_machine_resolver_class_of_type(resolvertype):
+    """
+    Return the class of the machine resolver type like "hosts". Only the
+    module of this machine resolver type is imported.
 
-    return tokenclass
+    :return: The machine resolver class or None
+    """
+    resolver_classes = this.config.setdefault("pi_machine_resolver_class", {})
+    if resolvertype in resolver_classes:
+        return resolver_classes[resolvertype]
+    mod_name = MACHINE_RESOLVER_MODULES.get(resolvertype)
+    if not mod_name:
+        return None
+    if resolvertype not in resolver_classes:
+        resolver_classes[resolvertype] = _import_class(
+            mod_name,
+            lambda obj: issubclass(obj, BaseMachineResolver) and
+            obj.type == resolvertype)
+    return resolver_classes[resolvertype]
 
 
 #@cache.cached(key_prefix="types")
 def get_token_types():
     """
-    Return a simple list of the type names of the tokens.
+    Return a simple list of the type names of the enabled tokens.
+    The token modules are not imported.
+
     :return: list of tokentypes like 'hotp', 'totp'...
     :rtype: list
     """
-    if "pi_token_types" not in this.config:
-        (t_classes, t_types) = get_token_class_dict()
-        this.config["pi_token_types"] = t_types
-        this.config["pi_token_classes"] = t_classes
-
-    return list(this.config["pi_token_types"].values())
+    return get_enabled_token_types()
 
 
 #@cache.cached(key_prefix="prefix")
@@ -395,14 +610,16 @@ def get_token_prefix(tokentype=None, default=None):
     :return: the prefix of the tokentype or the dict with all prefixes
     :rtype: string or dict
     """
-    prefix_dict = {}
-    for tokenclass in get_token_classes():
-        prefix_dict[tokenclass.get_class_type()] = tokenclass.get_class_prefix()
-
     if tokentype:
-        ret = prefix_dict.get(tokentype, default)
+        # Only import the module of this token type
+        tokenclass = get_token_class(tokentype)
+        ret = tokenclass.get_class_prefix() if tokenclass else default
     else:
-        ret = prefix_dict
+        if "pi_token_prefixes" not in this.config:
+            this.config["pi_token_prefixes"] = dict(
+                (tokenclass.get_class_type(), tokenclass.get_class_prefix())
+                for tokenclass in get_token_classes())
+        ret = dict(this.config["pi_token_prefixes"])
     return ret
 
 
@@ -436,6 +653,8 @@ def get_machine_resolver_class_dict():
 
     :return: tuple of two dicts
     """
+    if "pi_machine_resolver_classes" in this.config:
+        return this.config["pi_machine_resolver_classes"]
     resolverclass_dict = {}
     resolvertype_dict = {}
 
@@ -456,6 +675,8 @@ def get_machine_resolver_class_dict():
                     log.error("error constructing machine resolver "
                               "class_list: %r" % e)
 
+    this.config["pi_machine_resolver_classes"] = (resolverclass_dict,
+                                                  resolvertype_dict)
     return resolverclass_dict, resolvertype_dict
 
 
@@ -471,6 +692,8 @@ def get_caconnector_class_dict():
 
     :return: tuple of two dicts
     """
+    if "pi_caconnector_classes" in this.config:
+        return this.config["pi_caconnector_classes"]
     class_dict = {}
     type_dict = {}
 
@@ -491,6 +714,7 @@ def get_caconnector_class_dict():
                     log.error("error constructing CA connector "
                               "class_list: %r" % e)
 
+    this.config["pi_caconnector_classes"] = (class_dict, type_dict)
     return class_dict, type_dict
 
 
@@ -552,12 +776,7 @@ def get_resolver_list():
     :return: list of resolver names from the config file
     :rtype: set
     """
-    module_list = set()
-
-    module_list.add("privacyidea.lib.resolvers.PasswdIdResolver")
-    module_list.add("privacyidea.lib.resolvers.LDAPIdResolver")
-    module_list.add("privacyidea.lib.resolvers.SCIMIdResolver")
-    module_list.add("privacyidea.lib.resolvers.SQLIdResolver")
+    module_list = set(RESOLVER_MODULES.values())
 
     # Dynamic Resolver modules
     # TODO: Migration
@@ -601,38 +820,11 @@ def get_machine_resolver_class_list():
 #@cache.cached(key_prefix="token")
 def get_token_list():
     """
-    get the list of the tokens
+    get the list of the modules of the enabled token types
     :return: list of token names from the config file
     """
-    module_list = set()
-
-    # TODO: migrate the implementations and uncomment
-    module_list.add("privacyidea.lib.tokens.daplugtoken")
-    module_list.add("privacyidea.lib.tokens.hotptoken")
-    module_list.add("privacyidea.lib.tokens.motptoken")
-    module_list.add("privacyidea.lib.tokens.passwordtoken")
-    module_list.add("privacyidea.lib.tokens.remotetoken")
-    module_list.add("privacyidea.lib.tokens.spasstoken")
-    module_list.add("privacyidea.lib.tokens.sshkeytoken")
-    module_list.add("privacyidea.lib.tokens.totptoken")
-    module_list.add("privacyidea.lib.tokens.yubicotoken")
-    module_list.add("privacyidea.lib.tokens.yubikeytoken")
-    module_list.add("privacyidea.lib.tokens.radiustoken")
-    module_list.add("privacyidea.lib.tokens.smstoken")
-    module_list.add("privacyidea.lib.tokens.emailtoken")
-    module_list.add("privacyidea.lib.tokens.registrationtoken")
-    module_list.add("privacyidea.lib.tokens.certificatetoken")
-    module_list.add("privacyidea.lib.tokens.foureyestoken")
-    module_list.add("privacyidea.lib.tokens.tiqrtoken")
-    module_list.add("privacyidea.lib.tokens.ocratoken")
-    module_list.add("privacyidea.lib.tokens.u2ftoken")
-    module_list.add("privacyidea.lib.tokens.papertoken")
-    module_list.add("privacyidea.lib.tokens.questionnairetoken")
-    module_list.add("privacyidea.lib.tokens.vascotoken")
-    module_list.add("privacyidea.lib.tokens.tantoken")
-
-    #module_list.add(".tokens.tagespassworttoken")
-    #module_list.add(".tokens.vascotoken")
+    module_list = set(TOKEN_MODULES[tokentype] for tokentype in
+                      get_enabled_token_types())
 
     # Dynamic Resolver modules
     # TODO: Migration
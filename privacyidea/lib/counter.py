@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-05 Use atomic updates, support sharded counters and an
+#             in-process accumulator of counter increments
 #  2018-26-09 Paul Lettich <paul.lettich@netknights.it>
 #             Add decrease/reset functions
 #  2018-03-01 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -22,8 +24,111 @@
 #
 """
 This module is used to modify counters in the database
+
+The counter values are changed by atomic UPDATE statements.
+The behaviour can be tuned in pi.cfg:
+
+``PI_COUNTER_SHARDS`` splits each counter into the given number of rows.
+Increments are spread randomly over the rows and the rows are summed up when
+the counter is read.
+
+``PI_COUNTER_FLUSH_INTERVAL`` collects increments in the process for the
+given number of seconds and writes them to the database in one statement per
+counter.
 """
-from privacyidea.models import EventCounter
+import logging
+import random
+import time
+from threading import Lock
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from privacyidea.models import EventCounter, db
+from privacyidea.lib.framework import (get_app_local_store,
+                                       get_app_config_value)
+
+log = logging.getLogger(__name__)
+
+
+class CounterAccumulator(object):
+    """
+    Collects counter increments of this process, which are written to the
+    database later.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._deltas = {}
+        self.last_flush = time.time()
+
+    def add(self, counter_name, value=1):
+        with self._lock:
+            self._deltas[counter_name] = self._deltas.get(counter_name, 0) + value
+
+    def pop(self, counter_name=None):
+        """
+        Remove and return the pending increments.
+
+        :param counter_name: Only return the increments of this counter
+        :return: dict of counter names and increments
+        """
+        with self._lock:
+            if counter_name is None:
+                deltas = self._deltas
+                self._deltas = {}
+                self.last_flush = time.time()
+            else:
+                deltas = {}
+                if counter_name in self._deltas:
+                    deltas[counter_name] = self._deltas.pop(counter_name)
+        return deltas
+
+
+def _get_accumulator():
+    store = get_app_local_store()
+    accumulator = store.get("counter_accumulator")
+    if accumulator is None:
+        accumulator = store.setdefault("counter_accumulator",
+                                       CounterAccumulator())
+    return accumulator
+
+
+def _get_counter(counter_name, shard=0):
+    """
+    Return the counter row of the given shard. The row is created, if it does
+    not exist yet.
+    """
+    counter = EventCounter.query.filter_by(counter_name=counter_name,
+                                           shard=shard).first()
+    if not counter:
+        try:
+            counter = EventCounter(counter_name, 0, shard=shard)
+        except IntegrityError:
+            # The row was created by a concurrent process
+            db.session.rollback()
+            counter = EventCounter.query.filter_by(counter_name=counter_name,
+                                                   shard=shard).first()
+    return counter
+
+
+def _add(counter_name, value):
+    shards = int(get_app_config_value("PI_COUNTER_SHARDS", 1))
+    shard = random.randrange(shards) if shards > 1 else 0
+    _get_counter(counter_name, shard).increase(value)
+
+
+def flush_counters(counter_name=None):
+    """
+    Write the increments, that were collected in this process, to the
+    database.
+
+    :param counter_name: Only write the increments of this counter
+    :return:
+    """
+    for name, value in _get_accumulator().pop(counter_name).items():
+        if value:
+            _add(name, value)
 
 
 def increase(counter_name):
@@ -31,15 +136,21 @@ def increase(counter_name):
     Increase the counter value in the database.
     If the counter does not exist yet, create the counter.
 
+    If ``PI_COUNTER_FLUSH_INTERVAL`` is set, the increment is only collected
+    in the process and None is returned.
+
     :param counter_name: The name/identifier of the counter
     :return: the new integer value of the counter
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
-        counter = EventCounter(counter_name, 0)
-        counter.save()
-    counter.increase()
-    return counter.counter_value
+    flush_interval = int(get_app_config_value("PI_COUNTER_FLUSH_INTERVAL", 0))
+    if flush_interval:
+        accumulator = _get_accumulator()
+        accumulator.add(counter_name)
+        if time.time() - accumulator.last_flush >= flush_interval:
+            flush_counters()
+        return None
+    _add(counter_name, 1)
+    return read(counter_name)
 
 
 def decrease(counter_name, allow_negative=False):
@@ -52,12 +163,15 @@ def decrease(counter_name, allow_negative=False):
     :param allow_negative: Whether the counter can become negative
     :return: the new integer value of the counter
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
-        counter = EventCounter(counter_name, 0)
-        counter.save()
-    counter.decrease(allow_negative)
-    return counter.counter_value
+    flush_counters(counter_name)
+    counters = EventCounter.query.filter_by(counter_name=counter_name).order_by(
+        EventCounter.counter_value.desc()).all() or [_get_counter(counter_name)]
+    # Decrease the shard with the highest value. If no shard is positive
+    # and the counter must not become negative, all shards are set to zero.
+    for counter in counters:
+        if counter.decrease(allow_negative):
+            break
+    return read(counter_name)
 
 
 def reset(counter_name):
@@ -67,11 +181,36 @@ def reset(counter_name):
     :param counter_name: The name/identifier of the counter
     :return:
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
-        counter = EventCounter(counter_name, 0)
-        counter.save()
-    counter.reset()
+    _get_accumulator().pop(counter_name)
+    _get_counter(counter_name)
+    EventCounter.query.filter_by(counter_name=counter_name).update(
+        {"counter_value": 0}, synchronize_session=False)
+    db.session.commit()
+
+
+def read_and_reset(counter_name):
+    """
+    Read the counter value and subtract the read value from the counter.
+    Contrary to a read and a reset, increments that happen between reading
+    and resetting are not lost.
+
+    :param counter_name: The name of the counter
+    :return: The value of the counter before it was reset
+    """
+    flush_counters(counter_name)
+    counters = EventCounter.query.filter_by(counter_name=counter_name).all()
+    if not counters:
+        return None
+    value = 0
+    for counter in counters:
+        shard_value = counter.counter_value
+        if shard_value:
+            value += shard_value
+            EventCounter.query.filter_by(id=counter.id).update(
+                {"counter_value": EventCounter.counter_value - shard_value},
+                synchronize_session=False)
+    db.session.commit()
+    return value
 
 
 def read(counter_name):
@@ -82,8 +221,10 @@ def read(counter_name):
     :param counter_name: The name of the counter
     :return: The value of the counter
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
+    flush_counters(counter_name)
+    value = db.session.query(func.sum(EventCounter.counter_value)).filter(
+        EventCounter.counter_name == counter_name).scalar()
+    if value is None:
         return None
-    else:
-        return counter.counter_value
\ No newline at end of file
+    # Some databases return the sum as a decimal
+    return int(value)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Import the event handler modules on first use
 #  2018-08-03 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Allow Pre-Handling events
 #  2016-05-04 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -26,12 +27,28 @@ from privacyidea.lib.utils import fetch_one_resource
 from privacyidea.models import EventHandler, EventHandlerOption, db
 from privacyidea.lib.error import ParameterError
 from privacyidea.lib.audit import getAudit
+from privacyidea.lib.timing import span
 import functools
+import importlib
 import logging
 log = logging.getLogger(__name__)
 
 AVAILABLE_EVENTS = []
 
+#: The modules and classes of the event handlers. The module of a handler is
+#: only imported, when the handler is used.
+HANDLER_CLASSES = {
+    "UserNotification": ("privacyidea.lib.eventhandler.usernotification",
+                         "UserNotificationEventHandler"),
+    "Token": ("privacyidea.lib.eventhandler.tokenhandler",
+              "TokenEventHandler"),
+    "Script": ("privacyidea.lib.eventhandler.scripthandler",
+               "ScriptEventHandler"),
+    "Federation": ("privacyidea.lib.eventhandler.federationhandler",
+                   "FederationEventHandler"),
+    "Counter": ("privacyidea.lib.eventhandler.counterhandler",
+                "CounterEventHandler")}
+
 
 class event(object):
     """
@@ -67,34 +84,35 @@ class event(object):
                                               eventDef=e_handler_def))
                 event_handler_name = e_handler_def.get("handlermodule")
                 event_handler = get_handler_object(event_handler_name)
-                # The "action is determined by the event configuration
-                # In the options we can pass the mailserver configuration
-                options = {"request": self.request,
-                           "g": self.g,
-                           "handler_def": e_handler_def}
-                if event_handler.check_condition(options=options):
-                    log.debug(u"Pre-Handling event {eventname} with options"
-                              u"{options}".format(eventname=self.eventname,
-                                                  options=options))
-                    # create a new audit object for this action
-                    event_audit = getAudit(self.g.audit_object.config)
-                    # copy all values from the original audit entry
-                    event_audit_data = dict(self.g.audit_object.audit_data)
-                    event_audit_data["action"] = "PRE-EVENT {trigger}>>" \
-                                                 "{handler}:{action}".format(
-                        trigger=self.eventname,
-                        handler=e_handler_def.get("handlermodule"),
-                        action=e_handler_def.get("action"))
-                    event_audit_data["action_detail"] = "{0!s}".format(
-                        e_handler_def.get("options"))
-                    event_audit_data["info"] = e_handler_def.get("name")
-                    event_audit.log(event_audit_data)
-
-                    event_handler.do(e_handler_def.get("action"),
-                                     options=options)
-                    # set audit object to success
-                    event_audit.log({"success": True})
-                    event_audit.finalize_log()
+                with span(u"event.{0!s}".format(event_handler_name)):
+                    # The "action is determined by the event configuration
+                    # In the options we can pass the mailserver configuration
+                    options = {"request": self.request,
+                               "g": self.g,
+                               "handler_def": e_handler_def}
+                    if event_handler.check_condition(options=options):
+                        log.debug(u"Pre-Handling event {eventname} with options"
+                                  u"{options}".format(eventname=self.eventname,
+                                                      options=options))
+                        # create a new audit object for this action
+                        event_audit = getAudit(self.g.audit_object.config)
+                        # copy all values from the original audit entry
+                        event_audit_data = dict(self.g.audit_object.audit_data)
+                        event_audit_data["action"] = "PRE-EVENT {trigger}>>" \
+                                                     "{handler}:{action}".format(
+                            trigger=self.eventname,
+                            handler=e_handler_def.get("handlermodule"),
+                            action=e_handler_def.get("action"))
+                        event_audit_data["action_detail"] = "{0!s}".format(
+                            e_handler_def.get("options"))
+                        event_audit_data["info"] = e_handler_def.get("name")
+                        event_audit.log(event_audit_data)
+
+                        event_handler.do(e_handler_def.get("action"),
+                                         options=options)
+                        # set audit object to success
+                        event_audit.log({"success": True})
+                        event_audit.finalize_log()
 
             f_result = func(*args, **kwds)
 
@@ -106,37 +124,38 @@ class event(object):
                                               eventDef=e_handler_def))
                 event_handler_name = e_handler_def.get("handlermodule")
                 event_handler = get_handler_object(event_handler_name)
-                # The "action is determined by the event configuration
-                # In the options we can pass the mailserver configuration
-                options = {"request": self.request,
-                           "g": self.g,
-                           "response": f_result,
-                           "handler_def": e_handler_def}
-                if event_handler.check_condition(options=options):
-                    log.debug(u"Post-Handling event {eventname} with options"
-                              u"{options}".format(eventname=self.eventname,
-                                                 options=options))
-                    # create a new audit object
-                    event_audit = getAudit(self.g.audit_object.config)
-                    # copy all values from the original audit entry
-                    event_audit_data = dict(self.g.audit_object.audit_data)
-                    event_audit_data["action"] = "POST-EVENT {trigger}>>" \
-                                                 "{handler}:{action}".format(
-                            trigger=self.eventname,
-                            handler=e_handler_def.get("handlermodule"),
-                            action=e_handler_def.get("action"))
-                    event_audit_data["action_detail"] = "{0!s}".format(
-                        e_handler_def.get("options"))
-                    event_audit_data["info"] = e_handler_def.get("name")
-                    event_audit.log(event_audit_data)
-
-                    event_handler.do(e_handler_def.get("action"),
-                                     options=options)
-                    # In case the handler has modified the response
-                    f_result = options.get("response")
-                    # set audit object to success
-                    event_audit.log({"success": True})
-                    event_audit.finalize_log()
+                with span(u"event.{0!s}".format(event_handler_name)):
+                    # The "action is determined by the event configuration
+                    # In the options we can pass the mailserver configuration
+                    options = {"request": self.request,
+                               "g": self.g,
+                               "response": f_result,
+                               "handler_def": e_handler_def}
+                    if event_handler.check_condition(options=options):
+                        log.debug(u"Post-Handling event {eventname} with options"
+                                  u"{options}".format(eventname=self.eventname,
+                                                     options=options))
+                        # create a new audit object
+                        event_audit = getAudit(self.g.audit_object.config)
+                        # copy all values from the original audit entry
+                        event_audit_data = dict(self.g.audit_object.audit_data)
+                        event_audit_data["action"] = "POST-EVENT {trigger}>>" \
+                                                     "{handler}:{action}".format(
+                                trigger=self.eventname,
+                                handler=e_handler_def.get("handlermodule"),
+                                action=e_handler_def.get("action"))
+                        event_audit_data["action_detail"] = "{0!s}".format(
+                            e_handler_def.get("options"))
+                        event_audit_data["info"] = e_handler_def.get("name")
+                        event_audit.log(event_audit_data)
+
+                        event_handler.do(e_handler_def.get("action"),
+                                         options=options)
+                        # In case the handler has modified the response
+                        f_result = options.get("response")
+                        # set audit object to success
+                        event_audit.log({"success": True})
+                        event_audit.finalize_log()
 
             return f_result
 
@@ -151,25 +170,11 @@ def get_handler_object(handlername):
     :type hanldername: basestring
     :return:
     """
-    # TODO: beautify and make this work with several different handlers
-    from privacyidea.lib.eventhandler.usernotification import \
-        UserNotificationEventHandler
-    from privacyidea.lib.eventhandler.tokenhandler import TokenEventHandler
-    from privacyidea.lib.eventhandler.scripthandler import ScriptEventHandler
-    from privacyidea.lib.eventhandler.federationhandler import \
-        FederationEventHandler
-    from privacyidea.lib.eventhandler.counterhandler import CounterEventHandler
     h_obj = None
-    if handlername == "UserNotification":
-        h_obj = UserNotificationEventHandler()
-    if handlername == "Token":
-        h_obj = TokenEventHandler()
-    if handlername == "Script":
-        h_obj = ScriptEventHandler()
-    if handlername == "Federation":
-        h_obj = FederationEventHandler()
-    if handlername == "Counter":
-        h_obj = CounterEventHandler()
+    if handlername in HANDLER_CLASSES:
+        # Only the module of this handler is imported
+        mod_name, class_name = HANDLER_CLASSES[handlername]
+        h_obj = getattr(importlib.import_module(mod_name), class_name)()
     return h_obj
 
 
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Parse the XML import files incrementally
+#             Write PSKC files incrementally
 #  2018-05-10 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add fileversion to OATH CSV
 #  2017-11-24 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -57,7 +59,6 @@ from privacyidea.lib.config import get_token_class
 from privacyidea.lib.log import log_with
 from privacyidea.lib.crypto import (aes_decrypt_b64, aes_encrypt_b64, geturandom)
 from Crypto.Cipher import AES
-from bs4 import BeautifulSoup
 import traceback
 from passlib.utils.pbkdf2 import pbkdf2
 from privacyidea.lib.utils import to_utf8
@@ -66,6 +67,9 @@ import gnupg
 import logging
 log = logging.getLogger(__name__)
 
+# The expat error code of a file, which ends before all elements are closed
+XML_ERROR_NO_ELEMENTS = 3
+
 
 def _create_static_password(key_hex):
     '''
@@ -325,6 +329,50 @@ def parseYubicoCSV(csv):
     return TOKENS
 
 
+def _parse_safenet_token(elem_token):
+    """
+    Parse the element "Token" of an Aladdin/SafeNet XML file.
+
+    :return: tuple of serial and token dictionary or None
+    """
+    SERIAL = elem_token.get("serial")
+    COUNTER = None
+    HMAC = None
+    DESCRIPTION = None
+    log.debug("Found token with serial {0!s}".format(SERIAL))
+    for elem_tdata in list(elem_token):
+        tag = getTagName(elem_tdata)
+        if "ProductName" == tag:
+            DESCRIPTION = elem_tdata.text
+            log.debug("The Token with the serial %s has the "
+                      "productname %s" % (SERIAL, DESCRIPTION))
+        if "Applications" == tag:
+            for elem_apps in elem_tdata:
+                if getTagName(elem_apps) == "Application":
+                    for elem_app in elem_apps:
+                        tag = getTagName(elem_app)
+                        if "Seed" == tag:
+                            HMAC = elem_app.text
+                        if "MovingFactor" == tag:
+                            COUNTER = elem_app.text
+    if not SERIAL:
+        log.error("Found token without a serial")
+    elif HMAC:
+        hashlib = "sha1"
+        if len(HMAC) == 64:
+            hashlib = "sha256"
+
+        return SERIAL, {'otpkey': HMAC,
+                        'counter': COUNTER,
+                        'type': 'hotp',
+                        'hashlib': hashlib
+                        }
+    else:
+        log.error("Found token {0!s} without a element 'Seed'".format(
+                  SERIAL))
+    return None
+
+
 @log_with(log)
 def parseSafeNetXML(xml):
     """
@@ -342,44 +390,10 @@ def parseSafeNetXML(xml):
         raise ImportException("No toplevel element Tokens")
 
     for elem_token in list(elem_tokencontainer):
-        SERIAL = None
-        COUNTER = None
-        HMAC = None
-        DESCRIPTION = None
         if getTagName(elem_token) == "Token":
-            SERIAL = elem_token.get("serial")
-            log.debug("Found token with serial {0!s}".format(SERIAL))
-            for elem_tdata in list(elem_token):
-                tag = getTagName(elem_tdata)
-                if "ProductName" == tag:
-                    DESCRIPTION = elem_tdata.text
-                    log.debug("The Token with the serial %s has the "
-                              "productname %s" % (SERIAL, DESCRIPTION))
-                if "Applications" == tag:
-                    for elem_apps in elem_tdata:
-                        if getTagName(elem_apps) == "Application":
-                            for elem_app in elem_apps:
-                                tag = getTagName(elem_app)
-                                if "Seed" == tag:
-                                    HMAC = elem_app.text
-                                if "MovingFactor" == tag:
-                                    COUNTER = elem_app.text
-            if not SERIAL:
-                log.error("Found token without a serial")
-            else:
-                if HMAC:
-                    hashlib = "sha1"
-                    if len(HMAC) == 64:
-                        hashlib = "sha256"
-
-                    TOKENS[SERIAL] = {'otpkey': HMAC,
-                                      'counter': COUNTER,
-                                      'type': 'hotp',
-                                      'hashlib': hashlib
-                                      }
-                else:
-                    log.error("Found token {0!s} without a element 'Seed'".format(
-                              SERIAL))
+            token = _parse_safenet_token(elem_token)
+            if token:
+                TOKENS[token[0]] = token[1]
 
     return TOKENS
 
@@ -420,15 +434,19 @@ def derive_key(xml, password):
                               "encryption key, but no password given!")
 
     keymeth= xml.keycontainer.encryptionkey.derivedkey.keyderivationmethod
-    derivation_algo = keymeth["algorithm"].split("#")[-1]
+    return _pbkdf2_key(password, keymeth["algorithm"],
+                       keymeth.find("salt").text,
+                       keymeth.find("keylength").text,
+                       keymeth.find("iterationcount").text)
+
+
+def _pbkdf2_key(password, algorithm, salt, keylength, rounds):
+    derivation_algo = algorithm.split("#")[-1]
     if derivation_algo.lower() != "pbkdf2":
         raise ImportException("We only support PBKDF2 as Key derivation "
                               "function!")
-    salt = keymeth.find("salt").text.strip()
-    keylength = keymeth.find("keylength").text.strip()
-    rounds = keymeth.find("iterationcount").text.strip()
-    r = pbkdf2(to_utf8(password), base64.b64decode(salt), int(rounds),
-               int(keylength))
+    r = pbkdf2(to_utf8(password), base64.b64decode(salt.strip()),
+               int(rounds.strip()), int(keylength.strip()))
     return binascii.hexlify(r)
 
 
@@ -455,6 +473,7 @@ def parsePSKCdata(xml_data,
         { serial : { otpkey , counter, .... }}
     """
 
+    from bs4 import BeautifulSoup
     tokens = {}
     #xml = BeautifulSoup(xml_data, "lxml")
     xml = strip_prefix_from_soup(BeautifulSoup(xml_data, "lxml"))
@@ -520,6 +539,255 @@ def parsePSKCdata(xml_data,
     return tokens
 
 
+class _SkipLeadingWhitespace(object):
+    """
+    File like object, which skips the whitespace before the XML declaration.
+    BeautifulSoup accepts it, but the XML parser does not.
+    """
+
+    def __init__(self, xml_file):
+        self._file = xml_file
+        self._start = True
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        while self._start and data:
+            data = data.lstrip()
+            if data:
+                self._start = False
+            else:
+                data = self._file.read(size)
+        return data
+
+
+def _iterparse(xml_file, events=None):
+    """
+    Parse the XML file incrementally. Other than BeautifulSoup the parser
+    requires a well-formed XML file. Only the missing end tag of the root
+    element at the end of the file is accepted. A file, which ends within
+    a token, is truncated and raises an ImportException.
+    """
+    events = events or ("end",)
+    depth = 0
+    try:
+        for event, elem in etree.iterparse(_SkipLeadingWhitespace(xml_file),
+                                           events=("start", "end")):
+            depth += 1 if event == "start" else -1
+            if event in events:
+                yield event, elem
+    except etree.ParseError as exx:
+        if exx.code == XML_ERROR_NO_ELEMENTS and depth == 1:
+            log.warning("The end tag of the root element is missing: "
+                        "{0!s}".format(exx))
+        elif exx.code == XML_ERROR_NO_ELEMENTS:
+            raise ImportException("The XML file is truncated: "
+                                  "{0!s}".format(exx))
+        else:
+            raise ImportException("Failed to parse the XML file: "
+                                  "{0!s}".format(exx))
+
+
+def _parse_checked(parse, token_file, **kwds):
+    """
+    Parse the whole file once and then return the tokens of a second pass.
+    Thus a broken file raises an ImportException, before the first token
+    is returned.
+    """
+    for _token in parse(token_file, **kwds):
+        pass
+    token_file.seek(0)
+    for token in parse(token_file, **kwds):
+        yield token
+
+
+def _local_name(elem):
+    return getTagName(elem).lower()
+
+
+def _find(elem, *names):
+    """
+    Find the first descendant of the element along the given tag names.
+    Like in BeautifulSoup the tag names are compared in lower case and without
+    the namespace.
+
+    :return: The element or None
+    """
+    for name in names:
+        if elem is None:
+            return None
+        elem = next((child for child in elem.iter()
+                     if child is not elem and _local_name(child) == name),
+                    None)
+    return elem
+
+
+def _get_attribute(elem, name):
+    if elem is not None:
+        for key, value in elem.attrib.items():
+            if re.sub("^{.*?}", "", key).lower() == name:
+                return value
+    return None
+
+
+def _get_text(elem):
+    if elem is None:
+        return None
+    return u"".join(elem.itertext()).strip()
+
+
+def _parse_key_package(key_package, preshared_key_hex):
+    """
+    Parse the element "KeyPackage" of a PSKC file like parsePSKCdata.
+
+    :return: tuple of serial and token dictionary
+    """
+    token = {}
+    key = _find(key_package, "key")
+    if key is None:
+        raise ImportException("Found a KeyPackage without a Key")
+    manufacturer = _find(key_package, "deviceinfo", "manufacturer")
+    if manufacturer is not None:
+        token["description"] = manufacturer.text
+    serial = _get_attribute(key, "id")
+    serialno = _find(key_package, "deviceinfo", "serialno")
+    if serialno is not None and serialno.text:
+        serial = serialno.text.strip()
+    token["type"] = (_get_attribute(key, "algorithm") or "").split(":")[-1].lower()
+    parameters = _find(key, "algorithmparameters")
+    token["otplen"] = _get_attribute(_find(parameters, "responseformat"),
+                                     "length") or 6
+    hashalgo = _get_attribute(_find(parameters, "suite"), "hashalgo")
+    if hashalgo is None:
+        log.warning("No compatible suite contained.")
+    else:
+        token["hashlib"] = hashalgo or "sha1"
+    data = _find(key, "data")
+    try:
+        secret = _find(data, "secret")
+        if secret is None:
+            raise ImportException("No secret contained.")
+        plainvalue = _find(secret, "plainvalue")
+        encryptedvalue = _find(secret, "encryptedvalue")
+        if plainvalue is not None:
+            token["otpkey"] = binascii.hexlify(base64.b64decode(
+                plainvalue.text))
+        elif encryptedvalue is not None:
+            encryptionmethod = _find(encryptedvalue, "encryptionmethod")
+            enc_algorithm = _get_attribute(encryptionmethod,
+                                           "algorithm").split("#")[-1]
+            if enc_algorithm.lower() != "aes128-cbc":
+                raise ImportException("We only import PSKC files with "
+                                      "AES128-CBC.")
+            enc_data = _get_text(_find(encryptedvalue, "ciphervalue"))
+            secret = aes_decrypt_b64(binascii.unhexlify(preshared_key_hex),
+                                     enc_data)
+            if token["type"] in ["hotp", "totp"]:
+                token["otpkey"] = binascii.hexlify(secret)
+            else:
+                token["otpkey"] = secret
+    except Exception as exx:
+        log.error("Failed to import tokendata: {0!s}".format(exx))
+        log.debug(traceback.format_exc())
+        raise ImportException("Failed to import tokendata. Wrong "
+                              "encryption key? %s" % exx)
+    counter = _find(data, "counter")
+    if token["type"] in ["hotp", "totp"] and counter is not None:
+        token["counter"] = _get_text(counter)
+    if token["type"] == "totp":
+        timeinterval = _find(data, "timeinterval")
+        if timeinterval is not None:
+            token["timeStep"] = _get_text(timeinterval)
+        timedrift = _find(data, "timedrift")
+        if timedrift is not None:
+            token["timeShift"] = _get_text(timedrift)
+    return serial, token
+
+
+def iterparsePSKCdata(xml_file, preshared_key_hex=None, password=None):
+    """
+    This function parses a PSKC file like parsePSKCdata, but it reads the
+    file incrementally and returns the tokens one after another. The parsed
+    key packages are removed from memory, so that also files with many
+    thousand tokens can be imported.
+
+    :param xml_file: The PSKC file
+    :type xml_file: file like object
+    :param preshared_key_hex: The preshared key, hexlified
+    :param password: The password that encrypted the keys
+    :return: generator of tuples (serial, token dictionary)
+    """
+    for _event, elem in _iterparse(xml_file):
+        name = _local_name(elem)
+        if name == "encryptionkey":
+            keymeth = _find(elem, "derivedkey", "keyderivationmethod")
+            if keymeth is not None:
+                if not password:
+                    raise ImportException("The XML KeyContainer specifies a "
+                                          "derived encryption key, but no "
+                                          "password given!")
+                preshared_key_hex = _pbkdf2_key(
+                    password, _get_attribute(keymeth, "algorithm"),
+                    _get_text(_find(keymeth, "salt")),
+                    _get_text(_find(keymeth, "keylength")),
+                    _get_text(_find(keymeth, "iterationcount")))
+        elif name == "keypackage":
+            yield _parse_key_package(elem, preshared_key_hex)
+            elem.clear()
+
+
+def iterparseSafeNetXML(xml_file):
+    """
+    This function parses an Aladdin/SafeNet XML file like parseSafeNetXML,
+    but it reads the file incrementally and returns the tokens one after
+    another.
+
+    :param xml_file: The XML file
+    :type xml_file: file like object
+    :return: generator of tuples (serial, token dictionary)
+    """
+    depth = 0
+    for event, elem in _iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if depth == 0 and getTagName(elem) != "Tokens":
+                raise ImportException("No toplevel element Tokens")
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and getTagName(elem) == "Token":
+            token = _parse_safenet_token(elem)
+            if token:
+                yield token
+            elem.clear()
+
+
+def iterparse_token_file(token_file, file_type, preshared_key_hex=None,
+                         password=None):
+    """
+    Return the tokens of an import file. The XML files are parsed
+    incrementally, the CSV files are parsed at once. The XML files are
+    checked completely, before the first token is returned.
+
+    :param token_file: The import file
+    :type token_file: file like object
+    :param file_type: The type of the file "aladdin-xml", "oathcsv",
+        "yubikeycsv" or "pskc"
+    :param preshared_key_hex: The preshared key of a PSKC file, hexlified
+    :param password: The password of a PSKC file
+    :return: iterable of tuples (serial, token dictionary)
+    """
+    if file_type == "aladdin-xml":
+        return _parse_checked(iterparseSafeNetXML, token_file)
+    elif file_type in ["oathcsv", "OATH CSV"]:
+        return parseOATHcsv(token_file.read()).items()
+    elif file_type in ["yubikeycsv", "Yubikey CSV"]:
+        return parseYubicoCSV(token_file.read()).items()
+    elif file_type == "pskc":
+        return _parse_checked(iterparsePSKCdata, token_file,
+                              preshared_key_hex=preshared_key_hex,
+                              password=password)
+    raise ImportException("Unknown file type {0!s}".format(file_type))
+
+
 class GPGImport(object):
     """
     This class is used to decrypt GPG encrypted import files.
@@ -570,27 +838,7 @@ class GPGImport(object):
         return decrypted.data
 
 
-def export_pskc(tokenobj_list, psk=None):
-    """
-    Take a list of token objects and create a beautifulsoup xml object.
-
-    If no preshared key is given, we create one and return it.
-
-    :param tokenobj_list: list of token objects
-    :param psk: pre-shared-key for AES-128-CBC in hex format
-    :return: tuple of (psk, number of tokens, beautifulsoup)
-    """
-    if psk:
-        psk = binascii.unhexlify(psk)
-    else:
-        psk = geturandom(16)
-
-    mackey = geturandom(20)
-    encrypted_mackey = aes_encrypt_b64(psk, mackey)
-    number_of_exported_tokens = 0
-
-    # define the header
-    soup = BeautifulSoup("""<KeyContainer Version="1.0"
+PSKC_HEADER = u"""<KeyContainer Version="1.0"
      xmlns="urn:ietf:params:xml:ns:keyprov:pskc"
      xmlns:ds="http://www.w3.org/2000/09/xmldsig#"
      xmlns:xenc="http://www.w3.org/2001/04/xmlenc#">
@@ -606,38 +854,9 @@ def export_pskc(tokenobj_list, psk=None):
              </xenc:CipherData>
          </MACKey>
      </MACMethod>
-""".format(encrypted_mackey=encrypted_mackey), "html.parser")
+"""
 
-    for tokenobj in tokenobj_list:
-        if tokenobj.type.lower() not in ["totp", "hotp", "pw"]:
-            continue
-        type = tokenobj.type.lower()
-        issuer = "privacyIDEA"
-        try:
-            manufacturer = tokenobj.token.description.encode("ascii")
-        except UnicodeEncodeError:
-            manufacturer = "deleted during export"
-        serial = tokenobj.token.serial
-        otplen = tokenobj.token.otplen
-        counter = tokenobj.token.count
-        suite = tokenobj.get_tokeninfo("hashlib", default="sha1")
-        if type == "totp":
-            timestep = tokenobj.get_tokeninfo("timeStep")
-            timedrift = tokenobj.get_tokeninfo("timeShift")
-        else:
-            timestep = 0
-            timedrift = 0
-        otpkey = tokenobj.token.get_otpkey().getKey()
-        try:
-            if tokenobj.type.lower() in ["totp", "hotp"]:
-                encrypted_otpkey = aes_encrypt_b64(psk, binascii.unhexlify(otpkey))
-            else:
-                encrypted_otpkey = aes_encrypt_b64(psk, otpkey)
-        except TypeError:
-            # Some keys might be odd string length
-            continue
-        try:
-            kp2 = BeautifulSoup("""<KeyPackage>
+PSKC_KEY_PACKAGE = u"""<KeyPackage>
         <DeviceInfo>
           <Manufacturer>{manufacturer}</Manufacturer>
           <SerialNo>{serial}</SerialNo>
@@ -673,15 +892,136 @@ def export_pskc(tokenobj_list, psk=None):
                     </TimeDrift>
                 </Data>
         </Key>
-        </KeyPackage>""".format(serial=cgi.escape(serial), type=cgi.escape(type), otplen=otplen,
-                                issuer=cgi.escape(issuer), manufacturer=cgi.escape(manufacturer),
-                                counter=counter, timestep=timestep, encrypted_otpkey=encrypted_otpkey,
-                                timedrift=timedrift,
-                                suite=cgi.escape(suite)), "html.parser")
-
-            soup.macmethod.insert_after(kp2)
-            number_of_exported_tokens += 1
+        </KeyPackage>
+"""
+
+PSKC_FOOTER = u"""</KeyContainer>
+"""
+
+
+class PSKCWriter(object):
+    """
+    Write the tokens to a PSKC file one after another, so that the
+    tokens do not need to be kept in memory.
+
+    If no preshared key is given, we create one.
+    """
+
+    def __init__(self, psk=None):
+        """
+        :param psk: pre-shared-key for AES-128-CBC in hex format
+        """
+        if psk:
+            self.psk = binascii.unhexlify(psk)
+        else:
+            self.psk = geturandom(16)
+        self.mackey = geturandom(20)
+        self.number_of_exported_tokens = 0
+
+    def get_psk(self):
+        """
+        :return: The pre-shared-key in hex format
+        """
+        return binascii.hexlify(self.psk)
+
+    def header(self):
+        encrypted_mackey = aes_encrypt_b64(self.psk, self.mackey)
+        return PSKC_HEADER.format(
+            encrypted_mackey=encrypted_mackey).encode("utf-8")
+
+    def footer(self):
+        return PSKC_FOOTER.encode("utf-8")
+
+    def key_package(self, tokenobj):
+        """
+        Return the KeyPackage of the token or None, if the token can not be
+        exported.
+
+        :return: The UTF-8 encoded KeyPackage
+        """
+        if tokenobj.type.lower() not in ["totp", "hotp", "pw"]:
+            return None
+        type = tokenobj.type.lower()
+        issuer = "privacyIDEA"
+        try:
+            manufacturer = (tokenobj.token.description or "").encode("ascii")
+        except UnicodeEncodeError:
+            manufacturer = "deleted during export"
+        serial = tokenobj.token.serial
+        otplen = tokenobj.token.otplen
+        counter = tokenobj.token.count
+        suite = tokenobj.get_tokeninfo("hashlib", default="sha1")
+        if type == "totp":
+            timestep = tokenobj.get_tokeninfo("timeStep")
+            timedrift = tokenobj.get_tokeninfo("timeShift")
+        else:
+            timestep = 0
+            timedrift = 0
+        otpkey = tokenobj.token.get_otpkey().getKey()
+        try:
+            if type in ["totp", "hotp"]:
+                encrypted_otpkey = aes_encrypt_b64(self.psk,
+                                                   binascii.unhexlify(otpkey))
+            else:
+                encrypted_otpkey = aes_encrypt_b64(self.psk, otpkey)
+        except TypeError:
+            # Some keys might be odd string length
+            return None
+        try:
+            key_package = PSKC_KEY_PACKAGE.format(
+                serial=cgi.escape(serial, quote=True),
+                type=cgi.escape(type, quote=True), otplen=otplen,
+                issuer=cgi.escape(issuer), manufacturer=cgi.escape(manufacturer),
+                counter=counter, timestep=timestep,
+                encrypted_otpkey=encrypted_otpkey, timedrift=timedrift,
+                suite=cgi.escape(suite, quote=True))
         except Exception as e:
             log.warning(u"Failed to export the token {0!s}: {1!s}".format(serial, e))
+            return None
+        self.number_of_exported_tokens += 1
+        return key_package.encode("utf-8")
 
-    return binascii.hexlify(psk), number_of_exported_tokens, soup
\ No newline at end of file
+    def generate(self, tokenobj_list):
+        """
+        Generate the PSKC file of the tokens piece by piece. The generator
+        can be written to a file or returned as a streamed HTTP response.
+
+        :param tokenobj_list: The token objects
+        :type tokenobj_list: iterable
+        """
+        yield self.header()
+        for tokenobj in tokenobj_list:
+            key_package = self.key_package(tokenobj)
+            if key_package:
+                yield key_package
+        yield self.footer()
+
+    def write(self, output, tokenobj_list):
+        """
+        Write the PSKC file of the tokens to a file object.
+
+        :return: The number of the exported tokens
+        """
+        for data in self.generate(tokenobj_list):
+            output.write(data)
+        return self.number_of_exported_tokens
+
+
+def export_pskc(tokenobj_list, psk=None):
+    """
+    Take a list of token objects and create a beautifulsoup xml object.
+
+    If no preshared key is given, we create one and return it.
+
+    To export many tokens use the PSKCWriter, which does not keep the
+    tokens in memory.
+
+    :param tokenobj_list: list of token objects
+    :param psk: pre-shared-key for AES-128-CBC in hex format
+    :return: tuple of (psk, number of tokens, beautifulsoup)
+    """
+    from bs4 import BeautifulSoup
+    writer = PSKCWriter(psk)
+    soup = BeautifulSoup(b"".join(writer.generate(tokenobj_list)),
+                         "html.parser")
+    return writer.get_psk(), writer.number_of_exported_tokens, soup
\ No newline at end of file
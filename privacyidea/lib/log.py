@@ -95,7 +95,7 @@ class log_with(object):
     
     def __init__(self, logger=None, log_entry=True, log_exit=True,
                  hide_args=None, hide_kwargs=None,
-                 hide_args_keywords=None):
+                 hide_args_keywords=None, span=None):
         """
         Write the parameters and the result of the function to the log.
 
@@ -113,6 +113,9 @@ class log_with(object):
         :param hide_args_keys: Hide the keywords in positional arguments,
             if the positional argument is a dict
         :type hide_args_keywords: dict
+        :param span: If given, the duration of the function is recorded as
+            a phase of the request with this name (see lib/timing.py)
+        :type span: basestring
         """
         self.logger = logger
         self.log_exit = log_exit
@@ -120,6 +123,7 @@ class log_with(object):
         self.hide_args = hide_args or []
         self.hide_kwargs = hide_kwargs or []
         self.hide_args_keywords = hide_args_keywords or {}
+        self.span = span
 
     def __call__(self, func):
         """
@@ -136,8 +140,12 @@ class log_with(object):
         #if not self.logger:
         #    logging.basicConfig()
         #    self.logger = logging.getLogger(func.__module__)
-            
-        @functools.wraps(func)
+        wrapped_func = func
+        if self.span:
+            from privacyidea.lib.timing import span
+            func = span(self.span)(func)
+
+        @functools.wraps(wrapped_func)
         def log_wrapper(*args, **kwds):
             """
             Wrap the function in log entries. The entry of the function and
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-19 Load the machine tokens of the auth items in bulk and
+#             cache the auth items
 #  2015-02-27 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Initial writup
 #
@@ -27,21 +29,103 @@ tests/test_lib_machines.py.
 It depends on the database model models.py and on the machineresolver
 lib/machineresolver.py, so this can be tested standalone without realms,
 tokens and webservice!
+
+The authentication items of applications like SSH can be cached for
+``PI_MACHINE_AUTHITEM_CACHE`` seconds (default 0, no caching). The cache is
+kept per process. It is cleared, if a token is attached to or detached from
+a machine, if machine token options change and if tokens are changed.
 """
+import copy
+import time
+from collections import OrderedDict
+from threading import Lock
+
 from .machineresolver import get_resolver_list, get_resolver_object
-from privacyidea.models import Token
+from privacyidea.models import Token, TokenRealm
 from privacyidea.models import (MachineToken, db, MachineTokenOptions,
                                 MachineResolver, get_token_id,
                                 get_machineresolver_id,
                                 get_machinetoken_id)
 from privacyidea.lib.utils import fetch_one_resource
 from netaddr import IPAddress
+from privacyidea.lib.framework import (get_app_local_store,
+                                       get_app_config_value)
 from sqlalchemy import and_
+from sqlalchemy.orm import subqueryload, joinedload
 import logging
 
 log = logging.getLogger(__name__)
 from privacyidea.lib.log import log_with
-from privacyidea.lib.applications.base import get_auth_item
+from privacyidea.lib.applications.base import (get_auth_item_list,
+                                               is_application_cache_auth_items)
+from privacyidea.lib.token import create_tokenclass_object
+
+#: The maximum number of cached responses of get_auth_items
+AUTHITEM_CACHE_SIZE = 1000
+
+
+class AuthItemCache(object):
+    """
+    Caches the responses of get_auth_items. Each entry is stored with the
+    generation of the cache. Invalidating the cache starts a new generation,
+    so that responses, which were read before, are not stored anymore.
+    """
+
+    def __init__(self, size=AUTHITEM_CACHE_SIZE):
+        self.size = size
+        self.generation = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, timeout):
+        """
+        Return a copy of the cached response or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            timestamp, auth_items = entry
+            if time.time() - timestamp >= timeout:
+                del self._entries[key]
+                return None
+            # Move the entry to the end of the LRU list
+            del self._entries[key]
+            self._entries[key] = entry
+        return copy.deepcopy(auth_items)
+
+    def set(self, key, auth_items, generation):
+        """
+        Store a response, which was read during the given generation.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), copy.deepcopy(auth_items))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+def _get_authitem_cache():
+    store = get_app_local_store()
+    cache = store.get("machine_authitem_cache")
+    if cache is None:
+        cache = store.setdefault("machine_authitem_cache", AuthItemCache())
+    return cache
+
+
+def invalidate_auth_items():
+    """
+    Clear the cached authentication items of all machines. This is called,
+    if machine tokens or tokens are changed.
+    """
+    _get_authitem_cache().invalidate()
 
 
 @log_with(log)
@@ -171,6 +255,7 @@ def attach_token(serial, application, hostname=None, machine_id=None,
     if options:
         add_option(machinetoken_id=machinetoken.id,
                    options=options)
+    invalidate_auth_items()
 
     return machinetoken
 
@@ -214,6 +299,7 @@ def detach_token(serial, application, hostname=None, machine_id=None,
                                        MachineToken.machineresolver_id == machineresolver_id,
                                        MachineToken.application == application)).delete()
     db.session.commit()
+    invalidate_auth_items()
     return r
 
 
@@ -244,6 +330,7 @@ def add_option(machinetoken_id=None, machine_id=None, resolver_name=None,
 
     for option_name, option_value in options.items():
         MachineTokenOptions(machinetoken_id, option_name, option_value)
+    invalidate_auth_items()
     return len(options)
 
 
@@ -274,6 +361,7 @@ def delete_option(machinetoken_id=None, machine_id=None, resolver_name=None,
         MachineTokenOptions.machinetoken_id == machinetoken_id,
         MachineTokenOptions.mt_key == key)).delete()
     db.session.commit()
+    invalidate_auth_items()
     return r
 
 
@@ -293,31 +381,53 @@ def list_machine_tokens(hostname=None,
     res = []
     machine_id, resolver_name = _get_host_identifier(hostname, machine_id,
                                                      resolver_name)
+    for row in _get_machinetoken_rows(machine_id, resolver_name,
+                                      serial=serial,
+                                      application=application):
+        res.append(_machinetoken_dict(row, machine_id, resolver_name))
+
+    return res
+
+
+def _get_machinetoken_rows(machine_id, resolver_name, serial=None,
+                           application=None, load_tokens=False):
+    """
+    Return the MachineToken rows of a machine with their options.
+
+    :param load_tokens: Also load the tokeninfo and the realms of the tokens
+    :return: list of MachineToken objects
+    """
     machineresolver_id = get_machineresolver_id(resolver_name)
 
     sql_query = MachineToken.query.filter(and_(MachineToken.machine_id ==
                                                machine_id,
                                                MachineToken.machineresolver_id == machineresolver_id))
+    sql_query = sql_query.options(subqueryload(MachineToken.option_list))
+    if load_tokens:
+        sql_query = sql_query.options(
+            joinedload(MachineToken.token).subqueryload(Token.info_list),
+            joinedload(MachineToken.token).subqueryload(
+                Token.realm_list).joinedload(TokenRealm.realm))
     if application:
         sql_query = sql_query.filter(MachineToken.application == application)
     if serial:
         token_id = get_token_id(serial)
         sql_query = sql_query.filter(MachineToken.token_id == token_id)
 
-    for row in sql_query.all():
-        # row.token contains the database token
-        option_list = row.option_list
-        options = {}
-        for option in option_list:
-            options[option.mt_key] = option.mt_value
-        res.append({"serial": row.token.serial,
-                    "machine_id": machine_id,
-                    "resolver": resolver_name,
-                    "type": row.token.tokentype,
-                    "application": row.application,
-                    "options": options})
+    return sql_query.all()
 
-    return res
+
+def _machinetoken_dict(row, machine_id, resolver_name):
+    # row.token contains the database token
+    options = {}
+    for option in row.option_list:
+        options[option.mt_key] = option.mt_value
+    return {"serial": row.token.serial,
+            "machine_id": machine_id,
+            "resolver": resolver_name,
+            "type": row.token.tokentype,
+            "application": row.application,
+            "options": options}
 
 
 @log_with(log)
@@ -417,28 +527,49 @@ def get_auth_items(hostname, ip=None, application=None,
     #
     # TODO: We should check, if the IP Address matches the hostname
     #
-    auth_items = {}
-    machinetokens = list_machine_tokens(hostname=hostname,
-                                        serial=serial,
-                                        application=application)
-
-    for mtoken in machinetokens:
-        auth_item = get_auth_item(mtoken.get("application"),
-                                  mtoken.get("type"),
-                                  mtoken.get("serial"),
-                                  challenge,
-                                  options=mtoken.get("options"),
-                                  filter_param=filter_param)
-        if auth_item:
-            if mtoken.get("application") not in auth_items:
-                # we create a new empty list for the new application type
-                auth_items[mtoken.get("application")] = []
-
-            # Add the options the the auth_item
-            for k, v in mtoken.get("options", {}).items():
-                auth_item[k] = v
-
-            # append the auth_item to the list
-            auth_items[mtoken.get("application")].append(auth_item)
+    cache_timeout = float(get_app_config_value("PI_MACHINE_AUTHITEM_CACHE",
+                                               0))
+    cache_key = None
+    if cache_timeout > 0 and challenge is None and \
+            is_application_cache_auth_items(application):
+        cache = _get_authitem_cache()
+        cache_key = (hostname, application, serial,
+                     tuple(sorted((filter_param or {}).items())))
+        auth_items = cache.get(cache_key, cache_timeout)
+        if auth_items is not None:
+            return auth_items
+        generation = cache.generation
 
+    auth_items = {}
+    machine_id, resolver_name = _get_host_identifier(hostname, None, None)
+    # The machine tokens, their options, the tokens and their tokeninfo are
+    # read with a constant number of queries
+    machinetokens = {}
+    for row in _get_machinetoken_rows(machine_id, resolver_name,
+                                      serial=serial,
+                                      application=application,
+                                      load_tokens=True):
+        mtoken = _machinetoken_dict(row, machine_id, resolver_name)
+        mtoken["token"] = create_tokenclass_object(row.token)
+        machinetokens.setdefault(mtoken.get("application"), []).append(mtoken)
+
+    for mtoken_application, mtokens in machinetokens.items():
+        auth_item_list = get_auth_item_list(mtoken_application, mtokens,
+                                            challenge=challenge,
+                                            filter_param=filter_param)
+        for mtoken, auth_item in zip(mtokens, auth_item_list):
+            if auth_item:
+                if mtoken_application not in auth_items:
+                    # we create a new empty list for the new application type
+                    auth_items[mtoken_application] = []
+
+                # Add the options the the auth_item
+                for k, v in mtoken.get("options", {}).items():
+                    auth_item[k] = v
+
+                # append the auth_item to the list
+                auth_items[mtoken_application].append(auth_item)
+
+    if cache_key:
+        cache.set(cache_key, auth_items, generation)
     return auth_items
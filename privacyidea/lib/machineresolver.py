@@ -39,7 +39,8 @@ from ..api.lib.utils import required
 from ..api.lib.utils import getParam
 from sqlalchemy import func
 from .crypto import encryptPassword, decryptPassword
-from privacyidea.lib.config import get_machine_resolver_class_dict
+from privacyidea.lib.config import (get_machine_resolver_class_dict,
+                                   get_machine_resolver_class_of_type)
 from privacyidea.lib.utils import (sanity_name_check, get_data_from_params, fetch_one_resource)
 
 
@@ -207,16 +208,8 @@ def get_resolver_class(resolver_type):
                           fully qualified or abbreviated
     :return: resolver object class
     """
-    ret = None
-    
-    (resolver_clazzes, resolver_types) = get_machine_resolver_class_dict()
-
-    if resolver_type in resolver_types.values():
-        for k, v in resolver_types.items():
-            if v == resolver_type:
-                ret = resolver_clazzes.get(k)
-                break
-    return ret
+    # Only the module of this machine resolver type is imported
+    return get_machine_resolver_class_of_type(resolver_type)
 
 
 @log_with(log)
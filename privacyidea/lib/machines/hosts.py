@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-19 Keep a parsed index of the hosts file in memory
 #  2016-04-08 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Avoid consecutive if-statements
 #  2015-02-25 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -23,6 +24,10 @@ __doc__ = """This contains the HostsMachineResolver which simply resolves
 the machines in a file like /etc/hosts.
 The machine id is the IP address in this case.
 
+The hosts file is parsed into an index, which is shared by all resolvers of
+the process. The file is only read again, if its modification time or size
+changed.
+
 This file is tested in tests/test_lib_machines.py in the class
 HostsMachineTestCase
 """
@@ -31,7 +36,116 @@ from .base import Machine
 from .base import BaseMachineResolver
 from .base import MachineResolverError
 
+from bisect import bisect_left
+from threading import Lock
+import logging
 import netaddr
+import os
+
+log = logging.getLogger(__name__)
+
+# The parsed hosts files of this process by filename
+_HOSTS_INDEXES = {}
+_HOSTS_LOCK = Lock()
+
+
+class SubstringIndex(object):
+    """
+    Finds the positions of the keys, which contain a given substring.
+    All suffixes of the keys are kept in a sorted list, so that the keys
+    containing a substring are found by a search for the suffixes starting
+    with the substring.
+    """
+
+    def __init__(self, items):
+        """
+        :param items: iterable of tuples (key, position)
+        """
+        suffixes = set()
+        for key, position in items:
+            for i in range(len(key)):
+                suffixes.add((key[i:], position))
+        self._suffixes = sorted(suffixes)
+
+    def search(self, substring):
+        """
+        :return: set of the positions of the keys containing the substring
+        """
+        positions = set()
+        i = bisect_left(self._suffixes, (substring,))
+        while i < len(self._suffixes) and \
+                self._suffixes[i][0].startswith(substring):
+            positions.add(self._suffixes[i][1])
+            i += 1
+        return positions
+
+
+class HostsIndex(object):
+    """
+    The parsed entries of a hosts file with lookup tables for the id,
+    hostname and IP address and for substring searches.
+    """
+
+    def __init__(self, filename, stat):
+        self.stat = stat
+        # list of tuples (id, IP address, list of hostnames) in the order of
+        # the file
+        self.entries = []
+        self.by_id = {}
+        self.by_hostname = {}
+        self.by_ip = {}
+        with open(filename, "r") as f:
+            for line in f:
+                split_line = line.split()
+                if len(split_line) < 2:
+                    # skip lines with less than 2 columns
+                    continue
+                if split_line[0][0] == "#":
+                    # skip comments
+                    continue
+                position = len(self.entries)
+                line_id = split_line[0]
+                line_ip = netaddr.IPAddress(split_line[0])
+                line_hostname = split_line[1:]
+                self.entries.append((line_id, line_ip, line_hostname))
+                self.by_id.setdefault(line_id, []).append(position)
+                self.by_ip.setdefault(line_ip, []).append(position)
+                for hostname in line_hostname:
+                    self.by_hostname.setdefault(hostname, []).append(position)
+        self.id_index = SubstringIndex(
+            (entry[0], position) for position, entry in enumerate(self.entries))
+        self.ip_index = SubstringIndex(
+            ("{0!s}".format(entry[1]), position)
+            for position, entry in enumerate(self.entries))
+        self.hostname_index = SubstringIndex(
+            (hostname, position) for position, entry in enumerate(self.entries)
+            for hostname in entry[2])
+
+    def search_any(self, substring):
+        return (self.id_index.search(substring) |
+                self.ip_index.search(substring) |
+                self.hostname_index.search(substring))
+
+
+def get_hosts_index(filename):
+    """
+    Return the parsed hosts file. The file is parsed again, if it was
+    changed.
+
+    :param filename: The name of the hosts file
+    :return: HostsIndex
+    """
+    st = os.stat(filename)
+    stat = (st.st_mtime, st.st_size, st.st_ino)
+    index = _HOSTS_INDEXES.get(filename)
+    if index is None or index.stat != stat:
+        with _HOSTS_LOCK:
+            index = _HOSTS_INDEXES.get(filename)
+            if index is None or index.stat != stat:
+                log.debug(u"Reading the hosts file {0!s}".format(filename))
+                index = HostsIndex(filename, stat)
+                _HOSTS_INDEXES[filename] = index
+    return index
 
 
 class HostsMachineResolver(BaseMachineResolver):
@@ -53,56 +167,55 @@ class HostsMachineResolver(BaseMachineResolver):
         :return: list of Machine Objects
         """
         machines = []
+        index = get_hosts_index(self.filename)
 
-        f = open(self.filename, "r")
-        try:
-            for line in f:
-                split_line = line.split()
-                if len(split_line) < 2:
-                    # skip lines with less than 2 columns
-                    continue
-                if split_line[0][0] == "#":
-                    # skip comments
-                    continue
-                line_id = split_line[0]
-                line_ip = netaddr.IPAddress(split_line[0])
-                line_hostname = split_line[1:]
-                # check if machine_id, ip or hostname matches a substring
-                if (any and any not in line_id and
-                        len([x for x in line_hostname if any in x]) <= 0 and
-                        any not in "{0!s}".format(line_ip)):
-                    # "any" was provided but did not match either
-                    # hostname, ip or machine_id
-                    continue
+        def any_matches(position):
+            # check if machine_id, ip or hostname matches a substring
+            return not any or position in any_positions
+
+        any_positions = index.search_any(any) if any else None
+        if machine_id and not substring:
+            # The first machine with this very id is returned
+            for position in index.by_id.get(machine_id, []):
+                if any_matches(position):
+                    line_id, line_ip, line_hostname = index.entries[position]
+                    return [Machine(self.name, line_id,
+                                    hostname=list(line_hostname),
+                                    ip=line_ip)]
+
+        # Determine the candidates from the lookup tables
+        candidates = any_positions
+        if machine_id and substring:
+            candidates = self._intersect(candidates,
+                                         index.id_index.search(machine_id))
+        if hostname:
+            if substring:
+                h_positions = index.hostname_index.search(hostname)
+            else:
+                h_positions = set(index.by_hostname.get(hostname, []))
+            candidates = self._intersect(candidates, h_positions)
+        if ip:
+            try:
+                ip_positions = set(index.by_ip.get(netaddr.IPAddress(ip), []))
+            except (netaddr.AddrFormatError, ValueError, TypeError):
+                ip_positions = set()
+            candidates = self._intersect(candidates, ip_positions)
+        if candidates is None:
+            candidates = range(len(index.entries))
 
-                else:
-                    if machine_id:
-                        if not substring and machine_id == line_id:
-                            return [Machine(self.name, line_id,
-                                            hostname=line_hostname, ip=line_ip)]
-                        if substring and machine_id not in line_id:
-                            # do not append this machine!
-                            continue
-                    if hostname:
-                        if substring:
-                            h_match = len([x for x in line_hostname if hostname in x])
-                        else:
-                            h_match = hostname in line_hostname
-                        if not h_match:
-                            # do not append this machine!
-                            continue
-
-                    if ip and ip != line_ip:
-                        # Do not append this machine!
-                        continue
-
-                machines.append(Machine(self.name, line_id,
-                                        hostname=line_hostname,
-                                        ip=line_ip))
-        finally:
-            f.close()
+        for position in sorted(candidates):
+            line_id, line_ip, line_hostname = index.entries[position]
+            machines.append(Machine(self.name, line_id,
+                                    hostname=list(line_hostname),
+                                    ip=line_ip))
         return machines
 
+    @staticmethod
+    def _intersect(candidates, positions):
+        if candidates is None:
+            return positions
+        return candidates & positions
+
     def get_machine_id(self, hostname=None, ip=None):
         """
         Returns the machine id for a given hostname or IP address.
@@ -118,12 +231,9 @@ class HostsMachineResolver(BaseMachineResolver):
         :return: The machine ID, which depends on the resolver
         :rtype: basestring
         """
-        machines = self.get_machines()
-        for machine in machines:
-            h_match = not hostname or machine.has_hostname(hostname)
-            i_match = not ip or machine.has_ip(ip)
-            if h_match and i_match:
-                return machine.id
+        machines = self.get_machines(hostname=hostname, ip=ip)
+        if machines:
+            return machines[0].id
 
         return
 
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-19 Reuse the LDAP connections and cache the machines
 #  2016-08-12 Sebastian Plattner
 #             Allow hostname and machine ID being the same
 #             LDAP attribute.
@@ -31,6 +32,11 @@ The computer objects are identified by
 
 The machine id can be the DN or the objectSid in this case.
 
+The bound LDAP connections are shared by all resolvers of the process, which
+use the same server and credentials. The found machines are cached for
+CACHE_TIMEOUT seconds (default 120). Searches, that did not find a machine,
+are cached, too.
+
 This file is tested in tests/test_lib_machine_resolver_ldap.py in the class
 LdapMachineTestCase
 """
@@ -38,9 +44,13 @@ LdapMachineTestCase
 import netaddr
 import traceback
 import logging
+import time
+from collections import OrderedDict
+from threading import Lock
 
 import ldap3
 from ldap3 import Tls
+from ldap3.core.exceptions import LDAPException
 import ssl
 
 from .base import Machine
@@ -52,6 +62,18 @@ from privacyidea.lib import _
 
 log = logging.getLogger(__name__)
 
+# The maximum number of cached searches of all LDAP machine resolvers
+CACHE_SIZE = 1000
+
+# The bound connections of this process. The key contains the connection
+# parameters, the value is a tuple of a lock and the connection.
+_CONNECTIONS = {}
+_CONNECTIONS_LOCK = Lock()
+# The results of the searches of this process, the least recently used
+# search comes first.
+_MACHINE_CACHE = OrderedDict()
+_MACHINE_CACHE_LOCK = Lock()
+
 
 class LdapMachineResolver(BaseMachineResolver):
 
@@ -63,20 +85,85 @@ class LdapMachineResolver(BaseMachineResolver):
         if config:
             self.load_config(config)
 
+    def _connection_key(self):
+        return (self.uri, self.timeout, self.binddn, self.bindpw,
+                self.authtype, self.noreferrals, self.start_tls,
+                self.tls_verify, self.tls_ca_file)
+
     def _bind(self):
         if not self.i_am_bound:
-            server_pool = IdResolver.get_serverpool(self.uri, self.timeout,
-                                                    tls_context=self.tls_context)
-            self.l = IdResolver.create_connection(authtype=self.authtype,
-                                                  server=server_pool,
-                                                  user=self.binddn,
-                                                  password=self.bindpw,
-                                                  auto_referrals=not self.noreferrals,
-                                                  start_tls=self.start_tls)
-            if not self.l.bind():
-                raise Exception("Wrong credentials")
+            key = self._connection_key()
+            with _CONNECTIONS_LOCK:
+                pooled = _CONNECTIONS.get(key)
+            if pooled is None:
+                server_pool = IdResolver.get_serverpool(self.uri, self.timeout,
+                                                        tls_context=self.tls_context)
+                connection = IdResolver.create_connection(authtype=self.authtype,
+                                                          server=server_pool,
+                                                          user=self.binddn,
+                                                          password=self.bindpw,
+                                                          auto_referrals=not self.noreferrals,
+                                                          start_tls=self.start_tls)
+                if not connection.bind():
+                    raise Exception("Wrong credentials")
+                pooled = (Lock(), connection)
+                with _CONNECTIONS_LOCK:
+                    _CONNECTIONS[key] = pooled
+            self._lock, self.l = pooled
             self.i_am_bound = True
 
+    def _unbind(self):
+        """
+        Remove the connection from the shared connections, e.g. if the server
+        closed the connection.
+        """
+        with _CONNECTIONS_LOCK:
+            if _CONNECTIONS.get(self._connection_key(), (None, None))[1] is self.l:
+                del _CONNECTIONS[self._connection_key()]
+        self.i_am_bound = False
+
+    def _search(self, **kwds):
+        """
+        Search with the shared connection and return the response. If the
+        search fails, the search is repeated with a new connection.
+        """
+        for attempt in [1, 2]:
+            self._bind()
+            try:
+                with self._lock:
+                    self.l.search(**kwds)
+                    return list(self.l.response or [])
+            except LDAPException as exx:
+                log.warning(u"Search in LDAP machine resolver {0!s} failed: "
+                            u"{1!r}".format(self.name, exx))
+                self._unbind()
+                if attempt == 2:
+                    raise
+
+    def _cache_key(self, *params):
+        return self._connection_key() + (
+            self.basedn, self.search_filter, self.id_attribute,
+            self.hostname_attribute, self.ip_attribute, self.sizelimit) + params
+
+    def _get_cached(self, key):
+        with _MACHINE_CACHE_LOCK:
+            entry = _MACHINE_CACHE.get(key)
+            if entry is not None:
+                if time.time() - entry[0] > self.cache_timeout:
+                    del _MACHINE_CACHE[key]
+                    return None
+                # Mark the search as recently used
+                del _MACHINE_CACHE[key]
+                _MACHINE_CACHE[key] = entry
+                return list(entry[1])
+
+    def _set_cached(self, key, machines):
+        with _MACHINE_CACHE_LOCK:
+            _MACHINE_CACHE.pop(key, None)
+            _MACHINE_CACHE[key] = (time.time(), list(machines))
+            while len(_MACHINE_CACHE) > CACHE_SIZE:
+                _MACHINE_CACHE.popitem(last=False)
+
     @staticmethod
     def _get_entry(entry_attribute, entries):
         if type(entries.get(entry_attribute)) == list:
@@ -140,8 +227,18 @@ class LdapMachineResolver(BaseMachineResolver):
         :type any: basestring
         :return: list of Machine Objects
         """
+        cache_key = None
+        if self.cache_timeout > 0:
+            cache_key = self._cache_key(machine_id, hostname,
+                                        u"{0!s}".format(ip) if ip else ip,
+                                        any, substring)
+            machines = self._get_cached(cache_key)
+            if machines is not None:
+                log.debug(u"Reading machines from the cache of LDAP machine "
+                          u"resolver {0!s}".format(self.name))
+                return machines
+
         machines = []
-        self._bind()
         attributes = []
         if self.id_attribute.lower() != "dn":
             attributes.append(self.id_attribute)
@@ -158,20 +255,20 @@ class LdapMachineResolver(BaseMachineResolver):
                                           substring, any)
 
         if self.id_attribute.lower() == "dn" and machine_id:
-            self.l.search(search_base=machine_id,
-                          search_scope=ldap3.BASE,
-                          search_filter=filter,
-                          attributes=attributes,
-                          paged_size=self.sizelimit)
+            response = self._search(search_base=machine_id,
+                                    search_scope=ldap3.BASE,
+                                    search_filter=filter,
+                                    attributes=attributes,
+                                    paged_size=self.sizelimit)
         else:
-            self.l.search(search_base=self.basedn,
-                          search_scope=ldap3.SUBTREE,
-                          search_filter=filter,
-                          attributes=attributes,
-                          paged_size=self.sizelimit)
+            response = self._search(search_base=self.basedn,
+                                    search_scope=ldap3.SUBTREE,
+                                    search_filter=filter,
+                                    attributes=attributes,
+                                    paged_size=self.sizelimit)
 
         # returns a list of dictionaries
-        for entry in self.l.response:
+        for entry in response:
             dn = entry.get("dn")
             attributes = entry.get("attributes")
 
@@ -198,6 +295,9 @@ class LdapMachineResolver(BaseMachineResolver):
                 log.error("Error during fetching LDAP objects: {0!r}".format(exx))
                 log.debug("{0!s}".format(traceback.format_exc()))
 
+        if cache_key:
+            # Also cache, that no machine was found
+            self._set_cached(cache_key, machines)
         return machines
 
     def get_machine_id(self, hostname=None, ip=None):
@@ -256,6 +356,7 @@ class LdapMachineResolver(BaseMachineResolver):
         self.ip_attribute = config.get("IPATTRIBUTE")
         self.search_filter = config.get("SEARCHFILTER",
                                         "(objectClass=computer)")
+        self.cache_timeout = int(config.get("CACHE_TIMEOUT", 120))
 
         self.noreferrals = is_true(config.get("NOREFERRALS", False))
         self.authtype = config.get("AUTHTYPE", AUTHTYPE.SIMPLE)
@@ -286,7 +387,8 @@ class LdapMachineResolver(BaseMachineResolver):
                                              "AUTHTYPE": "string",
                                              "TLS_VERIFY": "bool",
                                              "TLS_CA_FILE": "string",
-                                             "START_TLS": "bool"
+                                             "START_TLS": "bool",
+                                             "CACHE_TIMEOUT": "int"
                                              }}}
 
         return description
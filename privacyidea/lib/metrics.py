@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+#
+#  2018-11-07 Live metrics of the privacyIDEA processes
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """This module contains a registry of live metrics like counters,
+gauges and latency histograms. Contrary to the monitoringstats, the values are
+not written to the database but kept in the memory of the process.
+
+If ``PI_METRICS_DIR`` is set in pi.cfg, each process writes its values to a
+memory mapped file in this directory. Thus the metrics of all wsgi processes
+can be aggregated, when they are exposed in the Prometheus text format.
+
+This module is tested in tests/test_lib_metrics.py
+"""
+import functools
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import has_app_context
+from privacyidea.lib.framework import (get_app_local_store,
+                                       get_app_config_value)
+
+log = logging.getLogger(__name__)
+
+
+class METRIC_TYPE(object):
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+
+
+# The default buckets of latency histograms in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# The metrics, that are written by privacyIDEA.
+METRICS = {
+    "privacyidea_validate_requests_total": (
+        METRIC_TYPE.COUNTER,
+        "Number of authentication requests by result"),
+    "privacyidea_policy_evaluation_seconds": (
+        METRIC_TYPE.HISTOGRAM,
+        "Time spent matching policies"),
+    "privacyidea_resolver_request_seconds": (
+        METRIC_TYPE.HISTOGRAM,
+        "Latency of requests to user resolvers"),
+    "privacyidea_audit_write_seconds": (
+        METRIC_TYPE.HISTOGRAM,
+        "Time spent writing audit entries"),
+    "privacyidea_db_pool_checkedout": (
+        METRIC_TYPE.GAUGE,
+        "Database connections in use"),
+    "privacyidea_db_pool_size": (
+        METRIC_TYPE.GAUGE,
+        "Size of the database connection pool"),
+}
+
+
+def _format_key(name, labels=None):
+    """
+    Return the sample name in the Prometheus text format like
+    ``name{label="value"}``
+    """
+    if not labels:
+        return name
+    label_str = u",".join([u'{0!s}="{1!s}"'.format(
+        k, unicode(v).replace(u"\\", u"\\\\").replace(u'"', u'\\"').replace(
+            u"\n", u"\\n")) for k, v in sorted(labels.items())])
+    return u"{0!s}{{{1!s}}}".format(name, label_str)
+
+
+def _format_value(value):
+    if value == int(value):
+        return "{0:d}".format(int(value))
+    return repr(value)
+
+
+class MmapedValues(object):
+    """
+    A file of float values, that is mapped to memory. Only one process writes
+    to a file, all processes can read it.
+
+    The file starts with the number of used bytes. Each value is stored as
+    the length of the key, the key padded to 8 bytes and the value as double.
+    """
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, filename):
+        self._f = open(filename, "a+b")
+        if os.fstat(self._f.fileno()).st_size == 0:
+            self._f.truncate(self.INITIAL_SIZE)
+        self._capacity = os.fstat(self._f.fileno()).st_size
+        self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._positions = {}
+        self._used = struct.unpack_from("i", self._m, 0)[0] or 8
+        for key, _value, pos in self._read_all(self._m, self._used):
+            self._positions[key] = pos
+
+    @staticmethod
+    def _read_all(data, used):
+        pos = 8
+        while pos < used:
+            keylen = struct.unpack_from("i", data, pos)[0]
+            key = data[pos + 4:pos + 4 + keylen].decode("utf-8")
+            pos += 4 + keylen + (8 - (4 + keylen) % 8) % 8
+            value = struct.unpack_from("d", data, pos)[0]
+            yield key, value, pos
+            pos += 8
+
+    @staticmethod
+    def read_file(filename):
+        """
+        Return the key/value pairs of the given file.
+        """
+        with open(filename, "rb") as f:
+            data = f.read()
+        if len(data) < 8:
+            return []
+        used = struct.unpack_from("i", data, 0)[0]
+        return [(key, value) for key, value, _pos in
+                MmapedValues._read_all(data, used)]
+
+    def _init_value(self, key):
+        encoded = key.encode("utf-8")
+        padded = encoded + b" " * ((8 - (4 + len(encoded)) % 8) % 8)
+        entry = struct.pack("i{0:d}sd".format(len(padded)), len(encoded),
+                            padded, 0.0)
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._f.truncate(self._capacity)
+            self._m.close()
+            self._m = mmap.mmap(self._f.fileno(), self._capacity)
+        self._m[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        # The number of used bytes is written last, so that readers only
+        # see complete entries.
+        struct.pack_into("i", self._m, 0, self._used)
+        self._positions[key] = self._used - 8
+
+    def get(self, key):
+        if key not in self._positions:
+            return 0.0
+        return struct.unpack_from("d", self._m, self._positions[key])[0]
+
+    def set(self, key, value):
+        if key not in self._positions:
+            self._init_value(key)
+        struct.pack_into("d", self._m, self._positions[key], value)
+
+    def items(self):
+        return [(key, self.get(key)) for key in self._positions]
+
+    def close(self):
+        self._m.close()
+        self._f.close()
+
+
+class DictValues(object):
+    """
+    The values of a single process, that are only kept in memory.
+    """
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key):
+        return self._values.get(key, 0.0)
+
+    def set(self, key, value):
+        self._values[key] = value
+
+    def items(self):
+        return self._values.items()
+
+
+class MetricsRegistry(object):
+    """
+    The registry of the metric values of this process.
+
+    :param directory: The directory for the memory mapped files. If it is
+        not given, the values are only kept in the memory of the process.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = Lock()
+        self._pid = None
+        self._values = None
+
+    def _get_values(self):
+        # After a fork the child process needs its own file
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            if self.directory:
+                self._values = MmapedValues(os.path.join(
+                    self.directory, "metrics_{0:d}.db".format(pid)))
+            else:
+                self._values = DictValues()
+        return self._values
+
+    def inc(self, name, value=1, labels=None):
+        """
+        Increase a counter.
+        """
+        key = _format_key(name, labels)
+        with self._lock:
+            values = self._get_values()
+            values.set(key, values.get(key) + value)
+
+    def set(self, name, value, labels=None):
+        """
+        Set the value of a gauge.
+        """
+        with self._lock:
+            self._get_values().set(_format_key(name, labels), value)
+
+    def observe(self, name, value, labels=None, buckets=DEFAULT_BUCKETS):
+        """
+        Add an observation like a duration to a histogram.
+        """
+        labels = labels or {}
+        with self._lock:
+            values = self._get_values()
+            # The buckets are cumulative. All buckets are written, so that
+            # empty buckets are exposed as well.
+            for bucket in buckets + (float("inf"),):
+                bucket_labels = dict(labels)
+                bucket_labels["le"] = "+Inf" if bucket == float(
+                    "inf") else _format_value(bucket)
+                key = _format_key(name + "_bucket", bucket_labels)
+                values.set(key, values.get(key) + (1 if value <= bucket else 0))
+            for suffix, inc in [("_sum", value), ("_count", 1)]:
+                key = _format_key(name + suffix, labels)
+                values.set(key, values.get(key) + inc)
+
+    def collect(self):
+        """
+        Return the aggregated values of all processes.
+        Counters and histograms of all processes are summed up. Gauges are
+        summed up for all running processes.
+
+        :return: dict of sample names and values
+        """
+        if not self.directory:
+            with self._lock:
+                return dict(self._get_values().items())
+        with self._lock:
+            # make sure, that the file of this process exists
+            self._get_values()
+        samples = {}
+        for filename in glob.glob(os.path.join(self.directory,
+                                               "metrics_*.db")):
+            pid = int(os.path.basename(filename)[8:-3])
+            alive = _pid_is_alive(pid)
+            for key, value in MmapedValues.read_file(filename):
+                name = key.split("{")[0]
+                if not alive and METRICS.get(name, ("",))[0] == \
+                        METRIC_TYPE.GAUGE:
+                    continue
+                samples[key] = samples.get(key, 0.0) + value
+        return samples
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def get_registry():
+    """
+    Return the metrics registry of the current application.
+    The registry respects the config option ``PI_METRICS_DIR``.
+    Outside of an application context no metrics are recorded and None is
+    returned.
+
+    :return: a MetricsRegistry object
+    """
+    if not has_app_context():
+        return None
+    app_store = get_app_local_store()
+    try:
+        return app_store["metrics_registry"]
+    except KeyError:
+        registry = MetricsRegistry(get_app_config_value("PI_METRICS_DIR"))
+        return app_store.setdefault("metrics_registry", registry)
+
+
+def inc(name, value=1, labels=None):
+    """
+    Increase the counter ``name``.
+    """
+    registry = get_registry()
+    if registry:
+        registry.inc(name, value, labels)
+
+
+def set_gauge(name, value, labels=None):
+    """
+    Set the gauge ``name``.
+    """
+    registry = get_registry()
+    if registry:
+        registry.set(name, value, labels)
+
+
+def observe(name, value, labels=None):
+    """
+    Add a value to the histogram ``name``.
+    """
+    registry = get_registry()
+    if registry:
+        registry.observe(name, value, labels)
+
+
+@contextmanager
+def timer(name, labels=None):
+    """
+    Context manager, that adds the duration of the block in seconds to the
+    histogram ``name``.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, labels)
+
+
+def timed(name, labels=None):
+    """
+    Decorator, that adds the duration of the decorated function to the
+    histogram ``name``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_wrapper(*args, **kwds):
+            with timer(name, labels):
+                return func(*args, **kwds)
+        return timed_wrapper
+    return decorator
+
+
+def _family(sample_name):
+    name = sample_name.split("{")[0]
+    for suffix in ["_bucket", "_sum", "_count"]:
+        if name.endswith(suffix) and METRICS.get(
+                name[:-len(suffix)], ("",))[0] == METRIC_TYPE.HISTOGRAM:
+            return name[:-len(suffix)]
+    return name
+
+
+def _bucket_order(sample_name):
+    # Sort buckets by their upper bound, as Prometheus expects them
+    if 'le="' not in sample_name:
+        return sample_name, 0
+    le = sample_name.split('le="')[1].split('"')[0]
+    base = sample_name.replace(u'le="{0!s}"'.format(le), u"")
+    return base, float(le)
+
+
+def generate_prometheus_text():
+    """
+    Return the metrics of all processes in the Prometheus text exposition
+    format.
+
+    :return: unicode string
+    """
+    families = {}
+    for key, value in get_registry().collect().items():
+        families.setdefault(_family(key), []).append((key, value))
+    lines = []
+    for family in sorted(families):
+        metric_type, description = METRICS.get(family, ("untyped", ""))
+        if description:
+            lines.append(u"# HELP {0!s} {1!s}".format(family, description))
+        lines.append(u"# TYPE {0!s} {1!s}".format(family, metric_type))
+        for key, value in sorted(families[family],
+                                 key=lambda s: _bucket_order(s[0])):
+            lines.append(u"{0!s} {1!s}".format(key, _format_value(value)))
+    return u"\n".join(lines) + u"\n"
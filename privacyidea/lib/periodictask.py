@@ -28,6 +28,7 @@ from dateutil.tz import tzutc, tzlocal
 
 from privacyidea.lib.error import ParameterError, ResourceNotFoundError
 from privacyidea.lib.utils import fetch_one_resource
+from privacyidea.lib.task.challengecleanup import ChallengeCleanupTask
 from privacyidea.lib.task.eventcounter import EventCounterTask
 from privacyidea.lib.task.simplestats import SimpleStatsTask
 from privacyidea.models import PeriodicTask
@@ -35,7 +36,7 @@ from privacyidea.lib.framework import get_app_config
 
 log = logging.getLogger(__name__)
 
-TASK_CLASSES = [EventCounterTask, SimpleStatsTask]
+TASK_CLASSES = [ChallengeCleanupTask, EventCounterTask, SimpleStatsTask]
 #: TASK_MODULES maps task module identifiers to subclasses of BaseTask
 TASK_MODULES = dict((cls.identifier, cls) for cls in TASK_CLASSES)
 
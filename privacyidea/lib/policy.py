@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Cache the UI rights per policy version
+#  2018-11-19 Compile the time ranges and client lists of the policies
 #  2018-09-07 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add App Image URL
 #  2018-01-15 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -156,20 +158,21 @@ from .log import log_with
 from configobj import ConfigObj
 
 from netaddr import IPAddress
-from netaddr import IPNetwork
 from operator import itemgetter
 import logging
 from ..models import (Policy, Config, PRIVACYIDEA_TIMESTAMP, db,
                       save_config_timestamp)
-from privacyidea.lib.config import (get_token_classes, get_token_types,
+from privacyidea.lib.config import (get_token_types, get_token_class_info,
                                     Singleton)
 from privacyidea.lib.framework import get_app_config_value
+from privacyidea.lib.metrics import timed
 from privacyidea.lib.error import ParameterError, PolicyError, ResourceNotFoundError
 from privacyidea.lib.realm import get_realms
 from privacyidea.lib.resolver import get_resolver_list
 from privacyidea.lib.smtpserver import get_smtpservers
 from privacyidea.lib.radiusserver import get_radiusservers
-from privacyidea.lib.utils import check_time_in_range, reload_db, fetch_one_resource
+from privacyidea.lib.utils import (get_time_range, get_client_matcher,
+                                   reload_db, fetch_one_resource)
 from privacyidea.lib.user import User
 from privacyidea.lib import _
 import datetime
@@ -181,6 +184,8 @@ log = logging.getLogger(__name__)
 
 optional = True
 required = False
+#: The number of cached UI rights per process
+RIGHTS_CACHE_SIZE = 1000
 
 
 class SCOPE(object):
@@ -393,6 +398,11 @@ class PolicyClass(with_metaclass(Singleton, object)):
         """
         self.policies = []
         self.timestamp = None
+        # The version is increased with each reload of the policies. The
+        # rights of the UI are cached per version.
+        self.version = 0
+        self._rights_cache = {}
+        self._time_dependent = False
         # read the policies from the database and store it in the object
         self.reload_from_db()
 
@@ -412,8 +422,47 @@ class PolicyClass(with_metaclass(Singleton, object)):
                 for pol in policies:
                     # read each policy
                     self.policies.append(pol.get())
+                self._compile_policies()
+                self.version += 1
+                self._rights_cache = {}
             self.timestamp = datetime.datetime.now()
 
+    def _compile_policies(self):
+        """
+        Compile the time ranges and the client lists of the policies, so
+        that get_policies does not need to parse them.
+        Wrong client definitions are reported, when the policies are matched.
+        """
+        self._time_dependent = False
+        for policy in self.policies:
+            if policy.get("time"):
+                self._time_dependent = True
+                get_time_range(policy.get("time"))
+            if policy.get("client"):
+                try:
+                    get_client_matcher(policy.get("client"))
+                except Exception as exx:
+                    log.warning("The client definition of policy {0!s} is "
+                                "invalid: {1!s}".format(policy.get("name"),
+                                                        exx))
+
+    def _get_cached_rights(self, key, compute):
+        """
+        Return the result of compute, which is cached for the key and the
+        version of the policies. If a policy is restricted to a time, the
+        result is computed with each call.
+        """
+        if self._time_dependent:
+            return compute()
+        key = (self.version,) + key
+        rights = self._rights_cache.get(key)
+        if rights is None:
+            rights = compute()
+            if len(self._rights_cache) >= RIGHTS_CACHE_SIZE:
+                self._rights_cache.clear()
+            self._rights_cache[key] = rights
+        return rights
+
     @classmethod
     def _search_value(cls, policy_attributes, searchvalue):
         """
@@ -452,6 +501,7 @@ class PolicyClass(with_metaclass(Singleton, object)):
         return value_found, value_excluded
 
     @log_with(log)
+    @timed("privacyidea_policy_evaluation_seconds")
     def get_policies(self, name=None, scope=None, realm=None, active=None,
                      resolver=None, user=None, client=None, action=None,
                      adminrealm=None, time=None, all_times=False,
@@ -491,7 +541,7 @@ class PolicyClass(with_metaclass(Singleton, object)):
         if not all_times:
             reduced_policies = [policy for policy in reduced_policies if
                                 (policy.get("time") and
-                                 check_time_in_range(policy.get("time"), time))
+                                 get_time_range(policy.get("time")).match(time))
                                 or not policy.get("time")]
         log.debug("Policies after matching time: {0!s}".format(
             reduced_policies))
@@ -576,22 +626,18 @@ class PolicyClass(with_metaclass(Singleton, object)):
         # An empty client definition in the policy matches all clients.
         if client is not None:
             new_policies = []
+            client_ip = None
             for policy in reduced_policies:
-                client_found = False
-                client_excluded = False
-                for polclient in policy.get("client"):
-                    if polclient[0] in ['-', '!']:
-                        # exclude the client?
-                        if IPAddress(client) in IPNetwork(polclient[1:]):
-                            log.debug("the client %s is excluded by %s in "
-                                      "policy %s" % (client, polclient, policy))
-                            client_excluded = True
-                    elif IPAddress(client) in IPNetwork(polclient):
-                        client_found = True
-                if client_found and not client_excluded:
-                    # The client was contained in the defined subnets and was
-                    #  not excluded
-                    new_policies.append(policy)
+                if policy.get("client"):
+                    # The client is only parsed, if a policy restricts the
+                    # clients
+                    if client_ip is None:
+                        client_ip = IPAddress(client)
+                    if get_client_matcher(policy.get("client")).match(
+                            client_ip):
+                        # The client was contained in the defined subnets
+                        # and was not excluded
+                        new_policies.append(policy)
 
             # If there is a policy without any client, we also add it to the
             # accepted list.
@@ -751,6 +797,11 @@ class PolicyClass(with_metaclass(Singleton, object)):
         :param client: The HTTP client IP
         :return: A list of actions
         """
+        return list(self._get_cached_rights(
+            ("rights", scope, realm, username, client),
+            lambda: self._get_rights(scope, realm, username, client)))
+
+    def _get_rights(self, scope, realm, username, client):
         from privacyidea.lib.auth import ROLE
         from privacyidea.lib.token import get_dynamic_policy_definitions
         rights = set()
@@ -784,7 +835,7 @@ class PolicyClass(with_metaclass(Singleton, object)):
             log.debug("No policies defined, so we set all rights.")
             rights = get_static_policy_definitions(scope)
             rights.update(get_dynamic_policy_definitions(scope))
-        rights = list(rights)
+        rights = tuple(rights)
         log.debug("returning the admin rights: {0!s}".format(rights))
         return rights
 
@@ -815,31 +866,38 @@ class PolicyClass(with_metaclass(Singleton, object)):
         :type logged_in_user: dict
         :return: list of token types, the user may enroll
         """
-        from privacyidea.lib.auth import ROLE
-        enroll_types = {}
         role = logged_in_user.get("role")
+        realm = logged_in_user.get("realm")
+        username = logged_in_user.get("username")
+        tokentypes = self._get_cached_rights(
+            ("enroll", role, realm, username, client),
+            lambda: self._get_enroll_tokentypes(client, role, realm,
+                                                username))
+        return dict((tokentype, get_token_class_info(tokentype, "description"))
+                    for tokentype in tokentypes)
+
+    def _get_enroll_tokentypes(self, client, role, realm, username):
+        from privacyidea.lib.auth import ROLE
         if role == ROLE.ADMIN:
-            admin_realm = logged_in_user.get("realm")
+            admin_realm = realm
             user_realm = None
         else:
             admin_realm = None
-            user_realm = logged_in_user.get("realm")
+            user_realm = realm
         # check, if we have a policy definition at all.
         pols = self.get_policies(scope=role, active=True)
-        tokenclasses = get_token_classes()
-        for tokenclass in tokenclasses:
-            # Check if the tokenclass is ui enrollable for "user" or "admin"
-            if role in tokenclass.get_class_info("ui_enroll"):
-                enroll_types[tokenclass.get_class_type()] = \
-                    tokenclass.get_class_info("description")
+        # Check if the tokenclass is ui enrollable for "user" or "admin"
+        enroll_types = [tokentype for tokentype in get_token_types()
+                        if role in get_token_class_info(tokentype,
+                                                        "ui_enroll")]
 
         if pols:
             # admin policies or user policies are set, so we need to
             # test, which tokens are allowed to be enrolled for this user
-            for tokentype in enroll_types.keys():
+            for tokentype in list(enroll_types):
                 # determine, if there is a enrollment policy for this very type
                 typepols = self.get_policies(scope=role, client=client,
-                                             user=logged_in_user.get("username"),
+                                             user=username,
                                              realm=user_realm,
                                              active=True,
                                              action="enroll"+tokentype.upper(),
@@ -847,9 +905,9 @@ class PolicyClass(with_metaclass(Singleton, object)):
                 if not typepols:
                     # If there is no policy allowing the enrollment of this
                     # tokentype, it is deleted.
-                    del(enroll_types[tokentype])
+                    enroll_types.remove(tokentype)
 
-        return enroll_types
+        return tuple(enroll_types)
 
 # --------------------------------------------------------------------------
 #
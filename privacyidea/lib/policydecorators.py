@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Read the authentications for the timelimit from the
+#             authentication counters
 #  2017-08-11 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add authcache decorator
 #  2017-07-20 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -48,9 +50,11 @@ from privacyidea.lib.policy import ACTION, SCOPE, ACTIONVALUE, LOGINMODE
 from privacyidea.lib.user import User
 from privacyidea.lib.utils import parse_timelimit, parse_timedelta
 from privacyidea.lib.authcache import verify_in_cache
+from privacyidea.lib.authcounter import get_auth_count
 import datetime
 from dateutil.tz import tzlocal
 from privacyidea.lib.radiusserver import get_radius
+from privacyidea.models import single_transaction
 
 log = logging.getLogger(__name__)
 
@@ -329,6 +333,24 @@ def auth_user_passthru(wrapped_function, user_object, passw, options=None):
     return wrapped_function(user_object, passw, options)
 
 
+def _get_auth_count(g, user_object, success, tdelta):
+    """
+    Return the number of successful or failed authentications of the user
+    in the time window. The authentications are read from the
+    authentication counters. If they are not available, the audit log is
+    counted.
+    """
+    count = get_auth_count(user_object.login, user_object.realm, success,
+                           tdelta)
+    if count is None:
+        count = g.audit_object.get_count({"user": user_object.login,
+                                          "realm": user_object.realm,
+                                          "action": "%/validate/check"},
+                                         success=success,
+                                         timedelta=tdelta)
+    return count
+
+
 def auth_user_timelimit(wrapped_function, user_object, passw, options=None):
     """
     This decorator checks the policy settings of
@@ -378,12 +400,7 @@ def auth_user_timelimit(wrapped_function, user_object, passw, options=None):
         # Always - also in case of unsuccessful authentication
         if len(max_fail_dict) == 1:
             policy_count, tdelta = parse_timelimit(list(max_fail_dict)[0])
-            fail_c = g.audit_object.get_count({"user": user_object.login,
-                                               "realm": user_object.realm,
-                                               "action":
-                                                   "%/validate/check"},
-                                              success=False,
-                                              timedelta=tdelta)
+            fail_c = _get_auth_count(g, user_object, False, tdelta)
             log.debug("Checking users timelimit %s: %s "
                       "failed authentications" %
                       (list(max_fail_dict)[0], fail_c))
@@ -399,12 +416,7 @@ def auth_user_timelimit(wrapped_function, user_object, passw, options=None):
             if len(max_success_dict) == 1:
                 policy_count, tdelta = parse_timelimit(list(max_success_dict)[0])
                 # check the successful authentications for this user
-                succ_c = g.audit_object.get_count({"user": user_object.login,
-                                                   "realm": user_object.realm,
-                                                   "action":
-                                                       "%/validate/check"},
-                                                  success=True,
-                                                  timedelta=tdelta)
+                succ_c = _get_auth_count(g, user_object, True, tdelta)
                 log.debug("Checking users timelimit %s: %s "
                           "succesful authentications" %
                           (list(max_success_dict)[0], succ_c))
@@ -434,6 +446,14 @@ def auth_lastauth(wrapped_function, user_or_serial, passw, options=None):
     :param options: Dict containing values for "g" and "clientip"
     :return: Tuple of True/False and reply-dictionary
     """
+    # The last authentication is written in the transaction of the
+    # authentication
+    with single_transaction():
+        return _auth_lastauth(wrapped_function, user_or_serial, passw,
+                              options=options)
+
+
+def _auth_lastauth(wrapped_function, user_or_serial, passw, options=None):
     # First we call the wrapped function
     res, reply_dict = wrapped_function(user_or_serial, passw, options)
 
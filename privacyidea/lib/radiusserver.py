@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-10-18 Add a cached dictionary, a pool of reusable client sockets
+#             per server and RADIUS server groups with health tracking
 #  2017-10-30 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add timeout handling
 #  2016-02-19 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -23,6 +25,11 @@ from privacyidea.models import RADIUSServer as RADIUSServerDB
 from privacyidea.lib.crypto import decryptPassword, encryptPassword
 from privacyidea.lib.config import get_from_config
 import logging
+import os
+import time
+import threading
+from six.moves import queue
+from contextlib import contextmanager
 from privacyidea.lib.log import log_with
 from privacyidea.lib.error import ConfigAdminError, privacyIDEAError
 import pyrad.packet
@@ -38,11 +45,289 @@ the Database.
 
 It depends on the RADIUSserver in the database model models.py. This module can
 be tested standalone without any webservices.
+Parsed RADIUS dictionaries and pyrad clients (each holding its own UDP
+socket) are kept per process, so that a RADIUS request does not need to parse
+the dictionary file and open a new socket.
+Several RADIUS server definitions can be used as a group. The group is either
+queried one server after the other ("failover") or all servers are queried
+at the same time ("race"). In the race the first Access-Accept is used. Other
+answers are only used, if no server accepts the request. Servers, that did not
+respond, are marked as down for a while and are only queried, if no other
+server is available.
+
 This module is tested in tests/test_lib_radiusserver.py
 """
 
 log = logging.getLogger(__name__)
 
+# The number of idle clients (sockets), that are kept per RADIUS server
+CLIENT_POOL_SIZE = 10
+# The number of seconds a RADIUS server is skipped after a timeout
+SERVER_DOWN_TIME = 30
+
+
+class GROUP_MODE(object):
+    """
+    The modes how a group of RADIUS servers is queried.
+    """
+    FAILOVER = "failover"
+    RACE = "race"
+
+
+_dictionary_lock = threading.Lock()
+_dictionaries = {}
+
+
+def get_dictionary(filename):
+    """
+    Return the parsed pyrad dictionary of the given file.
+    The dictionary is only parsed again, if the file was modified.
+
+    :param filename: The filename of the RADIUS dictionary
+    :return: A pyrad Dictionary object
+    """
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        # let pyrad raise the error for the missing file
+        mtime = None
+    with _dictionary_lock:
+        entry = _dictionaries.get(filename)
+        if entry and entry[0] == mtime:
+            return entry[1]
+    log.debug(u"Parsing RADIUS dictionary {0!r}".format(filename))
+    dictionary = Dictionary(filename)
+    with _dictionary_lock:
+        _dictionaries[filename] = (mtime, dictionary)
+    return dictionary
+
+
+class RADIUSClientPool(object):
+    """
+    A pool of pyrad clients for one RADIUS server.
+
+    A pyrad client keeps its UDP socket open, so reusing the clients means
+    reusing the sockets. A client is only used by one thread at a time.
+    """
+
+    def __init__(self, server, port, secret, dictionary,
+                 size=CLIENT_POOL_SIZE):
+        self.server = server
+        self.port = port
+        self.secret = secret
+        self.dictionary = dictionary
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _create_client(self):
+        return Client(server=self.server, authport=self.port,
+                      secret=self.secret,
+                      dict=get_dictionary(self.dictionary))
+
+    @contextmanager
+    def client(self):
+        """
+        Context manager, that yields an idle client or a new client, if all
+        clients are in use. The client is returned to the pool afterwards.
+        """
+        try:
+            srv = self._idle.get_nowait()
+        except queue.Empty:
+            srv = self._create_client()
+        try:
+            yield srv
+        except Exception:
+            # Do not reuse a socket, that may still receive a late reply
+            srv._CloseSocket()
+            raise
+        try:
+            self._idle.put_nowait(srv)
+        except queue.Full:
+            srv._CloseSocket()
+
+
+_pool_lock = threading.Lock()
+_client_pools = {}
+
+
+def get_client_pool(server, port, secret, dictionary):
+    """
+    Return the process wide client pool for the given RADIUS server.
+
+    :param server: The FQDN or IP address of the RADIUS server
+    :param port: The authentication port
+    :param secret: The RADIUS secret
+    :param dictionary: The filename of the RADIUS dictionary
+    :return: A RADIUSClientPool object
+    """
+    key = (server, port, secret, dictionary)
+    with _pool_lock:
+        if key not in _client_pools:
+            _client_pools[key] = RADIUSClientPool(server, port, secret,
+                                                  dictionary)
+        return _client_pools[key]
+
+
+class ServerHealth(object):
+    """
+    The health of a RADIUS server as seen by this process.
+    After a timeout the server is considered to be down for
+    SERVER_DOWN_TIME seconds.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.down_until = 0
+
+    def is_available(self):
+        return self.down_until <= time.time()
+
+    def record_success(self):
+        self.failures = 0
+        self.down_until = 0
+
+    def record_failure(self):
+        self.failures += 1
+        self.down_until = time.time() + SERVER_DOWN_TIME
+
+
+_health_lock = threading.Lock()
+_server_health = {}
+
+
+def get_server_health(server, port):
+    """
+    Return the health object of the given RADIUS server.
+    """
+    with _health_lock:
+        health = _server_health.get((server, port))
+        if health is None:
+            health = _server_health[(server, port)] = ServerHealth()
+        return health
+
+
+def reset_radius_state():
+    """
+    Forget all cached dictionaries, client sockets and server health
+    information of this process.
+    """
+    with _dictionary_lock:
+        _dictionaries.clear()
+    with _pool_lock:
+        for pool in _client_pools.values():
+            while not pool._idle.empty():
+                pool._idle.get_nowait()._CloseSocket()
+        _client_pools.clear()
+    with _health_lock:
+        _server_health.clear()
+
+
+def send_access_request(target, user, password, nas_identifier, state=None):
+    """
+    Send an Access-Request to one RADIUS server and return the response.
+    A Timeout is raised, if the server does not respond.
+
+    :param target: dict with the keys "server", "port", "secret",
+        "dictionary" and optionally "timeout" and "retries"
+    :param user: the radius username
+    :param password: the radius password
+    :param nas_identifier: The NAS-Identifier to send
+    :param state: An optional State attribute
+    :return: the pyrad response packet
+    """
+    pool = get_client_pool(target.get("server"), target.get("port"),
+                           target.get("secret"), target.get("dictionary"))
+    health = get_server_health(target.get("server"), target.get("port"))
+    with pool.client() as srv:
+        srv.timeout = target.get("timeout") or 5
+        srv.retries = target.get("retries") or 3
+        req = srv.CreateAuthPacket(code=pyrad.packet.AccessRequest,
+                                   User_Name=user.encode('ascii'),
+                                   NAS_Identifier=nas_identifier.encode(
+                                       'ascii'))
+        req["User-Password"] = req.PwCrypt(password)
+        if state:
+            req["State"] = str(state)
+        try:
+            response = srv.SendPacket(req)
+        except Timeout:
+            log.info(u"Receiving timeout from remote radius server "
+                     u"{0!s}".format(target.get("server")))
+            health.record_failure()
+            raise
+    health.record_success()
+    return response
+
+
+def _failover_request(targets, user, password, nas_identifier, state):
+    # Query the available servers first. Servers, that are down are
+    # only tried, if all other servers failed.
+    ordered = sorted(targets, key=lambda t: not get_server_health(
+        t.get("server"), t.get("port")).is_available())
+    for target in ordered:
+        try:
+            return send_access_request(target, user, password,
+                                       nas_identifier, state)
+        except Timeout:
+            log.info(u"Failing over from radius server {0!s}".format(
+                target.get("server")))
+    raise Timeout()
+
+
+def _race_request(targets, user, password, nas_identifier, state):
+    available = [t for t in targets if get_server_health(
+        t.get("server"), t.get("port")).is_available()] or targets
+    results = queue.Queue()
+    # Each server is asked until its timeout and retries are used up
+    deadline = time.time() + max((t.get("timeout") or 5) *
+                                 (t.get("retries") or 3) for t in available)
+
+    def _worker(target):
+        try:
+            results.put(send_access_request(target, user, password,
+                                            nas_identifier, state))
+        except Exception as exx:
+            results.put(exx)
+
+    for target in available:
+        t = threading.Thread(target=_worker, args=(target,))
+        t.daemon = True
+        t.start()
+    # An Access-Accept wins the race. Other answers are only returned, if
+    # no server accepts the request.
+    fallback = None
+    for _i in range(len(available)):
+        try:
+            response = results.get(timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            break
+        if isinstance(response, Exception):
+            log.debug(u"radius server in race failed: {0!r}".format(response))
+        elif response.code == pyrad.packet.AccessAccept:
+            return response
+        elif fallback is None:
+            fallback = response
+    if fallback is not None:
+        return fallback
+    raise Timeout()
+
+
+def send_group_request(targets, user, password, nas_identifier, state=None,
+                       mode=GROUP_MODE.FAILOVER):
+    """
+    Send an Access-Request to a group of RADIUS servers and return the first
+    response. A Timeout is raised, if no server responds.
+
+    :param targets: list of dicts as described in send_access_request
+    :param mode: GROUP_MODE.FAILOVER or GROUP_MODE.RACE
+    :return: the pyrad response packet
+    """
+    if len(targets) == 1:
+        return send_access_request(targets[0], user, password,
+                                   nas_identifier, state)
+    if mode == GROUP_MODE.RACE:
+        return _race_request(targets, user, password, nas_identifier, state)
+    return _failover_request(targets, user, password, nas_identifier, state)
+
 
 class RADIUSServer(object):
     """
@@ -62,6 +347,24 @@ class RADIUSServer(object):
     def get_secret(self):
         return decryptPassword(self.config.secret)
 
+    def get_target(self):
+        """
+        Return the RADIUS server definition as used by send_access_request.
+        """
+        return RADIUSServer._config_to_target(self.config)
+
+    @staticmethod
+    def _config_to_target(config):
+        r_dict = config.dictionary or get_from_config("radius.dictfile",
+                                                      "/etc/privacyidea/"
+                                                      "dictionary")
+        return {"server": config.server,
+                "port": config.port,
+                "secret": decryptPassword(config.secret),
+                "dictionary": r_dict,
+                "timeout": config.timeout,
+                "retries": config.retries}
+
     @staticmethod
     def request(config, user, password):
         """
@@ -81,47 +384,43 @@ class RADIUSServer(object):
         :param password: the radius password
         :return: True or False. If any error occurs, an exception is raised.
         """
-        success = False
+        return RADIUSServer.request_group([config], user, password)
 
+    @staticmethod
+    def request_group(configs, user, password, mode=None):
+        """
+        Perform a RADIUS request to a group of RADIUS servers.
+
+        :param configs: list of RADIUS configurations
+        :type configs: list of RADIUSServer Database Models
+        :param user: the radius username
+        :param password: the radius password
+        :param mode: GROUP_MODE.FAILOVER or GROUP_MODE.RACE. Defaults to the
+            system setting "radius.group_mode".
+        :return: True or False
+        """
+        success = False
         nas_identifier = get_from_config("radius.nas_identifier",
                                          "privacyIDEA")
-        r_dict = config.dictionary or get_from_config("radius.dictfile",
-                                                      "/etc/privacyidea/"
-                                                      "dictionary")
+        mode = mode or get_from_config("radius.group_mode",
+                                       GROUP_MODE.FAILOVER)
+        targets = [RADIUSServer._config_to_target(c) for c in configs]
+        servers = ", ".join([t.get("server") for t in targets])
         log.debug("NAS Identifier: %r, "
-                  "Dictionary: %r" % (nas_identifier, r_dict))
-        log.debug("constructing client object "
-                  "with server: %r, port: %r, secret: %r" %
-                  (config.server, config.port, config.secret))
-
-        srv = Client(server=config.server,
-                     authport=config.port,
-                     secret=decryptPassword(config.secret),
-                     dict=Dictionary(r_dict))
-
-        # Set retries and timeout of the client
-        if config.timeout:
-            srv.timeout = config.timeout
-        if config.retries:
-            srv.retries = config.retries
-
-        req = srv.CreateAuthPacket(code=pyrad.packet.AccessRequest,
-                                   User_Name=user.encode('ascii'),
-                                   NAS_Identifier=nas_identifier.encode('ascii'))
-
-        req["User-Password"] = req.PwCrypt(password)
+                  "servers: %r, mode: %r" % (nas_identifier, servers, mode))
         try:
-            response = srv.SendPacket(req)
-
+            response = send_group_request(targets, user, password,
+                                          nas_identifier, mode=mode)
             if response.code == pyrad.packet.AccessAccept:
                 log.info("Radiusserver %s granted "
-                         "access to user %s." % (config.server, user))
+                         "access to user %s." % (servers, user))
                 success = True
             else:
                 log.warning("Radiusserver %s rejected "
-                            "access to user %s." % (config.server, user))
+                            "access to user %s." % (servers, user))
         except Timeout:
-            log.warning("Receiving timeout from remote radius server {0!s}".format(config.server))
+            log.warning("Receiving timeout from remote radius "
+                        "server {0!s}".format(servers))
 
         return success
 
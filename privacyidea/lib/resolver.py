@@ -47,7 +47,8 @@ webservice!
 import logging
 
 from .log import log_with
-from .config import (get_resolver_types, get_resolver_classes, update_config_object)
+from .config import (get_resolver_types, get_resolver_class_of_type,
+                     update_config_object)
 from privacyidea.lib.usercache import delete_user_cache
 from privacyidea.lib.framework import get_request_local_store
 from ..models import (Resolver,
@@ -317,13 +318,8 @@ def get_resolver_class(resolver_type):
                           fully qualified or abreviated
     :return: resolver object class
     """
-    ret = None
-    resolver_clazzes = get_resolver_classes()
-    for k in resolver_clazzes:
-        if k.getResolverClassType() == resolver_type:
-            ret = k
-            break
-    return ret
+    # Only the module of this resolver type is imported
+    return get_resolver_class_of_type(resolver_type)
 
 
 #@cache.memoize(10)
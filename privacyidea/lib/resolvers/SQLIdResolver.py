@@ -232,6 +232,37 @@ class IdResolver (UserIdResolver):
         info = self.getUserInfo(userId)
         return info.get('username', "")
 
+    def getUsernames(self, userids):
+        """
+        Returns the usernames of several users with one SQL query.
+
+        :param userids: The userids in this resolver
+        :type userids: list
+        :return: dict of userids and usernames
+        :rtype: dict
+        """
+        usernames = dict((userid, "") for userid in userids)
+        try:
+            conditions = []
+            column = self.map.get("userid")
+            conditions.append(getattr(self.TABLE, column).in_(list(userids)))
+            conditions = self._append_where_filter(conditions, self.TABLE,
+                                                   self.where)
+            filter_condition = and_(*conditions)
+            result = self.session.query(self.TABLE).filter(filter_condition)
+            # The userids of the rows may have another type than the
+            # requested userids
+            requested = dict(("{0!s}".format(userid), userid)
+                             for userid in userids)
+            for r in result:
+                userinfo = self._get_user_from_mapped_object(r)
+                userid = requested.get("{0!s}".format(userinfo.get("userid")))
+                if userid is not None:
+                    usernames[userid] = userinfo.get("username", "")
+        except Exception as exx:  # pragma: no cover
+            log.error("Could not get the usernames: {0!r}".format(exx))
+        return usernames
+
     def getUserId(self, LoginName):
         """
         resolve the loginname to the userid.
@@ -143,6 +143,18 @@ class UserIdResolver(object):
         """
         return "dummy_user_name"
 
+    def getUsernames(self, userids):
+        """
+        Returns the usernames of several users. Resolvers, that can look up
+        several users in one request, should overwrite this method.
+
+        :param userids: The userids in this resolver
+        :type userids: list
+        :return: dict of userids and usernames
+        :rtype: dict
+        """
+        return dict((userid, self.getUsername(userid)) for userid in userids)
+
     def getUserInfo(self, userid):
         """
         This function returns all user information for a given user object
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+#  2018-11-16 Coalesce identical concurrent authentication requests
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """RADIUS clients and PAM stacks retransmit authentication requests.
+Identical requests, which arrive at the same time, would each run the complete
+authentication and race for the token counter.
+
+The ``single_flight`` decorator executes identical concurrent calls of a
+function only once. The first call is executed, the other calls wait for the
+first call and get a copy of its result.
+
+The coalescing is configured in pi.cfg:
+
+``PI_VALIDATE_COALESCE`` enables the coalescing.
+``PI_VALIDATE_COALESCE_WINDOW`` is the number of seconds (default 0), for
+which the result of a finished call is also returned to identical calls.
+
+The calls are only coalesced within one process.
+
+This module is tested in tests/test_lib_singleflight.py
+"""
+import copy
+import functools
+import hashlib
+import hmac
+import logging
+import os
+import time
+from threading import Lock, Event
+
+from privacyidea.lib.framework import (get_app_local_store,
+                                       get_app_config_value)
+
+log = logging.getLogger(__name__)
+
+#: The number of seconds a call waits for an identical call, before it is
+#: executed itself.
+WAIT_TIMEOUT = 30
+
+
+class _Call(object):
+    """
+    A call, which is executed or was executed recently.
+    """
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.exception = None
+        self.finished = None
+
+
+class SingleFlight(object):
+    """
+    Executes identical concurrent calls only once.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+        # The credentials are not kept in memory as keys
+        self._secret = os.urandom(16)
+
+    def make_key(self, *parts):
+        """
+        Return the key of a call with the given parts.
+        """
+        data = u"\x00".join([u"{0!r}".format(part) for part in parts])
+        return hmac.new(self._secret, data.encode("utf-8"),
+                        hashlib.sha256).hexdigest()
+
+    def _expire(self, now, window):
+        for key, call in list(self._calls.items()):
+            if call.finished is not None and now - call.finished > window:
+                del self._calls[key]
+
+    def do(self, key, window, func, *args, **kwds):
+        """
+        Execute *func*, unless an identical call with the same *key* is
+        executed at the moment or finished less than *window* seconds ago.
+        In this case, return a copy of the result of this call.
+        """
+        with self._lock:
+            self._expire(time.time(), window)
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.event.wait(WAIT_TIMEOUT):
+                log.debug(u"Returning the result of an identical call.")
+                if call.exception is not None:
+                    raise call.exception
+                return copy.deepcopy(call.result)
+            log.warning(u"An identical call did not finish in time.")
+            return func(*args, **kwds)
+
+        try:
+            call.result = func(*args, **kwds)
+            return call.result
+        except Exception as exx:
+            call.exception = exx
+            raise
+        finally:
+            call.finished = time.time()
+            call.event.set()
+            if window <= 0:
+                with self._lock:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+
+
+def _key_part(arg):
+    if isinstance(arg, dict):
+        return sorted([(k, v) for k, v in arg.items() if k != "g"])
+    return arg
+
+
+def single_flight(name):
+    """
+    Decorator, which coalesces identical concurrent calls of the decorated
+    function, if ``PI_VALIDATE_COALESCE`` is set. Two calls are identical, if
+    all their arguments are equal. The request context ``g`` in the options
+    is not compared.
+
+    :param name: The name of the function, which is part of the key
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def single_flight_wrapper(*args, **kwds):
+            if not get_app_config_value("PI_VALIDATE_COALESCE", False):
+                return func(*args, **kwds)
+            parts = [name] + [_key_part(arg) for arg in args]
+            for k in sorted(kwds):
+                parts.extend([k, _key_part(kwds[k])])
+            store = get_app_local_store()
+            flights = store.get("single_flight")
+            if flights is None:
+                flights = store.setdefault("single_flight", SingleFlight())
+            window = float(get_app_config_value("PI_VALIDATE_COALESCE_WINDOW",
+                                                0))
+            return flights.do(flights.make_key(*parts), window, func,
+                              *args, **kwds)
+
+        return single_flight_wrapper
+
+    return decorator
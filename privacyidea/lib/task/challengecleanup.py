@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#  2018-11-14 Task to delete the expired challenges
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+import logging
+from privacyidea.lib.task.base import BaseTask
+from privacyidea.lib.challenge import cleanup_expired_challenges
+from privacyidea.lib.error import ParameterError
+from privacyidea.lib import _
+
+
+__doc__ = """This task module deletes the expired challenges from the
+challenge database table in chunks."""
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNKSIZE = 1000
+
+
+class ChallengeCleanupTask(BaseTask):
+    identifier = "ChallengeCleanup"
+    description = "Delete the expired challenges from the database."
+
+    @property
+    def options(self):
+        return {
+            "chunksize": {
+                "type": "str",
+                "description": _("The number of challenges to delete in one "
+                                 "transaction. Defaults to 1000.")
+            }
+        }
+
+    def do(self, params):
+        chunksize = params.get("chunksize") or DEFAULT_CHUNKSIZE
+        try:
+            chunksize = int(chunksize)
+        except ValueError:
+            raise ParameterError("The chunksize needs to be an integer.")
+        if chunksize <= 0:
+            raise ParameterError("The chunksize needs to be positive.")
+        deleted = cleanup_expired_challenges(chunksize=chunksize)
+        log.info(u"Deleted {0:d} expired challenges.".format(deleted))
+        return True
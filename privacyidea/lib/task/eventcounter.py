@@ -19,7 +19,7 @@
 import logging
 from privacyidea.lib.task.base import BaseTask
 from privacyidea.lib.monitoringstats import write_stats
-from privacyidea.lib.counter import reset, read
+from privacyidea.lib.counter import read, read_and_reset
 from privacyidea.lib.utils import is_true
 from privacyidea.lib import _
 
@@ -61,9 +61,12 @@ class EventCounterTask(BaseTask):
         stats_key = params.get("stats_key")
         reset_event_counter = params.get("reset_event_counter")
 
-        counter_value = read(event_counter)
-        if is_true(reset_event_counter) and counter_value:
-            reset(event_counter)
+        if is_true(reset_event_counter):
+            # Only subtract the read value, so that concurrent increments
+            # of the counter are not lost.
+            counter_value = read_and_reset(event_counter)
+        else:
+            counter_value = read(event_counter)
 
         # now write the current value of the counter
         if counter_value is None:
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+#  2018-11-09 Timing of the phases of a request
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """This module measures the time spent in the phases of a request
+like the before_request, the prepolicies, the authentication and the
+postpolicies.
+
+A phase is measured with the ``span`` context manager or decorator or with the
+parameter ``span`` of the ``log_with`` decorator. The durations are stored in
+the request local store.
+
+The timing is configured in pi.cfg:
+
+``PI_REQUEST_TIMING`` enables the measurement.
+``PI_REQUEST_TIMING_HEADER`` returns the durations in the ``Server-Timing``
+HTTP header.
+``PI_REQUEST_TIMING_AUDIT_RATE`` is the fraction (0.0 to 1.0) of requests,
+whose durations are written to the audit log.
+
+This module is tested in tests/test_lib_timing.py
+"""
+import functools
+import logging
+import random
+import time
+
+from flask import has_app_context
+from privacyidea.lib.framework import (get_request_local_store,
+                                       get_app_config_value)
+
+log = logging.getLogger(__name__)
+
+TIMING_KEY = "request_timing"
+TIMING_AUDIT_KEY = "request_timing_audit"
+
+
+def start_request_timing():
+    """
+    Start the timing of the current request, if it is enabled in pi.cfg.
+    This needs to be called at the beginning of the request.
+    """
+    store = get_request_local_store()
+    if get_app_config_value("PI_REQUEST_TIMING", False):
+        store[TIMING_KEY] = []
+        rate = float(get_app_config_value("PI_REQUEST_TIMING_AUDIT_RATE", 0))
+        store[TIMING_AUDIT_KEY] = rate > 0 and random.random() < rate
+    else:
+        store.pop(TIMING_KEY, None)
+
+
+def _get_timing_list():
+    if not has_app_context():
+        return None
+    return get_request_local_store().get(TIMING_KEY)
+
+
+class span(object):
+    """
+    Measure the duration of a phase of the request. This can be used as
+    context manager::
+
+        with span("check_user_pass"):
+            ...
+
+    or as decorator::
+
+        @span("check_user_pass")
+        def check_user_pass(...):
+
+    If the timing is not enabled for the request, nothing is measured.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._entry = None
+        self._start = None
+
+    def __enter__(self):
+        timings = _get_timing_list()
+        if timings is not None:
+            # The entry is added at the start, so that the phases are
+            # ordered by their start and not by their end.
+            self._entry = [self.name, 0.0]
+            timings.append(self._entry)
+            self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._entry is not None:
+            self._entry[1] = time.time() - self._start
+        return False
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def span_wrapper(*args, **kwds):
+            with span(name):
+                return func(*args, **kwds)
+
+        return span_wrapper
+
+
+def get_request_timing():
+    """
+    Return the durations of the phases of the current request in
+    milliseconds. Phases with the same name are summed up.
+
+    :return: list of tuples (phase, milliseconds) in the order of the first
+        occurrence of the phase.
+    """
+    timings = _get_timing_list() or []
+    result = []
+    durations = {}
+    for name, duration in timings:
+        if name not in durations:
+            result.append(name)
+            durations[name] = 0.0
+        durations[name] += duration
+    return [(name, durations[name] * 1000) for name in result]
+
+
+def format_timing(timings, separator=u", ", template=u"{0!s};dur={1:.1f}"):
+    """
+    Return the durations as string. By default in the format of the
+    ``Server-Timing`` header.
+    """
+    return separator.join([template.format(name, duration)
+                           for name, duration in timings])
+
+
+def log_timing_to_audit(audit_object):
+    """
+    Write the durations of the request to the audit entry, if this request
+    was chosen for the audit sampling.
+    """
+    if has_app_context() and get_request_local_store().get(TIMING_AUDIT_KEY):
+        timings = get_request_timing()
+        if timings:
+            audit_object.log({"timing": format_timing(
+                timings, separator=u",", template=u"{0!s}={1:.1f}")})
+
+
+def add_server_timing_header(response):
+    """
+    Add the durations of the request as ``Server-Timing`` header to the
+    response, if this is configured.
+    """
+    if get_app_config_value("PI_REQUEST_TIMING_HEADER", False):
+        timings = get_request_timing()
+        if timings:
+            response.headers["Server-Timing"] = format_timing(timings)
+    return response
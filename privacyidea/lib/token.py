@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 #  privacyIDEA is a fork of LinOTP
 #
+#  2018-11-20 Read tokens in chunks, remove and disable tokens in bulk
+#  2018-11-20 Import tokens in batches
+#  2018-11-19 Clear the cached machine auth items, if tokens change
+#  2018-11-16 Coalesce identical concurrent authentication requests
 #  2018-12-10 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add Base58
 #  2018-01-21 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -69,21 +73,24 @@ import logging
 from six import string_types
 
 from sqlalchemy import (and_, func)
+from sqlalchemy.orm import subqueryload, joinedload
 from privacyidea.lib.error import (TokenAdminError,
                                    ParameterError,
                                    privacyIDEAError, ResourceNotFoundError)
 from privacyidea.lib.decorators import (check_user_or_serial,
                                         check_copy_serials)
 from privacyidea.lib.tokenclass import TokenClass
-from privacyidea.lib.utils import generate_password, is_true, BASE58
+from privacyidea.lib.utils import (generate_password, is_true, BASE58,
+                                   convert_column_to_unicode)
 from privacyidea.lib.log import log_with
 from privacyidea.models import (Token, Realm, TokenRealm, Challenge,
-                                MachineToken, TokenInfo)
+                                MachineToken, TokenInfo, db,
+                                single_transaction)
 from privacyidea.lib.config import get_from_config
 from privacyidea.lib.config import (get_token_class, get_token_prefix,
-                                    get_token_types,
+                                    get_token_types, get_token_class_info,
                                     get_inc_fail_count_on_false_pin)
-from privacyidea.lib.user import get_user_info, User
+from privacyidea.lib.user import get_user_info, get_usernames, User
 from privacyidea.lib import _
 from privacyidea.lib.realm import realm_is_defined
 from privacyidea.lib.resolver import get_resolver_object
@@ -99,6 +106,8 @@ from privacyidea.lib.policydecorators import (libpolicy,
 from privacyidea.lib.tokenclass import DATE_FORMAT
 from privacyidea.lib.tokenclass import TOKENKIND
 from dateutil.tz import tzlocal
+from privacyidea.lib.timing import span
+from privacyidea.lib.singleflight import single_flight
 
 log = logging.getLogger(__name__)
 
@@ -108,6 +117,16 @@ required = False
 ENCODING = "utf-8"
 
 
+def _invalidate_auth_items():
+    """
+    Clear the cached authentication items of the machines, since the
+    tokens have changed.
+    """
+    # lib/machine.py imports this module
+    from privacyidea.lib.machine import invalidate_auth_items
+    invalidate_auth_items()
+
+
 @log_with(log)
 def create_tokenclass_object(db_token):
     """
@@ -140,13 +159,21 @@ def create_tokenclass_object(db_token):
 def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
                         serial_exact=None, serial_wildcard=None, active=None, resolver=None,
                         rollout_state=None, description=None, revoked=None,
-                        locked=None, userid=None, tokeninfo=None, maxfail=None):
+                        locked=None, userid=None, tokeninfo=None, maxfail=None,
+                        eager_load=False):
     """
     This function create the sql query for getting tokens. It is used by
     get_tokens and get_tokens_paginate.
+
+    :param eager_load: Load the tokeninfo and the realms of all tokens with
+        one additional query each instead of one query per token.
     :return: An SQLAlchemy sql query
     """
     sql_query = Token.query
+    if eager_load:
+        sql_query = sql_query.options(
+            subqueryload(Token.info_list),
+            subqueryload(Token.realm_list).joinedload(TokenRealm.realm))
     if user is not None and not user.is_empty():
         # extract the realm from the user object:
         realm = user.realm
@@ -277,7 +304,7 @@ def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
 def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
                serial=None, serial_wildcard=None, active=None, resolver=None, rollout_state=None,
                count=False, revoked=None, locked=None, tokeninfo=None,
-               maxfail=None, psize=None, page=1):
+               maxfail=None, psize=None, page=1, eager_load=False):
     """
     (was getTokensOfType)
     This function returns a list of token objects of a
@@ -328,6 +355,10 @@ def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
     :type psize: int
     :param page: If pagination is used, this is the page to get
     :type page: int
+    :param eager_load: Load the tokeninfo and the realms of all returned
+        tokens in advance. This saves queries, if the tokeninfo or the
+        realms of many tokens are read.
+    :type eager_load: bool
 
     :return: A list of tokenclasses (lib.tokenclass).
         In case of pagination a tuple of count, prev, next, token_list
@@ -340,7 +371,8 @@ def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
                                     active=active, resolver=resolver,
                                     rollout_state=rollout_state,
                                     revoked=revoked, locked=locked,
-                                    tokeninfo=tokeninfo, maxfail=maxfail)
+                                    tokeninfo=tokeninfo, maxfail=maxfail,
+                                    eager_load=eager_load and count is not True)
 
     # Warning for unintentional exact serial matches
     if serial is not None and "*" in serial:
@@ -429,7 +461,8 @@ def get_tokens_paginate(tokentype=None, realm=None, assigned=None, user=None,
                                 serial_wildcard=serial, active=active,
                                 resolver=resolver,
                                 rollout_state=rollout_state,
-                                description=description, userid=userid)
+                                description=description, userid=userid,
+                                eager_load=True)
 
     if isinstance(sortby, string_types):
         # convert the string to a Token column
@@ -450,27 +483,53 @@ def get_tokens_paginate(tokentype=None, realm=None, assigned=None, user=None,
     next = None
     if pagination.has_next:
         next = page + 1
+    # Resolve the owners of all tokens with one request per resolver
+    owners = {}
+    for token in tokens:
+        if token.user_id and token.resolver:
+            owners.setdefault(token.resolver, set()).add(token.user_id)
+    usernames = {}
+    for resolvername, userids in owners.items():
+        try:
+            usernames[resolvername] = (get_usernames(list(userids),
+                                                     resolvername),
+                                       get_resolver_object(
+                                           resolvername).editable)
+        except Exception as exx:
+            # The users of this resolver are resolved per token below
+            log.warning("Could not resolve the token owners of resolver "
+                        "{0!s}: {1!s}".format(resolvername, exx))
+
     token_list = []
     for token in tokens:
         tokenobject = create_tokenclass_object(token)
         if isinstance(tokenobject, TokenClass):
             token_dict = tokenobject.get_as_dict()
             # add user information
-            # In certain cases the LDAP or SQL server might not be reachable.
-            # Then an exception is raised
             token_dict["username"] = ""
             token_dict["user_realm"] = ""
-            try:
-                userobject = tokenobject.user
-                if userobject:
-                    token_dict["username"] = userobject.login
-                    token_dict["user_realm"] = userobject.realm
-                    token_dict["user_editable"] = get_resolver_object(
-                        userobject.resolver).editable
-            except Exception as exx:
-                log.error("User information can not be retrieved: {0!s}".format(exx))
-                log.debug(traceback.format_exc())
-                token_dict["username"] = "**resolver error**"
+            if token.resolver in usernames:
+                resolver_users, editable = usernames[token.resolver]
+                username = resolver_users.get(token.user_id)
+                # FIXME: What if the token has more than one realm assigned?
+                if username and len(token_dict["realms"]) == 1:
+                    token_dict["username"] = username
+                    token_dict["user_realm"] = token_dict["realms"][0]
+                    token_dict["user_editable"] = editable
+            elif token.user_id and token.resolver:
+                # In certain cases the LDAP or SQL server might not be
+                # reachable. Then an exception is raised
+                try:
+                    userobject = tokenobject.user
+                    if userobject:
+                        token_dict["username"] = userobject.login
+                        token_dict["user_realm"] = userobject.realm
+                        token_dict["user_editable"] = get_resolver_object(
+                            userobject.resolver).editable
+                except Exception as exx:
+                    log.error("User information can not be retrieved: {0!s}".format(exx))
+                    log.debug(traceback.format_exc())
+                    token_dict["username"] = "**resolver error**"
 
             token_list.append(token_dict)
 
@@ -482,6 +541,170 @@ def get_tokens_paginate(tokentype=None, realm=None, assigned=None, user=None,
     return ret
 
 
+def get_tokens_chunked(chunksize=1000, tokeninfo_keys=None, **kwargs):
+    """
+    Iterate over all tokens, that match the filters, in chunks. This is used
+    to process a huge number of tokens like in the token janitor.
+
+    The chunks are read by the id of the tokens and not by an offset. Thus
+    tokens, which are deleted or changed while processing a chunk, do not
+    shift the following chunks. The tokeninfo and the realms of each chunk
+    are loaded with one query each.
+
+    :param chunksize: The number of tokens per chunk
+    :type chunksize: int
+    :param tokeninfo_keys: Only return tokens, which have all of these
+        tokeninfo keys
+    :type tokeninfo_keys: list
+    :param kwargs: The filters like tokentype, active or assigned of
+        ``get_tokens``. The serial is given as serial_exact.
+    :return: generator of lists of token objects
+    """
+    last_id = 0
+    while True:
+        sql_query = _create_token_query(eager_load=True, **kwargs)
+        for key in tokeninfo_keys or []:
+            sql_query = sql_query.filter(Token.info_list.any(TokenInfo.Key == key))
+        db_tokens = sql_query.filter(Token.id > last_id).order_by(
+            Token.id).limit(chunksize).all()
+        if not db_tokens:
+            return
+        last_id = db_tokens[-1].id
+        tokenobj_list = []
+        for db_token in db_tokens:
+            tokenobject = create_tokenclass_object(db_token)
+            if isinstance(tokenobject, TokenClass):
+                tokenobj_list.append(tokenobject)
+        yield tokenobj_list
+
+
+def get_orphaned_tokens(tokenobj_list):
+    """
+    Return the orphaned tokens of the list. The owners are resolved with one
+    request per resolver instead of one request per token like
+    TokenClass.is_orphaned.
+
+    :param tokenobj_list: list of token objects
+    :return: list of the orphaned token objects
+    """
+    owners = {}
+    for tokenobject in tokenobj_list:
+        if tokenobject.token.user_id and tokenobject.token.resolver:
+            owners.setdefault(tokenobject.token.resolver, set()).add(
+                tokenobject.token.user_id)
+    usernames = {}
+    for resolvername, userids in owners.items():
+        try:
+            usernames[resolvername] = get_usernames(list(userids), resolvername)
+        except Exception as exx:
+            # The owners of this resolver are resolved per token below
+            log.warning("Could not resolve the token owners of resolver "
+                        "{0!s}: {1!s}".format(resolvername, exx))
+
+    orphaned = []
+    for tokenobject in tokenobj_list:
+        token = tokenobject.token
+        if not token.user_id:
+            continue
+        if token.resolver in usernames:
+            username = usernames[token.resolver].get(token.user_id)
+            # Like TokenClass.user the owner needs exactly one realm
+            if not username or len(token.realm_list) != 1:
+                orphaned.append(tokenobject)
+        elif tokenobject.is_orphaned():
+            orphaned.append(tokenobject)
+    return orphaned
+
+
+def enable_tokens(serials, enable=True):
+    """
+    Enable or disable all tokens of the list with one statement.
+
+    :param serials: The serial numbers of the tokens
+    :type serials: list
+    :param enable: False if the tokens should be disabled
+    :return: Number of tokens that were enabled/disabled
+    """
+    count = 0
+    if serials:
+        count = Token.query.filter(Token.serial.in_(serials),
+                                   Token.active != enable).update(
+            {"active": enable}, synchronize_session=False)
+        db.session.commit()
+        _invalidate_auth_items()
+    return count
+
+
+def remove_tokens(serials):
+    """
+    Remove all tokens of the list with their challenges, machine
+    attachments, realms and tokeninfo with one statement per table.
+
+    :param serials: The serial numbers of the tokens
+    :type serials: list
+    :return: The number of deleted tokens
+    """
+    count = 0
+    if serials:
+        token_ids = [token_id for (token_id,) in db.session.query(
+            Token.id).filter(Token.serial.in_(serials))]
+        if token_ids:
+            Challenge.query.filter(Challenge.serial.in_(serials)).delete(
+                synchronize_session=False)
+            for table in [MachineToken, TokenRealm, TokenInfo]:
+                table.query.filter(table.token_id.in_(token_ids)).delete(
+                    synchronize_session=False)
+            count = Token.query.filter(Token.id.in_(token_ids)).delete(
+                synchronize_session=False)
+            db.session.commit()
+            _invalidate_auth_items()
+    return count
+
+
+def mark_tokens(serials, description=None, tokeninfo_key=None,
+                tokeninfo_value=None):
+    """
+    Set the description and a tokeninfo of all tokens of the list with one
+    statement per change. The tokeninfo is updated for the tokens, which
+    already have the key, and inserted for the other tokens.
+
+    :param serials: The serial numbers of the tokens
+    :type serials: list
+    :param description: The new description of the tokens or None
+    :param tokeninfo_key: The key of the tokeninfo or None
+    :param tokeninfo_value: The value of the tokeninfo
+    :return: The number of marked tokens
+    """
+    count = 0
+    if serials:
+        token_ids = [token_id for (token_id,) in db.session.query(
+            Token.id).filter(Token.serial.in_(serials))]
+        if token_ids:
+            if description is not None:
+                Token.query.filter(Token.id.in_(token_ids)).update(
+                    {"description": convert_column_to_unicode(description)},
+                    synchronize_session=False)
+            if tokeninfo_key:
+                value = convert_column_to_unicode(tokeninfo_value)
+                existing = set([token_id for (token_id,) in db.session.query(
+                    TokenInfo.token_id).filter(
+                        TokenInfo.token_id.in_(token_ids),
+                        TokenInfo.Key == tokeninfo_key)])
+                if existing:
+                    TokenInfo.query.filter(
+                        TokenInfo.token_id.in_(existing),
+                        TokenInfo.Key == tokeninfo_key).update(
+                        {"Value": value}, synchronize_session=False)
+                db.session.bulk_insert_mappings(TokenInfo, [
+                    {"token_id": token_id, "Key": tokeninfo_key,
+                     "Value": value, "Type": u"", "Description": u""}
+                    for token_id in token_ids if token_id not in existing])
+            db.session.commit()
+            _invalidate_auth_items()
+            count = len(token_ids)
+    return count
+
+
 def get_one_token(*args, **kwargs):
     """
     Fetch exactly one token according to the given filter arguments, which are passed to
@@ -694,12 +917,7 @@ def get_tokenclass_info(tokentype, section=None):
     :return: dict - if nothing found an empty dict
     :rtype:  dict
     """
-    res = {}
-    Tokenclass = get_token_class(tokentype)
-    if Tokenclass:
-        res = Tokenclass.get_class_info(section)
-
-    return res
+    return get_token_class_info(tokentype, section)
 
 
 @log_with(log)
@@ -944,6 +1162,155 @@ def import_token(serial, token_dict, default_hashlib=None, tokenrealms=None):
     return token
 
 
+#: The token types, which import_tokens writes to the database directly
+BULK_IMPORT_TYPES = ["hotp", "totp"]
+
+
+def _bulk_import_token(serial, token_dict, default_hashlib, defaults):
+    """
+    Create the database token and the tokeninfo of a new HOTP or TOTP token
+    like import_token.
+
+    :return: tuple of the database token and the tokeninfo dictionary
+    """
+    tokentype = (token_dict.get("type") or "hotp").lower()
+    db_token = Token(serial, tokentype=tokentype,
+                     otpkey=token_dict.get("otpkey"))
+    db_token.count_window = defaults["count_window"]
+    db_token.maxfail = defaults["maxfail"]
+    db_token.sync_window = defaults["sync_window"]
+    db_token.otplen = int(token_dict.get("otplen") or defaults["otplen"])
+    description = token_dict.get("description", "imported")
+    if description is not None:
+        db_token.set_description(description)
+    if token_dict.get("counter"):
+        db_token.count = int(token_dict.get("counter"))
+
+    hashlib = token_dict.get("hashlib")
+    if default_hashlib and default_hashlib != "auto":
+        hashlib = default_hashlib
+    tokeninfo = {"hashlib": hashlib or get_from_config(
+                     "{0!s}.hashlib".format(tokentype), u'sha1'),
+                 "tokenkind": TOKENKIND.HARDWARE}
+    if tokentype == "totp":
+        tokeninfo["timeStep"] = token_dict.get("timeStep") or int(
+            get_from_config("totp.timeStep") or 30)
+        tokeninfo["timeWindow"] = int(get_from_config("totp.timeWindow")
+                                      or 180)
+        tokeninfo["timeShift"] = token_dict.get("timeShift") or 0.0
+    return db_token, tokeninfo
+
+
+def _import_token_batch(batch, tokenrealms, realm_ids, default_hashlib,
+                         defaults):
+    """
+    Import a list of tokens. New HOTP and TOTP tokens without a user are
+    inserted with one statement per table, all other tokens are imported by
+    import_token.
+    """
+    serials = [serial for serial, _token_dict in batch]
+    existing = set(serial for (serial,) in db.session.query(Token.serial)
+                   .filter(Token.serial.in_(serials)))
+    single_tokens = []
+    db_tokens = []
+    tokeninfos = []
+    for serial, token_dict in batch:
+        if serial in existing or token_dict.get("user") or \
+                not token_dict.get("otpkey") or \
+                (token_dict.get("type") or "hotp").lower() not in \
+                BULK_IMPORT_TYPES:
+            single_tokens.append((serial, token_dict))
+        else:
+            # The serial is imported again later in the same batch
+            existing.add(serial)
+            db_token, tokeninfo = _bulk_import_token(serial, token_dict,
+                                                     default_hashlib,
+                                                     defaults)
+            db_tokens.append(db_token)
+            tokeninfos.append(tokeninfo)
+
+    if db_tokens:
+        db.session.add_all(db_tokens)
+        # The tokens get their ids
+        db.session.flush()
+        db.session.bulk_insert_mappings(TokenInfo, [
+            {"token_id": db_token.id, "Key": key,
+             "Value": convert_column_to_unicode(value)}
+            for db_token, tokeninfo in zip(db_tokens, tokeninfos)
+            for key, value in tokeninfo.items()])
+        db.session.bulk_insert_mappings(TokenRealm, [
+            {"token_id": db_token.id, "realm_id": realm_id}
+            for db_token in db_tokens for realm_id in realm_ids])
+        db.session.commit()
+
+    for serial, token_dict in single_tokens:
+        import_token(serial, token_dict, default_hashlib=default_hashlib,
+                     tokenrealms=tokenrealms)
+
+
+def import_tokens(tokens, tokenrealms=None, default_hashlib=None,
+                  batch_size=500, progress=None):
+    """
+    Import many tokens from an import file. The new HOTP and TOTP tokens are
+    written to the database in batches, which is much faster than importing
+    each token with import_token. Existing tokens, tokens with a user and
+    other token types are imported by import_token.
+
+    Each batch is committed on its own, so the import is not atomic. If the
+    import fails, the tokens of the batches before stay imported and the
+    TokenAdminError tells their number.
+
+    :param tokens: The tokens like returned by the import parsers
+    :type tokens: iterable of tuples (serial, token_dict)
+    :param tokenrealms: The realms of the tokens
+    :type tokenrealms: list
+    :param default_hashlib: The hashlib, which overrides the hashlib of the
+        tokens, if it is not "auto"
+    :param batch_size: The number of tokens, that are written at once
+    :param progress: This function is called with the number of imported
+        tokens after each batch
+    :return: The list of the imported serials
+    """
+    tokenrealms = tokenrealms or []
+    # Realms, which are not defined, are ignored like in set_realms
+    realm_ids = [realm.id for realm in
+                 Realm.query.filter(Realm.name.in_(tokenrealms))]
+    defaults = {"otplen": int(get_from_config("DefaultOtpLen") or 6),
+                "count_window": int(get_from_config("DefaultCountWindow")
+                                    or 10),
+                "maxfail": int(get_from_config("DefaultMaxFailCount") or 10),
+                "sync_window": int(get_from_config("DefaultSyncWindow")
+                                   or 1000)}
+    serials = []
+    batch = []
+    try:
+        for serial, token_dict in tokens:
+            batch.append((serial, token_dict))
+            if len(batch) >= batch_size:
+                _import_token_batch(batch, tokenrealms, realm_ids,
+                                    default_hashlib, defaults)
+                serials.extend(serial for serial, _token_dict in batch)
+                batch = []
+                if progress:
+                    progress(len(serials))
+        if batch:
+            _import_token_batch(batch, tokenrealms, realm_ids,
+                                default_hashlib, defaults)
+            serials.extend(serial for serial, _token_dict in batch)
+            if progress:
+                progress(len(serials))
+    except Exception as exx:
+        db.session.rollback()
+        log.error(u"The token import failed after {0:d} tokens: "
+                  u"{1!s}".format(len(set(serials)), exx))
+        raise TokenAdminError(u"The token import failed after {0:d} tokens "
+                              u"were imported: {1!s}".format(
+                                  len(set(serials)), exx))
+    finally:
+        _invalidate_auth_items()
+    return serials
+
+
 @log_with(log)
 def init_token(param, user=None, tokenrealms=None,
                tokenkind=None):
@@ -1052,6 +1419,7 @@ def init_token(param, user=None, tokenrealms=None,
         set_validity_period_end(serial, user, validity_period_end)
     if validity_period_start:
         set_validity_period_start(serial, user, validity_period_start)
+    _invalidate_auth_items()
 
     return tokenobject
 
@@ -1092,6 +1460,7 @@ def remove_token(serial=None, user=None):
                                 tokenobject.token.id).delete()
 
         tokenobject.token.delete()
+    _invalidate_auth_items()
 
     return token_count
 
@@ -1125,6 +1494,7 @@ def set_realms(serial, realms=None, add=False):
     tokenobject = get_one_token(serial=serial)
     tokenobject.set_realms(corrected_realms, add=add)
     tokenobject.save()
+    _invalidate_auth_items()
 
 
 @log_with(log)
@@ -1185,6 +1555,7 @@ def assign_token(serial, user, pin=None, encrypt_pin=False, err_message=None):
 
     log.debug("successfully assigned token with serial "
               "{0!r} to user {1!r}".format(serial, user))
+    _invalidate_auth_items()
     return True
 
 
@@ -1213,6 +1584,7 @@ def unassign_token(serial, user=None):
             raise TokenAdminError("Token unassign failed for {0!r}/{1!r}: {2!r}".format(serial, user, e), id=1105)
 
         log.debug("successfully unassigned token with serial {0!r}".format(tokenobject))
+    _invalidate_auth_items()
     # TODO: test with more than 1 token
     return len(tokenobject_list)
 
@@ -1360,6 +1732,7 @@ def revoke_token(serial, user=None):
     for tokenobject in tokenobject_list:
         tokenobject.revoke()
         tokenobject.save()
+    _invalidate_auth_items()
 
     return len(tokenobject_list)
 
@@ -1392,6 +1765,7 @@ def enable_token(serial, enable=True, user=None):
             tokenobject.enable(enable)
             tokenobject.save()
             count += 1
+    _invalidate_auth_items()
 
     return count
 
@@ -1531,6 +1905,7 @@ def add_tokeninfo(serial, info, value=None,
     for tokenobject in tokenobject_list:
         tokenobject.add_tokeninfo(info, value)
         tokenobject.save()
+    _invalidate_auth_items()
 
     return len(tokenobject_list)
 
@@ -1555,6 +1930,7 @@ def delete_tokeninfo(serial, key, user=None):
     for tokenobject in tokenobject_list:
         tokenobject.del_tokeninfo(key)
         tokenobject.save()
+    _invalidate_auth_items()
 
     return len(tokenobject_list)
 
@@ -1763,6 +2139,7 @@ def copy_token_user(serial_from, serial_to):
                                                 resolver_type)
     copy_token_realms(serial_from, serial_to)
     tokenobject_to.save()
+    _invalidate_auth_items()
     return True
 
 @check_copy_serials
@@ -1898,7 +2275,8 @@ def check_realm_pass(realm, passw, options=None):
     return res, reply_dict
 
 
-@log_with(log)
+@single_flight("check_serial_pass")
+@log_with(log, span="check_serial_pass")
 @libpolicy(auth_lastauth)
 def check_serial_pass(serial, passw, options=None):
     """
@@ -1943,6 +2321,8 @@ def check_otp(serial, otpval):
     return res, reply_dict
 
 
+@span("check_user_pass")
+@single_flight("check_user_pass")
 @libpolicy(auth_cache)
 @libpolicy(auth_user_does_not_exist)
 @libpolicy(auth_user_has_no_token)
@@ -1981,7 +2361,7 @@ def check_user_pass(user, passw, options=None):
     return res, reply_dict
 
 
-@log_with(log)
+@log_with(log, span="check_token_list")
 def check_token_list(tokenobject_list, passw, user=None, options=None):
     """
     this takes a list of token objects and tries to find the matching token
@@ -1993,6 +2373,12 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
     This function is called by check_serial_pass, check_user_pass and
     check_yubikey_pass.
 
+    The counters, fail counters and token infos of the tokens are written
+    in one transaction. Messages like the AutoSMS and the cleanup of the
+    expired challenges follow after its commit. Only the SMS and email
+    challenges commit the increased counter before they are sent, since the
+    gateway must not hold the lock of the token.
+
     :param tokenobject_list: list of identified tokens
     :param passw: the provided passw (mostly pin+otp)
     :param user: the identified use - as class object
@@ -2001,6 +2387,12 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
     :return: tuple of success and optional response
     :rtype: (bool, dict)
     """
+    with single_transaction():
+        return _check_token_list(tokenobject_list, passw, user=user,
+                                 options=options)
+
+
+def _check_token_list(tokenobject_list, passw, user=None, options=None):
     res = False
     reply_dict = {}
     increase_auth_counters = not is_true(get_from_config(key="no_auth_counter"))
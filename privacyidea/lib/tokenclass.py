@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Increase the OTP counter by compare and set
+#  2018-11-20 Read the token info without building a new dictionary
+#  2018-11-14 Rate limit the challenge janitor
 #  2018-01-21 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Implement tokenkind. Token can be hardware, software or virtual
 #  2017-07-08 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -90,8 +93,9 @@ from .config import (get_from_config, get_prepend_pin)
 from .utils import create_img
 from .user import (User,
                    get_username)
-from ..models import (TokenRealm, Challenge, cleanup_challenges)
-from .challenge import get_challenges
+from sqlalchemy.orm.attributes import set_committed_value
+from ..models import (TokenRealm, Challenge, Token, db, after_transaction)
+from .challenge import get_challenges, cleanup_expired_challenges_limited
 from .crypto import encryptPassword
 from .crypto import decryptPassword
 from .policydecorators import libpolicy, auth_otppin, challenge_response_allowed
@@ -163,7 +167,8 @@ class TokenClass(object):
         """
         tokentype = u'' + tokentype
         self.type = tokentype
-        self.token.tokentype = tokentype
+        if self.token.tokentype != tokentype:
+            self.token.tokentype = tokentype
 
     @staticmethod
     def get_class_type():
@@ -712,6 +717,37 @@ class TokenClass(object):
         self.token.count = int(otpCount)
         self.token.save()
 
+    @check_token_locked
+    def set_otp_count_if_higher(self, otpCount):
+        """
+        Set the OTP counter, if the counter in the database is still lower.
+        The counter is compared and set in one UPDATE statement without
+        locking the token. If two requests with the same OTP value are
+        processed concurrently, only one of them can set the counter.
+
+        :param otpCount: The new counter
+        :type otpCount: int
+        :return: True, if the counter was set. False, if a concurrent
+            request already set the counter.
+        """
+        otpCount = int(otpCount)
+        if not self.token.id:
+            self.token.count = otpCount
+            return True
+        # Write pending changes of the token before the UPDATE
+        db.session.flush()
+        updated = Token.query.filter(
+            Token.id == self.token.id,
+            Token.count < otpCount).update({"count": otpCount},
+                                           synchronize_session=False)
+        if not updated:
+            log.warning(u"The counter of the token {0!s} was already set to "
+                        u"{1!s}.".format(self.token.serial, otpCount))
+            db.session.expire(self.token, ["count"])
+            return False
+        set_committed_value(self.token, "count", otpCount)
+        return True
+
     @check_token_locked
     def set_pin(self, pin, encrypt=False):
         """
@@ -853,14 +889,13 @@ class TokenClass(object):
         :return: the value for the key
         :rtype: int or string
         """
-        tokeninfo = self.token.get_info()
         if key:
-            ret = tokeninfo.get(key, default)
-            if tokeninfo.get(key + ".type") == "password":
+            ret = self.token.get_info_value(key, default)
+            if self.token.get_info_value(key + ".type") == "password":
                 # we need to decrypt the return value
                 ret = decryptPassword(ret)
         else:
-            ret = tokeninfo
+            ret = self.token.get_info()
         return ret
 
     def del_tokeninfo(self, key=None):
@@ -1151,6 +1186,10 @@ class TokenClass(object):
         Before increasing the token.count the token.count can be set using the
         parameter counter.
 
+        The counter is only increased, if it is still lower than the new
+        value in the database. Thus only one of several concurrent requests
+        with the same OTP value can increase the counter.
+
         :param counter: if given, the token counter is first set to counter and then
                 increased by increment
         :type counter: int
@@ -1158,13 +1197,13 @@ class TokenClass(object):
         :type increment: int
         :param reset: reset the failcounter if set to True
         :type reset: bool
-        :return: the new counter value
+        :return: the new counter value or -1, if a concurrent request already
+            increased the counter to this value
         """
         reset_counter = False
-        if counter:
-            self.token.count = counter
-
-        self.token.count += increment
+        new_count = (counter or self.token.count) + increment
+        if not self.set_otp_count_if_higher(new_count):
+            return -1
 
         if reset is True and get_from_config("DefaultResetFailCount") == "True":
             reset_counter = True
@@ -1173,9 +1212,10 @@ class TokenClass(object):
             self.token.maxfail):
             self.set_failcount(0)
 
-        # make DB persistent immediately, to avoid the re-usage of the counter
+        # Within the transaction of an authentication the token is committed
+        # at the end of the authentication
         self.token.save()
-        return self.token.count
+        return new_count
 
     def check_otp_exist(self, otp, window=None):
         """
@@ -1450,10 +1490,14 @@ class TokenClass(object):
     def challenge_janitor():
         """
         Just clean up all challenges, for which the expiration has expired.
+        To keep the challenge table off the hot path, this only happens once
+        in ``PI_CHALLENGE_CLEANUP_INTERVAL`` seconds per process.
+        The cleanup commits on its own, so within ``single_transaction`` it
+        is done after the commit of the authentication.
 
         :return: None
         """
-        cleanup_challenges()
+        after_transaction(cleanup_expired_challenges_limited)
 
     def create_challenge(self, transactionid=None, options=None):
         """
@@ -75,7 +75,8 @@ from privacyidea.lib.utils import is_true
 from privacyidea.lib.policy import (SCOPE, ACTION, get_action_values_from_options)
 from privacyidea.lib.log import log_with
 from privacyidea.lib import _
-from privacyidea.models import Challenge
+from privacyidea.models import (Challenge, after_transaction,
+                                commit_before_call)
 from privacyidea.lib.decorators import check_token_locked
 from privacyidea.lib.smtpserver import send_email_data, send_email_identifier
 
@@ -278,6 +279,9 @@ class EmailTokenClass(HotpTokenClass):
                 db_challenge.save()
                 transactionid = transactionid or db_challenge.transaction_id
                 # We send the email after creating the challenge for testing.
+                # The mail server must not hold the lock of the increased
+                # counter.
+                commit_before_call()
                 success, sent_message = self._compose_email(
                     message=message_template,
                     subject=subject_template,
@@ -318,14 +322,20 @@ class EmailTokenClass(HotpTokenClass):
             subject, _ = self._get_email_text_or_subject(options,
                                                       action=EMAILACTION.EMAILSUBJECT,
                                                       default="Your OTP")
-            self.inc_otp_counter(ret, reset=False)
-            success, message = self._compose_email(message=message,
-                                                   subject=subject,
-                                                   mimetype=mimetype)
-            log.debug("AutoEmail: send new SMS: {0!s}".format(success))
-            log.debug("AutoEmail: {0!r}".format(message))
+            # HotpTokenClass.check_otp already increased the counter. The
+            # email is sent after the commit of the counter, so that the mail
+            # server does not hold the lock of the token.
+            after_transaction(self._send_auto_email, message, subject,
+                              mimetype)
         return ret
 
+    def _send_auto_email(self, message, subject, mimetype):
+        success, message = self._compose_email(message=message,
+                                               subject=subject,
+                                               mimetype=mimetype)
+        log.debug("AutoEmail: send new SMS: {0!s}".format(success))
+        log.debug("AutoEmail: {0!r}".format(message))
+
     @staticmethod
     def _get_email_text_or_subject(options,
                                    action=EMAILACTION.EMAILTEXT,
@@ -5,6 +5,7 @@
 #  License: AGPLv3
 #  contact: http://www.privacyidea.org
 #
+#  2018-11-20 Only set the counter, if no concurrent request set it
 #  2018-06-06 Michael Becker <michael.becker@hs-niederrhein.de>
 #             Add get_setting_type to make hotp.hashlib public and
 #             therefore recognised in token enrollment with role user.
@@ -402,11 +403,12 @@ class HotpTokenClass(TokenClass):
 
         if res == -1:
             res = self._autosync(hmac2Otp, anOtpVal)
-        if res != -1:
-            # on success, we save the counter
-            self.set_otp_count(res + 1)
-            # We could also store it temporarily
-            # self.auth_details["matched_otp_counter"] = res
+        if res != -1 and not self.set_otp_count_if_higher(res + 1):
+            # A concurrent request with the same OTP value already
+            # increased the counter
+            res = -1
+        # We could also store it temporarily
+        # self.auth_details["matched_otp_counter"] = res
 
         return res
 
@@ -566,8 +568,7 @@ class HotpTokenClass(TokenClass):
                       "%r != otp2: %r ret: %r" % (nextOtp, otp2, ret))
             return ret
 
-        ret = True
-        self.inc_otp_counter(counter + 1, reset=True)
+        ret = self.inc_otp_counter(counter + 1, reset=True) >= 0
 
         log.debug("end. resync was successful: ret: {0!r}".format((ret)))
         return ret
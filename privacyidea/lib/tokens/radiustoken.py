@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-10-18 Allow a comma separated list of RADIUS identifiers, that are
+#             queried as a group. Reuse the client sockets.
 #  2018-01-21 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add tokenkind
 #  2016-02-22 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -52,11 +54,10 @@ from privacyidea.api.lib.utils import getParam, ParameterError
 from privacyidea.lib.log import log_with
 from privacyidea.lib.config import get_from_config
 from privacyidea.lib.decorators import check_token_locked
-from privacyidea.lib.radiusserver import get_radius
+from privacyidea.lib.radiusserver import (get_radius, send_group_request,
+                                          GROUP_MODE)
 
 import pyrad.packet
-from pyrad.client import Client
-from pyrad.dictionary import Dictionary
 from privacyidea.lib import _
 
 
@@ -188,18 +189,17 @@ class RadiusTokenClass(RemoteTokenClass):
         otp_count = -1
         options = options or {}
 
-        radius_dictionary = None
+        radius_targets = []
         radius_identifier = self.get_tokeninfo("radius.identifier")
         radius_user = self.get_tokeninfo("radius.user")
         system_radius_settings = self.get_tokeninfo("radius.system_settings")
         if radius_identifier:
-            # New configuration
-            radius_server_object = get_radius(radius_identifier)
-            radius_server = radius_server_object.config.server
-            radius_port = radius_server_object.config.port
-            radius_server = "{0!s}:{1!s}".format(radius_server, radius_port)
-            radius_secret = radius_server_object.get_secret()
-            radius_dictionary = radius_server_object.config.dictionary
+            # New configuration. Several identifiers form a group of servers.
+            for identifier in radius_identifier.split(","):
+                radius_server_object = get_radius(identifier.strip())
+                radius_targets.append(radius_server_object.get_target())
+            radius_server = ", ".join([t.get("server") for t in
+                                       radius_targets])
 
         elif system_radius_settings:
             # system configuration
@@ -220,40 +220,32 @@ class RadiusTokenClass(RemoteTokenClass):
         try:
             # pyrad does not allow to set timeout and retries.
             # it defaults to retries=3, timeout=5
-
-            # TODO: At the moment we support only one radius server.
-            # No round robin.
-            server = radius_server.split(':')
-            r_server = server[0]
-            r_authport = 1812
-            if len(server) >= 2:
-                r_authport = int(server[1])
             nas_identifier = get_from_config("radius.nas_identifier",
                                              "privacyIDEA")
-            if not radius_dictionary:
+            if not radius_targets:
+                server = radius_server.split(':')
+                r_server = server[0]
+                r_authport = 1812
+                if len(server) >= 2:
+                    r_authport = int(server[1])
                 radius_dictionary = get_from_config("radius.dictfile",
                                                     "/etc/privacyidea/"
                                                     "dictionary")
-            log.debug("NAS Identifier: %r, "
-                      "Dictionary: %r" % (nas_identifier, radius_dictionary))
-            log.debug("constructing client object "
-                      "with server: %r, port: %r, secret: %r" %
-                      (r_server, r_authport, radius_secret))
-
-            srv = Client(server=r_server,
-                         authport=r_authport,
-                         secret=radius_secret,
-                         dict=Dictionary(radius_dictionary))
-
-            req = srv.CreateAuthPacket(code=pyrad.packet.AccessRequest,
-                                       User_Name=radius_user.encode('ascii'),
-                                       NAS_Identifier=nas_identifier.encode('ascii'))
-
-            req["User-Password"] = req.PwCrypt(otpval)
-            if "transactionid" in options:
-                req["State"] = str(options.get("transactionid"))
-
-            response = srv.SendPacket(req)
+                log.debug("constructing client object "
+                          "with server: %r, port: %r, secret: %r" %
+                          (r_server, r_authport, radius_secret))
+                radius_targets = [{"server": r_server,
+                                   "port": r_authport,
+                                   "secret": radius_secret,
+                                   "dictionary": radius_dictionary}]
+            log.debug("NAS Identifier: %r" % nas_identifier)
+            group_mode = get_from_config("radius.group_mode",
+                                         GROUP_MODE.FAILOVER)
+
+            response = send_group_request(radius_targets, radius_user,
+                                          otpval, nas_identifier,
+                                          state=options.get("transactionid"),
+                                          mode=group_mode)
             c = response.code
             # TODO: handle the RADIUS challenge
             """
@@ -271,11 +263,11 @@ class RadiusTokenClass(RemoteTokenClass):
             """
             if response.code == pyrad.packet.AccessAccept:
                 log.info("Radiusserver %s granted "
-                         "access to user %s." % (r_server, radius_user))
+                         "access to user %s." % (radius_server, radius_user))
                 otp_count = 0
             else:
                 log.warning("Radiusserver %s rejected "
-                            "access to user %s." % (r_server, radius_user))
+                            "access to user %s." % (radius_server, radius_user))
 
         except Exception as ex:  # pragma: no cover
             log.error("Error contacting radius Server: {0!r}".format((ex)))
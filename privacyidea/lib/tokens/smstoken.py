@@ -62,7 +62,8 @@ from json import loads
 from privacyidea.lib import _
 
 from privacyidea.lib.tokens.hotptoken import HotpTokenClass
-from privacyidea.models import Challenge
+from privacyidea.models import (Challenge, after_transaction,
+                                commit_before_call)
 from privacyidea.lib.decorators import check_token_locked
 import logging
 
@@ -297,6 +298,8 @@ class SmsTokenClass(HotpTokenClass):
             # out would cancel the checking of the other tokens
             try:
                 message_template = self._get_sms_text(options)
+                # The gateway must not hold the lock of the increased counter
+                commit_before_call()
                 success, sent_message = self._send_sms(
                     message=message_template)
 
@@ -340,12 +343,17 @@ class SmsTokenClass(HotpTokenClass):
         ret = HotpTokenClass.check_otp(self, anOtpVal, counter, window, options)
         if ret >= 0 and self._get_auto_sms(options):
             message = self._get_sms_text(options)
-            self.inc_otp_counter(ret, reset=False)
-            success, message = self._send_sms(message=message)
-            log.debug("AutoSMS: send new SMS: {0!s}".format(success))
-            log.debug("AutoSMS: {0!r}".format(message))
+            # HotpTokenClass.check_otp already increased the counter. The SMS
+            # is sent after the commit of the counter, so that the gateway
+            # does not hold the lock of the token.
+            after_transaction(self._send_auto_sms, message)
         return ret
 
+    def _send_auto_sms(self, message):
+        success, message = self._send_sms(message=message)
+        log.debug("AutoSMS: send new SMS: {0!s}".format(success))
+        log.debug("AutoSMS: {0!r}".format(message))
+
     @log_with(log)
     def _send_sms(self, message="<otp>"):
         """
@@ -91,7 +91,6 @@ from privacyidea.models import Challenge
 from privacyidea.lib.user import get_user_from_param
 from privacyidea.lib.tokens.ocra import OCRASuite, OCRA
 from privacyidea.lib.challenge import get_challenges
-from privacyidea.models import cleanup_challenges
 from privacyidea.lib import _
 from privacyidea.lib.policydecorators import challenge_response_allowed
 from privacyidea.lib.decorators import check_token_locked
@@ -342,7 +341,7 @@ class TiqrTokenClass(OcraTokenClass):
                             # Mark the challenge as answered successfully.
                             challenges[0].set_otp_status(True)
 
-            cleanup_challenges()
+            TiqrTokenClass.challenge_janitor()
 
             return "plain", res
 
@@ -2,6 +2,7 @@
 #
 #  (c) 2015 Cornelius Kölbel - cornelius@privacyidea.org
 #
+#  2018-11-20 Only set the counter, if no concurrent request set it
 #  2017-12-01 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add policy for 2step
 #  2016-04-29 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -344,9 +345,13 @@ class TotpTokenClass(HotpTokenClass):
             # _autosync: test if two consecutive otps have been provided
             res = self._autosync(hmac2Otp, anOtpVal)
 
+        if res != -1 and not self.set_otp_count_if_higher(res):
+            # A concurrent request with the same OTP value already saved
+            # the counter
+            res = -1
+
         if res != -1:
             # on success, we have to save the last attempt
-            self.set_otp_count(res)
             # We could also store it temporarily
             # self.auth_details["matched_otp_counter"] = res
 
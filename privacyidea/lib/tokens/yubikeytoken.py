@@ -183,14 +183,9 @@ class YubikeyTokenClass(TokenClass):
             window = self.get_otp_count_window()
         counter = self.get_otp_count()
 
-        res = self.check_otp(otp, counter=counter, window=window, options=None)
-
-        if res >= 0:
-            # As usually the counter is increased in lib.token.checkUserPass, we
-            # need to do this manually here:
-            self.inc_otp_counter(res)
-
-        return res
+        # check_otp increases the counter
+        return self.check_otp(otp, counter=counter, window=window,
+                              options=None)
 
     @log_with(log)
     @challenge_response_allowed
@@ -315,10 +310,11 @@ class YubikeyTokenClass(TokenClass):
         # TODO: We also could check the timestamp
         # see http://www.yubico.com/wp-content/uploads/2013/04/YubiKey-Manual-v3_1.pdf
         log.debug('compare counter to database counter: {0!r}'.format(self.token.count))
-        if count_int >= self.token.count:
+        # on success we save the used counter, unless a concurrent request
+        # with the same OTP value already saved it
+        if count_int >= self.token.count and \
+                self.inc_otp_counter(count_int) >= 0:
             res = count_int
-            # on success we save the used counter
-            self.inc_otp_counter(res)
 
         return res
 
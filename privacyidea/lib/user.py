@@ -52,6 +52,7 @@ from .error import UserError
 from ..api.lib.utils import (getParam,
                              optional)
 from .log import log_with
+from .metrics import timer
 from .resolver import (get_resolver_object,
                        get_resolver_type)
 
@@ -59,10 +60,12 @@ from .realm import (get_realms,
                     get_default_realm,
                     get_realm)
 from .config import get_from_config
-from .usercache import (user_cache, cache_username, user_init, delete_user_cache)
+from .usercache import (user_cache, cache_username, cache_usernames,
+                        user_init, delete_user_cache)
 
 
 ENCODING = 'utf-8'
+RESOLVER_METRIC = "privacyidea_resolver_request_seconds"
 
 log = logging.getLogger(__name__)
 
@@ -228,7 +231,8 @@ class User(object):
             log.info("Resolver {0!r} not found!".format(resolvername))
             return False
         else:
-            uid = y.getUserId(self.login)
+            with timer(RESOLVER_METRIC, {"resolver": resolvername}):
+                uid = y.getUserId(self.login)
             if uid not in ["", None]:
                 log.info("user {0!r} found in resolver {1!r}".format(self.login,
                                                                      resolvername))
@@ -278,7 +282,8 @@ class User(object):
             return {}
         (uid, _rtype, _resolver) = self.get_user_identifiers()
         y = get_resolver_object(self.resolver)
-        userInfo = y.getUserInfo(uid)
+        with timer(RESOLVER_METRIC, {"resolver": self.resolver}):
+            userInfo = y.getUserInfo(uid)
         return userInfo
     
     @log_with(log)
@@ -368,7 +373,9 @@ class User(object):
             if len(res) == 1:
                 y = get_resolver_object(self.resolver)
                 uid, _rtype, _rname = self.get_user_identifiers()
-                if y.checkPass(uid, password):
+                with timer(RESOLVER_METRIC, {"resolver": self.resolver}):
+                    password_ok = y.checkPass(uid, password)
+                if password_ok:
                     success = u"{0!s}@{1!s}".format(self.login, self.realm)
                     log.debug("Successfully authenticated user {0!r}.".format(self))
                 else:
@@ -556,7 +563,7 @@ def split_user(username):
     return user, realm
 
 
-@log_with(log)
+@log_with(log, span="get_user_from_param")
 def get_user_from_param(param, optionalOrRequired=optional):
     """
     Find the parameters user, realm and resolver and
@@ -707,6 +714,31 @@ def get_username(userid, resolvername):
     if userid:
         y = get_resolver_object(resolvername)
         if y:
-            username = y.getUsername(userid)
+            with timer(RESOLVER_METRIC, {"resolver": resolvername}):
+                username = y.getUsername(userid)
     return username
 
+
+@log_with(log)
+@user_cache(cache_usernames)
+def get_usernames(userids, resolvername):
+    """
+    Determine the usernames for several ids of one resolver. This is used to
+    display the owners of a list of tokens.
+
+    :param userids: The ids of the users in the resolver
+    :type userids: list
+    :param resolvername: The name of the resolver
+    :return: dict of ids and usernames. The username is "", if the user does
+        not exist.
+    :rtype: dict
+    """
+    usernames = {}
+    userids = [userid for userid in set(userids) if userid]
+    if userids:
+        y = get_resolver_object(resolvername)
+        if y:
+            with timer(RESOLVER_METRIC, {"resolver": resolvername}):
+                usernames = y.getUsernames(userids)
+    return usernames
+
@@ -185,6 +185,31 @@ def cache_username(wrapped_function, userid, resolvername):
         return username
 
 
+def cache_usernames(wrapped_function, userids, resolvername):
+    """
+    Decorator that adds a UserCache lookup to a function that looks up the
+    user names of several user IDs of one resolver.
+    The cache is queried once for all user IDs. Only the user IDs, that were
+    not found in the cache, are passed to the wrapped function and the found
+    entries are added to the cache.
+    """
+    usernames = {}
+    filter_conditions = and_(create_filter(resolver=resolvername),
+                             UserCache.user_id.in_(list(userids)))
+    # The latest entry of a user wins
+    for entry in UserCache.query.filter(filter_conditions).order_by(
+            UserCache.timestamp.asc()):
+        usernames[entry.user_id] = entry.username
+    missing = [userid for userid in userids if userid not in usernames]
+    if missing:
+        for userid, username in wrapped_function(missing,
+                                                 resolvername).items():
+            usernames[userid] = username
+            if username:
+                add_to_cache(username, resolvername, userid)
+    return usernames
+
+
 def user_init(wrapped_function, self):
     """
     Decorator to decorate the User creation function
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-19 Compile time ranges, client lists and proxy settings once
 #  2017-11-24 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Use HSM to generate Salt for PasswordHash
 #  2017-07-18 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -44,7 +45,7 @@ from datetime import timedelta, datetime
 from datetime import time as dt_time
 from dateutil.parser import parse as parse_date_string
 from dateutil.tz import tzlocal, tzutc
-from netaddr import IPAddress, IPNetwork, AddrFormatError
+from netaddr import IPAddress, IPNetwork, IPSet, AddrFormatError
 import hashlib
 import crypt
 import traceback
@@ -70,6 +71,112 @@ ENCODING = "utf-8"
 
 BASE58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
 
+#: The maximum number of compiled time ranges, client lists and proxy
+#: settings, which are kept in memory
+COMPILED_CACHE_SIZE = 1000
+_compiled_time_ranges = {}
+_compiled_clients = {}
+_compiled_proxies = {}
+
+
+def _get_compiled(cache, key, compile_func):
+    """
+    Return the compiled object of the key from the cache. If the key is not
+    contained, it is compiled with compile_func and added to the cache.
+    Exceptions of compile_func are raised and not cached.
+    """
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = compile_func(key)
+        if len(cache) >= COMPILED_CACHE_SIZE:
+            cache.clear()
+        cache[key] = compiled
+    return compiled
+
+
+class TimeRange(object):
+    """
+    A compiled time range string like
+
+     Mon-Fri: 09:00-17:30, Sat: 10-12
+
+    The string is parsed once. The time ranges are stored per day of the week,
+    so that checking a time only looks at the time ranges of its day.
+    """
+    dow_index = {"mon": 1,
+                 "tue": 2,
+                 "wed": 3,
+                 "thu": 4,
+                 "fri": 5,
+                 "sat": 6,
+                 "sun": 7}
+
+    def __init__(self, time_range):
+        # The time ranges of each day of the week, index 1 is monday
+        self.days = [[] for _i in range(8)]
+        # remove whitespaces
+        time_range = ''.join(time_range.split())
+        # split into list of time ranges
+        time_ranges = time_range.split(",")
+        try:
+            for tr in time_ranges:
+                # tr is something like: Mon-Tue:09:30-17:30
+                dow, t = [x.lower() for x in tr.split(":", 1)]
+                if "-" in dow:
+                    dow_start, dow_end = dow.split("-")
+                else:
+                    dow_start = dow_end = dow
+                t_start, t_end = t.split("-")
+                # determine if we have times like 9:00-15:00 or 9-15
+                ts = [int(x) for x in t_start.split(":")]
+                te = [int(x) for x in t_end.split(":")]
+                if len(ts) == 2:
+                    time_start = dt_time(ts[0], ts[1])
+                else:
+                    time_start = dt_time(ts[0])
+                if len(te) == 2:
+                    time_end = dt_time(te[0], te[1])
+                else:
+                    time_end = dt_time(te[0])
+
+                # An unknown start day matches from monday, an unknown end
+                # day does not match at all.
+                day_start = self.dow_index.get(dow_start, 1)
+                day_end = self.dow_index.get(dow_end, 0)
+                for day in range(day_start, day_end + 1):
+                    self.days[day].append((time_start, time_end))
+        except ValueError:
+            log.error("Wrong time range format: <dow>-<dow>:<hh:mm>-<hh:mm>")
+            log.debug("{0!s}".format(traceback.format_exc()))
+
+    def match(self, check_time=None):
+        """
+        Check if the given time is contained in the time range.
+
+        :param check_time: The time to check. The default is now.
+        :type check_time: datetime
+        :return: True, if the time is within the time range
+        """
+        check_time = check_time or datetime.now()
+        check_hour = dt_time(check_time.hour, check_time.minute)
+        for time_start, time_end in self.days[check_time.isoweekday()]:
+            if time_start <= check_hour <= time_end:
+                return True
+        return False
+
+
+def get_time_range(time_range):
+    """
+    Return the compiled TimeRange of the time_range string. The compiled
+    time ranges are kept in memory.
+
+    :param time_range: The time range like "Mon-Fri: 09:00-17:30"
+    :type time_range: basestring
+    :rtype: TimeRange
+    """
+    return _get_compiled(_compiled_time_ranges, time_range, TimeRange)
+
+
 def check_time_in_range(time_range, check_time=None):
     """
     Check if the given time is contained in the time_range string.
@@ -91,53 +198,50 @@ def check_time_in_range(time_range, check_time=None):
     :type time: datetime
     :return: True, if time is within time_range.
     """
-    time_match = False
-    dow_index = {"mon": 1,
-                 "tue": 2,
-                 "wed": 3,
-                 "thu": 4,
-                 "fri": 5,
-                 "sat": 6,
-                 "sun": 7}
+    return get_time_range(time_range).match(check_time)
 
-    check_time = check_time or datetime.now()
-    check_day = check_time.isoweekday()
-    check_hour =dt_time(check_time.hour, check_time.minute)
-    # remove whitespaces
-    time_range = ''.join(time_range.split())
-    # split into list of time ranges
-    time_ranges = time_range.split(",")
-    try:
-        for tr in time_ranges:
-            # tr is something like: Mon-Tue:09:30-17:30
-            dow, t = [x.lower() for x in tr.split(":", 1)]
-            if "-" in dow:
-                dow_start, dow_end = dow.split("-")
-            else:
-                dow_start = dow_end = dow
-            t_start, t_end = t.split("-")
-            # determine if we have times like 9:00-15:00 or 9-15
-            ts = [int(x) for x in t_start.split(":")]
-            te = [int(x) for x in t_end.split(":")]
-            if len(ts) == 2:
-                time_start =dt_time(ts[0], ts[1])
-            else:
-                time_start =dt_time(ts[0])
-            if len(te) == 2:
-                time_end =dt_time(te[0], te[1])
+
+class ClientMatcher(object):
+    """
+    A compiled list of client IP addresses and subnets like
+
+     10.0.0.0/8, -10.0.0.1, 192.168.0.1
+
+    A client matches, if it is contained in one of the addresses or subnets
+    and is not excluded by a leading "-" or "!".
+    """
+
+    def __init__(self, clients):
+        self.included = IPSet()
+        self.excluded = IPSet()
+        for client in clients:
+            if client[0] in ['-', '!']:
+                self.excluded.add(IPNetwork(client[1:]))
             else:
-                time_end =dt_time(te[0])
+                self.included.add(IPNetwork(client))
+
+    def match(self, client):
+        """
+        Check if the client matches the compiled list.
+
+        :param client: The IP address of the client
+        :type client: basestring or IPAddress
+        :return: True, if the client is included and not excluded
+        """
+        client = IPAddress(client)
+        return client in self.included and client not in self.excluded
 
-            # check the day and the time
-            if (dow_index.get(dow_start) <= check_day <= dow_index.get(dow_end)
-                    and
-                    time_start <= check_hour <= time_end):
-                time_match = True
-    except ValueError:
-        log.error("Wrong time range format: <dow>-<dow>:<hh:mm>-<hh:mm>")
-        log.debug("{0!s}".format(traceback.format_exc()))
 
-    return time_match
+def get_client_matcher(clients):
+    """
+    Return the compiled ClientMatcher of the list of clients. The compiled
+    lists are kept in memory.
+
+    :param clients: list of IP addresses and subnets
+    :type clients: list
+    :rtype: ClientMatcher
+    """
+    return _get_compiled(_compiled_clients, tuple(clients), ClientMatcher)
 
 
 def to_utf8(password):
@@ -516,7 +620,9 @@ def check_proxy(proxy_ip, rewrite_ip, proxy_settings):
     :return:
     """
     try:
-        proxy_dict = parse_proxy(proxy_settings)
+        proxy_list = _get_compiled(_compiled_proxies, proxy_settings,
+                                   lambda settings: list(
+                                       parse_proxy(settings).items()))
     except AddrFormatError:
         log.error("Error parsing the OverrideAuthorizationClient setting: {"
                   "0!s}! The IP addresses need to be comma separated. Fix "
@@ -524,9 +630,10 @@ def check_proxy(proxy_ip, rewrite_ip, proxy_settings):
         log.debug("{0!s}".format(traceback.format_exc()))
         return False
 
-    for proxynet, clientnet in proxy_dict.items():
-        if IPAddress(proxy_ip) in proxynet and IPAddress(rewrite_ip) in \
-                clientnet:
+    proxy_ip = IPAddress(proxy_ip)
+    rewrite_ip = IPAddress(rewrite_ip)
+    for proxynet, clientnet in proxy_list:
+        if proxy_ip in proxynet and rewrite_ip in clientnet:
             return True
 
     return False
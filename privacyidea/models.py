@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 #
+#  2018-11-20 Save the changes of an authentication in one transaction
+#  2018-11-20 Keep the token info dictionary of a token
+#  2018-11-16 Store salted hashes in the AuthCache
+#  2018-11-14 Add index on the expiration of the challenges
+#  2018-11-05 Split EventCounter into shards and use atomic updates
 #  2018-06-20 Friedrich Weber <friedrich.weber@netknights.it>
 #             Add PeriodicTask, PeriodicTaskOption, PeriodicTaskLastRun
 #  2018-25-09 Paul Lettich <paul.lettich@netknights.it>
@@ -37,9 +42,12 @@
 #
 import binascii
 import logging
+import sys
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 from dateutil.tz import tzutc
+import six
 from json import loads, dumps
 from flask_sqlalchemy import SQLAlchemy
 from .lib.crypto import (encrypt,
@@ -68,6 +76,84 @@ PRIVACYIDEA_TIMESTAMP = "__timestamp__"
 
 db = SQLAlchemy()
 
+SINGLE_TRANSACTION = "single_transaction"
+AFTER_TRANSACTION = "after_transaction"
+
+
+@contextmanager
+def single_transaction():
+    """
+    The objects, that are saved or deleted within this block, are only
+    flushed to the database. They are committed in one transaction at the
+    end of the block. A nested block is part of the outer transaction.
+
+    If the block raises an exception, the changes are committed
+    nevertheless, like every save outside of the block would have done.
+
+    The functions, that were passed to ``after_transaction`` within the
+    block, are called after the commit.
+    """
+    if db.session.info.get(SINGLE_TRANSACTION):
+        yield
+        return
+    db.session.info[SINGLE_TRANSACTION] = True
+    try:
+        yield
+    except Exception:
+        db.session.info.pop(SINGLE_TRANSACTION, None)
+        calls = db.session.info.pop(AFTER_TRANSACTION, [])
+        exc_info = sys.exc_info()
+        try:
+            db.session.commit()
+        except Exception as exx:  # pragma: no cover
+            log.warning(u"Could not commit the transaction: {0!r}".format(exx))
+            db.session.rollback()
+        for func, args, kwds in calls:
+            try:
+                func(*args, **kwds)
+            except Exception as exx:  # pragma: no cover
+                log.warning(u"Could not call {0!r} after the transaction: "
+                            u"{1!r}".format(func, exx))
+        six.reraise(*exc_info)
+    db.session.info.pop(SINGLE_TRANSACTION, None)
+    calls = db.session.info.pop(AFTER_TRANSACTION, [])
+    db.session.commit()
+    for func, args, kwds in calls:
+        func(*args, **kwds)
+
+
+def commit_before_call():
+    """
+    Commit the session also within ``single_transaction``. This releases the
+    locks of the written rows before a slow call, whose result is needed
+    within the block, like sending the challenge to a gateway. The changes
+    after the call are committed at the end of the block.
+    """
+    db.session.commit()
+
+
+def after_transaction(func, *args, **kwds):
+    """
+    Call the function after the commit of ``single_transaction``, so that
+    slow calls like sending a message do not hold the locks of the
+    transaction. Outside of the block the function is called at once.
+    """
+    if db.session.info.get(SINGLE_TRANSACTION):
+        db.session.info.setdefault(AFTER_TRANSACTION, []).append(
+            (func, args, kwds))
+    else:
+        func(*args, **kwds)
+
+
+def commit():
+    """
+    Commit the session or only flush it within ``single_transaction``.
+    """
+    if db.session.info.get(SINGLE_TRANSACTION):
+        db.session.flush()
+    else:
+        db.session.commit()
+
 
 class MethodsMixin(object):
     """
@@ -77,13 +163,13 @@ class MethodsMixin(object):
     
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
         return self.id
     
     def delete(self):
         ret = self.id
         db.session.delete(self)
-        db.session.commit()
+        commit()
         return ret
 
 
@@ -236,7 +322,7 @@ class Token(MethodsMixin, db.Model):
                   .filter(TokenInfo.token_id == self.id)\
                   .delete()
         db.session.delete(self)
-        db.session.commit()
+        commit()
         return ret
 
     @staticmethod
@@ -549,7 +635,8 @@ class Token(MethodsMixin, db.Model):
             if not k.endswith(".type"):
                 TokenInfo(self.id, k, v,
                           Type=types.get(k)).save(persistent=False)
-        db.session.commit()
+        commit()
+        self._expire_info()
 
     def del_info(self, key=None):
         """
@@ -565,18 +652,52 @@ class Token(MethodsMixin, db.Model):
             tokeninfos = TokenInfo.query.filter_by(token_id=self.id)
         for ti in tokeninfos:
             ti.delete()
+        self._expire_info()
+
+    def _expire_info(self):
+        """
+        The token info was changed. Within ``single_transaction`` the list of
+        the token info needs to be loaded again.
+        """
+        self._info_dict = None
+        if self in db.session:
+            db.session.expire(self, ["info_list"])
+
+    def _get_info_dict(self):
+        """
+        Return the token info dictionary, which is only built again, if the
+        token info was changed or loaded again from the database.
+        The dictionary must not be changed.
+        """
+        info_list = self.info_list
+        info_dict = getattr(self, "_info_dict", None)
+        if info_dict is None or info_dict[0] is not info_list:
+            ret = {}
+            for ti in info_list:
+                if ti.Type:
+                    ret[ti.Key + ".type"] = ti.Type
+                ret[ti.Key] = ti.Value
+            info_dict = (info_list, ret)
+            self._info_dict = info_dict
+        return info_dict[1]
 
     def get_info(self):
         """
 
         :return: The token info as dictionary
         """
-        ret = {}
-        for ti in self.info_list:
-            if ti.Type:
-                ret[ti.Key + ".type"] = ti.Type
-            ret[ti.Key] = ti.Value
-        return ret
+        return dict(self._get_info_dict())
+
+    def get_info_value(self, key, default=None):
+        """
+        Return a single value of the token info without building a new
+        dictionary.
+
+        :param key: The key of the token info
+        :param default: The value, if the key does not exist
+        :return: The value
+        """
+        return self._get_info_dict().get(key, default)
 
     def update_type(self, typ):
         """
@@ -655,7 +776,7 @@ class TokenInfo(MethodsMixin, db.Model):
         if ti is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit()
             ret = self.id
         else:
             # update
@@ -667,7 +788,7 @@ class TokenInfo(MethodsMixin, db.Model):
                                                      'Type': self.Type})
             ret = ti.id
         if persistent:
-            db.session.commit()
+            commit()
         return ret
 
 
@@ -1148,7 +1269,7 @@ class Challenge(MethodsMixin, db.Model):
     # The token serial number
     serial = db.Column(db.Unicode(40), default=u'', index=True)
     timestamp = db.Column(db.DateTime, default=datetime.now())
-    expiration = db.Column(db.DateTime)
+    expiration = db.Column(db.DateTime, index=True)
     received_count = db.Column(db.Integer(), default=0)
     otp_valid = db.Column(db.Boolean, default=False)
 
@@ -2256,7 +2377,8 @@ class ClientApplication(MethodsMixin, db.Model):
         clientapp = ClientApplication.query.filter(
             ClientApplication.ip == self.ip,
             ClientApplication.clienttype == self.clienttype).first()
-        self.lastseen = datetime.now()
+        if self.lastseen is None:
+            self.lastseen = datetime.now()
         if clientapp is None:
             # create a new one
             db.session.add(self)
@@ -2341,15 +2463,25 @@ class Subscription(MethodsMixin, db.Model):
 class EventCounter(db.Model):
     """
     This table stores counters of the event handler "Counter".
+
+    A counter can be split into several rows (shards), which are summed up
+    when the counter is read. Thus concurrent processes do not all need to
+    lock the same row.
     """
     __tablename__ = 'eventcounter'
-    __table_args__ = {'mysql_row_format': 'DYNAMIC'}
-    counter_name = db.Column(db.Unicode(80), nullable=False, primary_key=True)
+    id = db.Column(db.Integer, Sequence("eventcounter_seq"), primary_key=True)
+    counter_name = db.Column(db.Unicode(80), nullable=False)
     counter_value = db.Column(db.Integer, default=0)
+    shard = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('counter_name',
+                                          'shard',
+                                          name='evctr_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
 
-    def __init__(self, name, value=0):
+    def __init__(self, name, value=0, shard=0):
         self.counter_value = value
         self.counter_name = name
+        self.shard = shard
         self.save()
 
     def save(self):
@@ -2363,34 +2495,48 @@ class EventCounter(db.Model):
         db.session.commit()
         return ret
 
-    def increase(self):
+    def increase(self, value=1):
         """
-        Increase the value of a counter
+        Increase the value of a counter.
+        The value is changed in the database by an atomic UPDATE statement,
+        so that no concurrent increment gets lost.
+
+        :param value: The value to add to the counter
         :return:
         """
-        self.counter_value = self.counter_value + 1
-        self.save()
+        EventCounter.query.filter_by(id=self.id).update(
+            {"counter_value": EventCounter.counter_value + value},
+            synchronize_session=False)
+        db.session.commit()
 
     def decrease(self, allow_negative=False):
         """
         Decrease the value of a counter, stop at zero if allow_negative not given
         :param allow_negative:
-        :return:
-        """
-        if self.counter_value <= 0 and not allow_negative:
+        :return: True, if the counter was decreased
+        """
+        query = EventCounter.query.filter_by(id=self.id)
+        if not allow_negative:
+            query = query.filter(EventCounter.counter_value > 0)
+        decreased = query.update(
+            {"counter_value": EventCounter.counter_value - 1},
+            synchronize_session=False)
+        if not decreased and not allow_negative:
             # set counter to zero
-            self.counter_value = 0
-        else:
-            self.counter_value = self.counter_value - 1
-        self.save()
+            EventCounter.query.filter_by(id=self.id).filter(
+                EventCounter.counter_value < 0).update(
+                {"counter_value": 0}, synchronize_session=False)
+        db.session.commit()
+        return bool(decreased)
 
     def reset(self):
         """
         Reset the value of a counter
         :return:
         """
-        self.counter_value = 0
-        self.save()
+        EventCounter.query.filter_by(id=self.id).update(
+            {"counter_value": 0}, synchronize_session=False)
+        db.session.commit()
 
 
 ### Audit
@@ -2409,7 +2555,8 @@ audit_column_length = {"signature": 620,
                        "client": 50,
                        "loglevel": 12,
                        "clearance_level": 12,
-                       "policies": 255}
+                       "policies": 255,
+                       "timing": 255}
 AUDIT_TABLE_NAME = 'pidea_audit'
 
 
@@ -2441,6 +2588,7 @@ class Audit(MethodsMixin, db.Model):
     clearance_level = db.Column(db.String(audit_column_length.get(
         "clearance_level")))
     policies = db.Column(db.String(audit_column_length.get("policies")))
+    timing = db.Column(db.String(audit_column_length.get("timing")))
 
     def __init__(self,
                  action="",
@@ -2457,7 +2605,8 @@ class Audit(MethodsMixin, db.Model):
                  client="",
                  loglevel="default",
                  clearance_level="default",
-                 policies=""
+                 policies="",
+                 timing=""
                  ):
         self.signature = ""
         self.date = datetime.now()
@@ -2476,6 +2625,7 @@ class Audit(MethodsMixin, db.Model):
         self.loglevel = convert_column_to_unicode(loglevel)
         self.clearance_level = convert_column_to_unicode(clearance_level)
         self.policies = convert_column_to_unicode(policies)
+        self.timing = convert_column_to_unicode(timing)
 
 
 ### User Cache
@@ -2507,9 +2657,10 @@ class AuthCache(MethodsMixin, db.Model):
     realm = db.Column(db.Unicode(120), default=u'', index=True)
     client_ip = db.Column(db.Unicode(40), default=u"")
     user_agent = db.Column(db.Unicode(120), default=u"")
-    # We can hash the password like this:
+    # The salted hash of the password, see lib.authcache.hash_password.
+    # Older entries contain the unsalted hash like this:
     # binascii.hexlify(hashlib.sha256("secret123456").digest())
-    authentication = db.Column(db.Unicode(64), default=u"")
+    authentication = db.Column(db.Unicode(255), default=u"")
 
     def __init__(self, username, realm, resolver, authentication,
                  first_auth=None, last_auth=None):
@@ -2521,6 +2672,38 @@ class AuthCache(MethodsMixin, db.Model):
         self.last_auth = last_auth
 
 
+class AuthCounter(MethodsMixin, db.Model):
+    """
+    This table counts the successful and failed authentications of a user
+    in a time bucket. The bucket is the start of the time bucket in seconds
+    since the epoch.
+
+    The counters are used to check the policies authmaxsuccess and
+    authmaxfail without counting the entries of the audit log.
+    """
+    __tablename__ = 'authcounter'
+    id = db.Column(db.Integer, Sequence("authcounter_seq"), primary_key=True)
+    username = db.Column(db.Unicode(64), nullable=False)
+    realm = db.Column(db.Unicode(120), nullable=False)
+    success = db.Column(db.Boolean, nullable=False)
+    bucket = db.Column(db.Integer, nullable=False, index=True)
+    counter = db.Column(db.Integer, default=0)
+    __table_args__ = (db.UniqueConstraint('username',
+                                          'realm',
+                                          'success',
+                                          'bucket',
+                                          name='authctr_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
+
+    def __init__(self, username, realm, success, bucket, counter=0):
+        self.username = username
+        self.realm = realm
+        self.success = success
+        self.bucket = bucket
+        self.counter = counter
+
+
+
 ### Periodic Tasks
 
 class PeriodicTask(MethodsMixin, db.Model):
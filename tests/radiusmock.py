@@ -26,6 +26,7 @@ from __future__ import (
 )
 
 import re
+import time
 import six
 
 if six.PY2:
@@ -105,12 +106,16 @@ class RadiusMock(object):
         self._request_data = {}
         self._calls.reset()
 
-    def setdata(self, server=None, rpacket=None, success=True, timeout=False):
+    def setdata(self, server=None, rpacket=None, success=True, timeout=False,
+                timeout_servers=None, reject_servers=None, delays=None):
         self._request_data = {
             'server': server,
             'packet': rpacket,
             'success': success,
-            'timeout': timeout
+            'timeout': timeout,
+            'timeout_servers': timeout_servers or [],
+            'reject_servers': reject_servers or [],
+            'delays': delays or {}
         }
 
     @property
@@ -148,9 +153,14 @@ class RadiusMock(object):
         """
         #reply = pkt.CreateReply(packet=rawreply)
         reply = pkt.CreateReply()
-        if self._request_data.get("timeout"):
+        self._calls.setdata(client_instance.server, reply)
+        time.sleep(self._request_data.get("delays", {}).get(
+            client_instance.server, 0))
+        if self._request_data.get("timeout") or client_instance.server in \
+                self._request_data.get("timeout_servers", []):
             raise Timeout()
-        if self._request_data.get("success"):
+        if self._request_data.get("success") and client_instance.server not \
+                in self._request_data.get("reject_servers", []):
             reply.code = packet.AccessAccept
         else:
             reply.code = packet.AccessReject
@@ -2,10 +2,15 @@
 """
 This tests the file api.lib.utils
 """
+import time
+
+import jwt
+import mock
+
 from .base import MyTestCase
 
-from privacyidea.api.lib.utils import (getParam)
-from privacyidea.lib.error import ParameterError
+from privacyidea.api.lib.utils import (getParam, verify_auth_token)
+from privacyidea.lib.error import ParameterError, AuthError
 
 
 class UtilsTestCase(MyTestCase):
@@ -15,3 +20,43 @@ class UtilsTestCase(MyTestCase):
         self.assertEqual(s, "")
 
         self.assertRaises(ParameterError, getParam, {"serial": ""}, "serial", optional=False, allow_empty=False)
+
+    def test_02_verify_auth_token(self):
+        exp = int(time.time()) + 120
+        auth_token = jwt.encode({"username": "admin", "realm": "",
+                                 "role": "admin", "exp": exp},
+                                self.app.secret_key)
+        r = verify_auth_token(auth_token, ["admin"])
+        self.assertEqual(r.get("username"), "admin")
+        self.assertRaises(AuthError, verify_auth_token, auth_token, ["user"])
+
+        # The verified token is not decoded again
+        with mock.patch("privacyidea.api.lib.utils.jwt.decode") as mock_decode:
+            r = verify_auth_token(auth_token, ["admin"])
+            self.assertEqual(r.get("username"), "admin")
+            self.assertEqual(mock_decode.call_count, 0)
+            # The role is checked with each call
+            self.assertRaises(AuthError, verify_auth_token, auth_token,
+                              ["user"])
+
+        # A modified token with the same signature is verified
+        header, _payload, signature = auth_token.split(b".")
+        forged = b".".join([header, jwt.encode({"role": "admin"}, "x").split(
+            b".")[1], signature])
+        self.assertRaises(AuthError, verify_auth_token, forged)
+
+        # The expired token is removed from the cache
+        with mock.patch("privacyidea.api.lib.utils.time.time") as mock_time:
+            mock_time.return_value = exp + 1
+            with mock.patch("privacyidea.api.lib.utils.jwt.decode") as \
+                    mock_decode:
+                mock_decode.side_effect = jwt.ExpiredSignature
+                self.assertRaises(AuthError, verify_auth_token, auth_token)
+
+        # Without the cache the token is decoded with each call
+        self.app.config["PI_AUTH_TOKEN_CACHE_SIZE"] = 0
+        with mock.patch("privacyidea.api.lib.utils.jwt.decode") as mock_decode:
+            mock_decode.return_value = {"role": "admin", "exp": exp}
+            verify_auth_token(auth_token)
+            self.assertEqual(mock_decode.call_count, 1)
+        self.app.config.pop("PI_AUTH_TOKEN_CACHE_SIZE")
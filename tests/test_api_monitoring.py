@@ -119,3 +119,26 @@ class APIMonitoringTestCase(MyTestCase):
             result = json.loads(res.data.decode('utf8')).get("result")
             # Number of remaining values
             self.assertEqual(len(result.get("value")), 1)
+
+    def test_03_get_metrics(self):
+        self.setUp_user_realms()
+        # an authentication request is counted
+        with self.app.test_request_context('/validate/check',
+                                           method='POST',
+                                           data={"user": "cornelius",
+                                                 "pass": "wrong"}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+
+        with self.app.test_request_context('/monitoring/metrics',
+                                           method='GET',
+                                           headers={'Authorization': self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+            self.assertTrue(res.mimetype.startswith("text/plain"))
+            text = res.data.decode('utf8')
+            self.assertIn(u'privacyidea_validate_requests_total{result="reject"}',
+                          text)
+            self.assertIn(u"# TYPE privacyidea_policy_evaluation_seconds "
+                          u"histogram", text)
+            self.assertIn(u"privacyidea_audit_write_seconds_count", text)
@@ -2459,4 +2459,57 @@ class TriggeredPoliciesTestCase(MyTestCase):
         # clean up
         remove_token("triggtoken")
         delete_policy("otppin")
-        delete_policy("lastauth")
\ No newline at end of file
+        delete_policy("lastauth")
+
+class RequestTimingTestCase(MyTestCase):
+
+    def setUp(self):
+        MyTestCase.setUp(self)
+        self.setUp_user_realms()
+
+    def tearDown(self):
+        for key in ["PI_REQUEST_TIMING", "PI_REQUEST_TIMING_HEADER",
+                    "PI_REQUEST_TIMING_AUDIT_RATE"]:
+            self.app.config.pop(key, None)
+
+    def test_01_server_timing(self):
+        init_token({"serial": "timingtoken", "type": "spass",
+                    "pin": "test"}, user=User("cornelius", self.realm1))
+        with self.app.test_request_context('/validate/check',
+                                           method='POST',
+                                           data={"user": "cornelius",
+                                                 "pass": "test"}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+            self.assertFalse("Server-Timing" in res.headers)
+
+        self.app.config["PI_REQUEST_TIMING"] = True
+        self.app.config["PI_REQUEST_TIMING_HEADER"] = True
+        self.app.config["PI_REQUEST_TIMING_AUDIT_RATE"] = 1
+        with self.app.test_request_context('/validate/check',
+                                           method='POST',
+                                           data={"user": "cornelius",
+                                                 "pass": "test"}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+            data = json.loads(res.data)
+            self.assertTrue(data.get("result").get("value"))
+            server_timing = res.headers.get("Server-Timing")
+            phases = [t.split(";")[0] for t in server_timing.split(", ")]
+            for phase in ["before_request", "get_user_from_param",
+                          "prepolicy.set_realm", "check_user_pass",
+                          "check_token_list", "finalize_log"]:
+                self.assertIn(phase, phases)
+
+        # The timing was written to the audit log
+        with self.app.test_request_context('/audit/',
+                                           method='GET',
+                                           data={"serial": "timingtoken"},
+                                           headers={"Authorization": self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+            auditdata = json.loads(res.data).get("result").get("value").get(
+                "auditdata")
+            self.assertTrue(auditdata[0].get("timing").startswith(
+                "before_request="))
+        remove_token("timingtoken")
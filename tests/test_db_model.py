@@ -17,7 +17,8 @@ from privacyidea.models import (Token,
                                 EventHandlerCondition, PrivacyIDEAServer,
                                 ClientApplication, Subscription, UserCache,
                                 EventCounter, PeriodicTask, PeriodicTaskLastRun,
-                                PeriodicTaskOption, MonitoringStats)
+                                PeriodicTaskOption, MonitoringStats, db,
+                                single_transaction, after_transaction)
 from .base import MyTestCase
 from dateutil.tz import tzutc
 from datetime import datetime
@@ -863,3 +864,55 @@ class TokenModelTestCase(MyTestCase):
         MonitoringStats.query.delete()
         self.assertEqual(MonitoringStats.query.filter_by(stats_key=key1).count(), 0)
         self.assertEqual(MonitoringStats.query.filter_by(stats_key=key2).count(), 0)
+
+    def test_28_single_transaction(self):
+        token = Token("TRANS1", tokentype="hotp")
+        token.save()
+        with single_transaction():
+            token.count = 5
+            token.save()
+            token.set_info({"key1": "value1"})
+            with single_transaction():
+                token.failcount = 2
+                token.save()
+            # The changes are only flushed, so they can be rolled back
+            db.session.rollback()
+        db.session.refresh(token)
+        self.assertEqual(token.count, 0)
+        self.assertEqual(token.get_info(), {})
+
+        with single_transaction():
+            token.count = 7
+            token.save()
+            token.set_info({"key1": "value1"})
+        db.session.rollback()
+        db.session.refresh(token)
+        self.assertEqual(token.count, 7)
+        self.assertEqual(token.get_info(), {"key1": "value1"})
+
+        # The changes are also committed, if the block fails
+        def fail():
+            with single_transaction():
+                token.failcount = 3
+                token.save()
+                raise ValueError("failed")
+        self.assertRaises(ValueError, fail)
+        db.session.rollback()
+        db.session.refresh(token)
+        self.assertEqual(token.failcount, 3)
+
+        # The functions are called after the commit of the outer block
+        calls = []
+        with single_transaction():
+            token.count = 9
+            token.save()
+            with single_transaction():
+                after_transaction(calls.append, "called")
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, ["called"])
+        db.session.rollback()
+        db.session.refresh(token)
+        self.assertEqual(token.count, 9)
+        after_transaction(calls.append, "at once")
+        self.assertEqual(calls, ["called", "at once"])
+        token.delete()
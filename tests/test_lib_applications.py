@@ -11,12 +11,16 @@ from privacyidea.lib.applications.luks import (MachineApplication as
                                                LUKSApplication)
 from privacyidea.lib.applications.offline import (MachineApplication as
                                                   OfflineApplication,
-                                                  REFILLTOKEN_LENGTH)
+                                                  REFILLTOKEN_LENGTH,
+                                                  hash_otps,
+                                                  close_hash_pool)
+from privacyidea.lib.applications import offline
 from privacyidea.lib.applications import (get_auth_item,
                                           is_application_allow_bulk_call,
                                           get_application_types)
 from privacyidea.lib.token import init_token, get_tokens
 from privacyidea.lib.user import User
+import multiprocessing.pool
 import passlib.hash
 
 
@@ -156,6 +160,31 @@ class OfflineApplicationTestCase(MyTestCase):
                                                                "s")
         self.assertEqual(auth_item, {})
 
+    def test_04_hash_otps(self):
+        passwords = {1: "pin123456", 2: "pin654321", 3: "pin111111"}
+        hashes = hash_otps(passwords, rounds=100)
+        self.assertEqual(set(hashes), set(passwords))
+        for counter, password in passwords.items():
+            self.assertTrue(passlib.hash.pbkdf2_sha512.verify(
+                password, hashes[counter]))
+
+        # Hash the passwords in a pool of processes
+        self.app.config["PI_OFFLINE_HASH_PROCESSES"] = 2
+        hashes = hash_otps(passwords, rounds=100)
+        for counter, password in passwords.items():
+            self.assertTrue(passlib.hash.pbkdf2_sha512.verify(
+                password, hashes[counter]))
+        # The pool is started once per process
+        pool = offline._hash_pool[1]
+        self.assertNotEqual(pool, None)
+        hash_otps(passwords, rounds=100)
+        self.assertIs(offline._hash_pool[1], pool)
+        self.app.config["PI_OFFLINE_HASH_PROCESSES"] = 0
+        # The pool is stopped
+        close_hash_pool()
+        self.assertEqual(offline._hash_pool, (None, None))
+        self.assertEqual(pool._state, multiprocessing.pool.TERMINATE)
+
 
 class BaseApplicationTestCase(MyTestCase):
 
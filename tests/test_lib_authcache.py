@@ -6,7 +6,8 @@ The lib.auth_cache.py only depends on the database model.
 from .base import MyTestCase
 
 from privacyidea.lib.authcache import (add_to_cache, delete_from_cache,
-                                       update_cache_last_auth, verify_in_cache)
+                                       update_cache_last_auth, verify_in_cache,
+                                       hash_password, flush_last_auth)
 from privacyidea.models import AuthCache
 import datetime
 import hashlib
@@ -96,7 +97,66 @@ class AuthCacheTestCase(MyTestCase):
         r = AuthCache.query.filter(AuthCache.username == "grandpa").first()
         self.assertEqual(r, None)
 
+    def test_04_salted_hash(self):
+        h1 = hash_password(self.password)
+        h2 = hash_password(self.password)
+        # Each entry has its own salt
+        self.assertNotEqual(h1, h2)
+        salt, pw_hash = h1.split("$")
+        self.assertEqual(len(salt), 16)
+        self.assertEqual(hash_password(self.password, salt), h1)
 
+        add_to_cache("salted", self.realm, self.resolver, h1)
+        first_auth = datetime.datetime.utcnow() - datetime.timedelta(hours=4)
+        self.assertTrue(verify_in_cache("salted", self.realm, self.resolver,
+                                        self.password, first_auth=first_auth))
+        self.assertFalse(verify_in_cache("salted", self.realm, self.resolver,
+                                         "wrong", first_auth=first_auth))
+        delete_from_cache("salted", self.realm, self.resolver, h1)
 
-
-
+    def test_05_memory_cache(self):
+        first_auth = datetime.datetime.utcnow() - datetime.timedelta(hours=4)
+        last_auth = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+        auth_hash = hash_password(self.password)
+        cache_id = add_to_cache("memory", self.realm, self.resolver, auth_hash)
+        update_cache_last_auth(cache_id)
+        self.assertTrue(verify_in_cache("memory", self.realm, self.resolver,
+                                        self.password, first_auth=first_auth,
+                                        last_auth=last_auth))
+        last_auth1 = AuthCache.query.filter_by(id=cache_id).first().last_auth
+
+        # The next authentication is answered from memory and does not
+        # write to the database
+        self.assertTrue(verify_in_cache("memory", self.realm, self.resolver,
+                                        self.password, first_auth=first_auth,
+                                        last_auth=last_auth))
+        db_entry = AuthCache.query.filter_by(id=cache_id).first()
+        self.assertEqual(db_entry.last_auth, last_auth1)
+        # ... until the last_auth is written
+        flush_last_auth()
+        db_entry = AuthCache.query.filter_by(id=cache_id).first()
+        self.assertTrue(db_entry.last_auth > last_auth1)
+
+        # A wrong password is not found in memory
+        self.assertFalse(verify_in_cache("memory", self.realm, self.resolver,
+                                         "wrong", first_auth=first_auth,
+                                         last_auth=last_auth))
+
+        # Deleting the entry also removes it from memory
+        delete_from_cache("memory", self.realm, self.resolver, auth_hash)
+        self.assertFalse(verify_in_cache("memory", self.realm, self.resolver,
+                                         self.password, first_auth=first_auth,
+                                         last_auth=last_auth))
+
+        # Without the memory cache every authentication reads the database
+        self.app.config["PI_AUTH_CACHE_MEMORY_SIZE"] = 0
+        cache_id = add_to_cache("memory", self.realm, self.resolver, auth_hash)
+        update_cache_last_auth(cache_id)
+        self.assertTrue(verify_in_cache("memory", self.realm, self.resolver,
+                                        self.password, first_auth=first_auth,
+                                        last_auth=last_auth))
+        AuthCache.query.filter_by(id=cache_id).delete()
+        self.assertFalse(verify_in_cache("memory", self.realm, self.resolver,
+                                         self.password, first_auth=first_auth,
+                                         last_auth=last_auth))
+        self.app.config.pop("PI_AUTH_CACHE_MEMORY_SIZE")
@@ -0,0 +1,115 @@
+"""
+This file contains the tests for lib/authcounter.py
+"""
+import time
+from datetime import timedelta
+
+import mock
+
+from .base import MyTestCase, FakeFlaskG, FakeAudit
+from privacyidea.lib.authcounter import (record_authentication,
+                                         get_auth_count,
+                                         flush_auth_counters,
+                                         cleanup_auth_counters)
+from privacyidea.lib.policy import set_policy, delete_policy, PolicyClass
+from privacyidea.lib.policy import SCOPE, ACTION
+from privacyidea.lib.policydecorators import auth_user_timelimit
+from privacyidea.lib.user import User
+from privacyidea.models import AuthCounter, db
+
+
+class AuthCounterTestCase(MyTestCase):
+
+    def tearDown(self):
+        for key in ["PI_AUTH_COUNTER", "PI_AUTH_COUNTER_FLUSH_INTERVAL",
+                    "PI_AUTH_COUNTER_RETENTION"]:
+            self.app.config.pop(key, None)
+        AuthCounter.query.delete()
+        db.session.commit()
+
+    def test_01_count(self):
+        window = timedelta(minutes=5)
+        self.assertEqual(get_auth_count(u"hans", u"realm1", True, window), 0)
+        record_authentication(u"hans", u"realm1", True)
+        record_authentication(u"hans", u"realm1", True)
+        record_authentication(u"hans", u"realm1", False)
+        record_authentication(u"hans", u"realm2", True)
+        self.assertEqual(get_auth_count(u"hans", u"realm1", True, window), 2)
+        self.assertEqual(get_auth_count(u"hans", u"realm1", False, window), 1)
+        self.assertEqual(get_auth_count(u"hans", u"realm2", True, window), 1)
+        self.assertEqual(get_auth_count(u"kurt", u"realm1", True, window), 0)
+        # Both authentications are in one bucket
+        self.assertEqual(AuthCounter.query.filter_by(username=u"hans",
+                                                     realm=u"realm1",
+                                                     success=True).count(), 1)
+
+        # The authentications are outside of the time window
+        later = time.time() + 600
+        with mock.patch("privacyidea.lib.authcounter.time.time") as mock_time:
+            mock_time.return_value = later
+            self.assertEqual(get_auth_count(u"hans", u"realm1", True, window),
+                             0)
+
+        # Windows longer than the retention and disabled counters need the
+        # audit log
+        self.assertEqual(get_auth_count(u"hans", u"realm1", True,
+                                        timedelta(hours=25)), None)
+        self.app.config["PI_AUTH_COUNTER"] = False
+        self.assertEqual(get_auth_count(u"hans", u"realm1", True, window),
+                         None)
+        record_authentication(u"hans", u"realm1", True)
+        self.app.config["PI_AUTH_COUNTER"] = True
+        self.assertEqual(get_auth_count(u"hans", u"realm1", True, window), 2)
+
+    def test_02_flush_interval(self):
+        window = timedelta(minutes=5)
+        self.app.config["PI_AUTH_COUNTER_FLUSH_INTERVAL"] = 60
+        record_authentication(u"hans", u"realm1", False)
+        record_authentication(u"hans", u"realm1", False)
+        # The collected authentications are counted, but not written yet
+        self.assertEqual(AuthCounter.query.count(), 0)
+        self.assertEqual(get_auth_count(u"hans", u"realm1", False, window), 2)
+        flush_auth_counters()
+        self.assertEqual(AuthCounter.query.count(), 1)
+        self.assertEqual(get_auth_count(u"hans", u"realm1", False, window), 2)
+
+    def test_03_cleanup(self):
+        record_authentication(u"hans", u"realm1", True)
+        self.assertEqual(cleanup_auth_counters(), 0)
+        self.app.config["PI_AUTH_COUNTER_RETENTION"] = 60
+        later = time.time() + 120
+        with mock.patch("privacyidea.lib.authcounter.time.time") as mock_time:
+            mock_time.return_value = later
+            self.assertEqual(cleanup_auth_counters(), 1)
+        self.assertEqual(AuthCounter.query.count(), 0)
+
+    def test_04_timelimit_policy(self):
+        self.setUp_user_realms()
+        user = User("cornelius", realm=self.realm1)
+        set_policy(name="pol_time", scope=SCOPE.AUTHZ,
+                   action="{0!s}=2/5m".format(ACTION.AUTHMAXFAIL))
+        g = FakeFlaskG()
+        g.policy_object = PolicyClass()
+        g.audit_object = FakeAudit()
+        options = {"g": g}
+
+        def check(user, passw, options=None):
+            return True, {}
+
+        r = auth_user_timelimit(check, user, "pass", options=options)
+        self.assertTrue(r[0])
+        record_authentication(u"cornelius", self.realm1, False)
+        record_authentication(u"cornelius", self.realm1, False)
+        r = auth_user_timelimit(check, user, "pass", options=options)
+        self.assertFalse(r[0])
+        self.assertEqual(r[1].get("message"),
+                         "Only 2 failed authentications per 0:05:00")
+
+        # Without the counters the audit log is counted
+        self.app.config["PI_AUTH_COUNTER"] = False
+        with mock.patch.object(FakeAudit, "get_count") as mock_count:
+            mock_count.return_value = 0
+            r = auth_user_timelimit(check, user, "pass", options=options)
+            self.assertTrue(r[0])
+            self.assertEqual(mock_count.call_count, 1)
+        delete_policy("pol_time")
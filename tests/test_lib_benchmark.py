@@ -0,0 +1,65 @@
+"""
+This file contains the tests for lib/benchmark.py
+"""
+import shutil
+import tempfile
+
+from .base import MyTestCase
+from privacyidea.lib.benchmark import (run_benchmark, compare_results,
+                                       percentile, SCENARIOS, StubSMTP,
+                                       measure_startup, STARTUP_PHASES)
+
+
+class BenchmarkTestCase(MyTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_01_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_02_run_benchmark(self):
+        results = run_benchmark(self.app, self.directory, users=2,
+                                requests=5, policies=4, events=1,
+                                allocations=True)
+        self.assertEqual(results["parameters"]["requests"], 5)
+        self.assertEqual(sorted(results["scenarios"].keys()), sorted(SCENARIOS))
+        for name, scenario in results["scenarios"].items():
+            self.assertEqual(scenario["requests"], 5)
+            self.assertEqual(scenario["errors"], 0, name)
+            self.assertTrue(scenario["throughput"] > 0)
+            # The allocations can only be traced with Python 3
+            self.assertTrue("allocated_kb" in scenario)
+            latency = scenario["latency_ms"]
+            self.assertTrue(latency["min"] <= latency["p50"] <= latency["p95"]
+                            <= latency["max"])
+        # The challenges were sent to the stub
+        self.assertEqual(len(StubSMTP.messages), 10)
+
+    def test_03_compare(self):
+        old = {"scenarios": {"validate_spass": {
+            "throughput": 100.0, "latency_ms": {"p95": 10.0}}}}
+        new = {"scenarios": {"validate_spass": {
+            "throughput": 80.0, "latency_ms": {"p95": 10.5}}}}
+        comparison = compare_results(old, new)
+        self.assertEqual(comparison[0]["scenario"], "validate_spass")
+        self.assertAlmostEqual(comparison[0]["throughput_change"], -20.0)
+        self.assertAlmostEqual(comparison[0]["p95_change"], 5.0)
+        self.assertTrue(comparison[0]["regression"])
+        self.assertFalse(compare_results(old, old)[0]["regression"])
+
+    def test_04_measure_startup(self):
+        results = measure_startup("testing", rounds=1)
+        self.assertEqual(results["rounds"], 1)
+        for phase in STARTUP_PHASES:
+            self.assertTrue(results[phase + "_ms"] > 0, phase)
+        self.assertTrue(results["total_ms"] >= results["import_ms"])
+        # The token modules are imported, when the tokens are used
+        self.assertEqual(results["token_modules"], [])
@@ -5,7 +5,10 @@ This tests the token functions on an interface level
 """
 from .base import MyTestCase
 from privacyidea.lib.error import (TokenAdminError, ParameterError)
-from privacyidea.lib.challenge import get_challenges
+from privacyidea.lib.challenge import (get_challenges,
+                                       cleanup_expired_challenges_limited)
+from privacyidea.models import Challenge
+from flask import current_app
 from privacyidea.lib.policy import (set_policy, delete_policy, SCOPE,
                                     ACTION)
 from privacyidea.lib.token import init_token
@@ -43,4 +46,23 @@ class ChallengeTestCase(MyTestCase):
 
         delete_policy("chalresp")
 
+    def test_02_cleanup_rate_limit(self):
+        Challenge("LIMIT1", transaction_id="limit1", validitytime=0).save()
+        # Every call deletes the expired challenges
+        current_app.config["PI_CHALLENGE_CLEANUP_INTERVAL"] = 0
+        self.assertEqual(cleanup_expired_challenges_limited(), 1)
 
+        # The next cleanup is skipped within the interval
+        current_app.config["PI_CHALLENGE_CLEANUP_INTERVAL"] = 3600
+        Challenge("LIMIT1", transaction_id="limit2", validitytime=0).save()
+        self.assertEqual(cleanup_expired_challenges_limited(), None)
+        self.assertEqual(len(get_challenges(serial="LIMIT1")), 1)
+
+        # A negative interval disables the cleanup
+        current_app.config["PI_CHALLENGE_CLEANUP_INTERVAL"] = -1
+        self.assertEqual(cleanup_expired_challenges_limited(), None)
+        self.assertEqual(len(get_challenges(serial="LIMIT1")), 1)
+
+        current_app.config["PI_CHALLENGE_CLEANUP_INTERVAL"] = 0
+        self.assertEqual(cleanup_expired_challenges_limited(), 1)
+        self.assertEqual(len(get_challenges(serial="LIMIT1")), 0)
@@ -3,8 +3,13 @@ This test file tests the lib.clientapplicaton.py
 """
 from .base import MyTestCase
 from datetime import datetime
-from privacyidea.lib.clientapplication import (get_clientapplication,
-                                               save_clientapplication)
+from sqlalchemy.exc import IntegrityError
+from privacyidea.lib.clientapplication import (
+    get_clientapplication, save_clientapplication, flush_clientapplications,
+    flush_clientapplications_at_exit, _get_buffer)
+from privacyidea.models import ClientApplication
+import mock
+import time
 
 
 class ClientApplicationTestCase(MyTestCase):
@@ -38,3 +43,69 @@ class ClientApplicationTestCase(MyTestCase):
         self.assertEqual(r["PAM"][0]["ip"], "1.2.3.4")
         self.assertTrue(r["RADIUS"][0]["lastseen"] < datetime.now())
         self.assertTrue(r["SAML"][0]["lastseen"] < datetime.now())
+
+    def test_02_write_behind(self):
+        # In the tests each sighting is written immediately
+        r = save_clientapplication("1.2.3.4", "PAM")
+        self.assertTrue(r > 0)
+
+        self.app.config["PI_CLIENTAPPLICATION_FLUSH_INTERVAL"] = 3600
+        r = save_clientapplication("1.2.3.4", "PAM")
+        self.assertEqual(r, None)
+        save_clientapplication("1.2.3.4", "FreeRADIUS")
+        save_clientapplication("1.2.3.4", "FreeRADIUS")
+        save_clientapplication("192.168.0.1", "FreeRADIUS")
+        # The new clients are not written yet
+        self.assertEqual(ClientApplication.query.filter_by(
+            clienttype="FreeRADIUS").count(), 0)
+        pam_lastseen = ClientApplication.query.filter_by(
+            ip="1.2.3.4", clienttype="PAM").first().lastseen
+
+        flush_clientapplications()
+        clients = ClientApplication.query.filter_by(
+            clienttype="FreeRADIUS").all()
+        self.assertEqual(set([c.ip for c in clients]),
+                         set(["1.2.3.4", "192.168.0.1"]))
+        self.assertTrue(ClientApplication.query.filter_by(
+            ip="1.2.3.4", clienttype="PAM").first().lastseen > pam_lastseen)
+
+        # Reading the clients writes the pending sightings
+        save_clientapplication("10.0.0.1", "FreeRADIUS")
+        r = get_clientapplication(clienttype="FreeRADIUS")
+        self.assertEqual(len(r.get("FreeRADIUS")), 3)
+
+        # Write each sighting immediately
+        self.app.config["PI_CLIENTAPPLICATION_FLUSH_INTERVAL"] = 0
+        r = save_clientapplication("10.0.0.2", "FreeRADIUS")
+        self.assertTrue(r > 0)
+
+    def test_03_flush_thread(self):
+        # The thread of the process writes the sightings after the interval
+        self.app.config["PI_CLIENTAPPLICATION_FLUSH_INTERVAL"] = 1
+        save_clientapplication("10.0.0.3", "FreeRADIUS")
+        for _i in range(50):
+            if ClientApplication.query.filter_by(ip="10.0.0.3").count():
+                break
+            time.sleep(0.1)
+        self.assertEqual(ClientApplication.query.filter_by(
+            ip="10.0.0.3").count(), 1)
+
+        # The pending sightings are written, when the process exits
+        self.app.config["PI_CLIENTAPPLICATION_FLUSH_INTERVAL"] = 3600
+        save_clientapplication("10.0.0.4", "FreeRADIUS")
+        self.assertEqual(ClientApplication.query.filter_by(
+            ip="10.0.0.4").count(), 0)
+        flush_clientapplications_at_exit()
+        self.assertEqual(ClientApplication.query.filter_by(
+            ip="10.0.0.4").count(), 1)
+
+        # If a concurrent process inserted a client, the sightings are
+        # written one by one with the time of the sighting
+        lastseen = datetime(2018, 11, 15, 12, 0)
+        _get_buffer().add(u"10.0.0.5", "FreeRADIUS", lastseen)
+        with mock.patch("privacyidea.lib.clientapplication._write_sightings",
+                        side_effect=IntegrityError("insert", {}, None)):
+            flush_clientapplications()
+        self.assertEqual(ClientApplication.query.filter_by(
+            ip="10.0.0.5").first().lastseen, lastseen)
+        self.app.config["PI_CLIENTAPPLICATION_FLUSH_INTERVAL"] = 0
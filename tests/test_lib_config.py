@@ -20,7 +20,13 @@ from privacyidea.lib.config import (get_resolver_list,
                                     get_token_classes, get_token_prefix,
                                     get_machine_resolver_class_dict,
                                     get_privacyidea_node, get_privacyidea_nodes,
-                                    this, get_config_object, update_config_object)
+                                    this, get_config_object, update_config_object,
+                                    get_token_class, get_enabled_token_types,
+                                    get_resolver_class_of_type,
+                                    get_machine_resolver_class_of_type,
+                                    get_token_class_info, register_token_type,
+                                    register_resolver_type, TOKEN_MODULES,
+                                    RESOLVER_MODULES)
 from privacyidea.lib.resolvers.PasswdIdResolver import IdResolver as PWResolver
 from privacyidea.lib.tokens.hotptoken import HotpTokenClass
 from privacyidea.lib.tokens.totptoken import TotpTokenClass
@@ -144,12 +150,12 @@ class ConfigTestCase(MyTestCase):
         self.assertTrue("totp" in types, types)
         self.assertTrue("hotp" in types, types)
 
-        # token classes are cached with calling 'get_token_types()'
-        self.assertTrue("pi_token_classes" in this.config, this.config)
-        self.assertTrue("pi_token_types" in this.config, this.config)
         r = get_token_classes()
         self.assertTrue(TotpTokenClass in r, r)
         self.assertTrue(HotpTokenClass in r, r)
+        # token classes are cached with calling 'get_token_classes()'
+        self.assertTrue("pi_token_classes" in this.config, this.config)
+        self.assertTrue("pi_token_types" in this.config, this.config)
 
     def test_03_token_prefix(self):
         prefix = get_token_prefix("totp")
@@ -222,3 +228,61 @@ class ConfigTestCase(MyTestCase):
         self.assertEqual(get_config_object().get_config("k1"), "v1")
         # updated now
         self.assertEqual(update_config_object().get_config("k1"), "v2")
+
+    def test_09_enabled_token_types(self):
+        self.assertTrue("u2f" in get_enabled_token_types())
+        self.assertEqual(get_token_class("HOTP"), HotpTokenClass)
+        self.assertEqual(get_token_class("hmac"), HotpTokenClass)
+        self.assertEqual(get_token_class("unknown"), None)
+        self.assertEqual(get_resolver_class_of_type("passwdresolver"),
+                         PWResolver)
+        self.assertEqual(get_resolver_class_of_type("unknown"), None)
+        self.assertEqual(get_machine_resolver_class_of_type("hosts").type,
+                         "hosts")
+
+        self.app.config["PI_TOKEN_TYPES"] = "hotp, TOTP, unknown"
+        try:
+            self.assertEqual(get_enabled_token_types(), ["hotp", "totp"])
+            self.assertEqual(get_token_types(), ["hotp", "totp"])
+            self.assertEqual(get_token_list(),
+                             set(["privacyidea.lib.tokens.hotptoken",
+                                  "privacyidea.lib.tokens.totptoken"]))
+            self.assertEqual(get_token_class("totp"), TotpTokenClass)
+            # Disabled token types are not available
+            self.assertEqual(get_token_class("spass"), None)
+            self.assertEqual(get_token_prefix("spass", "none"), "none")
+            self.app.config["PI_TOKEN_TYPES"] = ["spass"]
+            self.assertEqual(get_enabled_token_types(), ["spass"])
+        finally:
+            self.app.config.pop("PI_TOKEN_TYPES")
+
+    def test_10_type_registries(self):
+        # The classes and class infos are only determined once
+        self.assertEqual(get_token_class("hotp"), HotpTokenClass)
+        self.assertEqual(this.config["pi_token_class"].get("hotp"),
+                         HotpTokenClass)
+        info = get_token_class_info("HOTP")
+        self.assertEqual(info["type"], "hotp")
+        self.assertTrue(get_token_class_info("hotp") is info)
+        self.assertEqual(get_token_class_info("hotp", "description"),
+                         HotpTokenClass.get_class_info("description"))
+        self.assertEqual(get_token_class_info("hotp", "unknown"), {})
+        self.assertEqual(get_token_class_info("unknown"), {})
+
+        # The dict of the prefixes is a copy
+        prefixes = get_token_prefix()
+        self.assertEqual(prefixes.get("hotp"), "OATH")
+        prefixes["hotp"] = "CHANGED"
+        self.assertEqual(get_token_prefix().get("hotp"), "OATH")
+        self.assertEqual(get_token_prefix("hotp"), "OATH")
+
+        # Registering a module resets the registries
+        register_token_type("hotp", TOKEN_MODULES["hotp"])
+        self.assertFalse("pi_token_class" in this.config)
+        self.assertFalse("pi_token_prefixes" in this.config)
+        self.assertEqual(get_token_class("hotp"), HotpTokenClass)
+        register_resolver_type("passwdresolver",
+                               RESOLVER_MODULES["passwdresolver"])
+        self.assertFalse("pi_resolver_class" in this.config)
+        self.assertEqual(get_resolver_class_of_type("passwdresolver"),
+                         PWResolver)
@@ -4,7 +4,8 @@ This tests the files
 """
 
 from .base import MyTestCase
-from privacyidea.lib.counter import increase, decrease, reset, read
+from privacyidea.lib.counter import (increase, decrease, reset, read,
+                                     read_and_reset, flush_counters)
 from privacyidea.models import EventCounter
 
 
@@ -81,3 +82,53 @@ class CounterTestCase(MyTestCase):
 
         counter = EventCounter.query.filter_by(counter_name="hallo_counter4").first()
         self.assertEqual(counter.counter_value, 0)
+
+    def test_05_sharded_counter(self):
+        self.app.config["PI_COUNTER_SHARDS"] = 4
+        for x in range(0, 40):
+            increase("sharded_counter")
+        counters = EventCounter.query.filter_by(counter_name="sharded_counter").all()
+        self.assertTrue(len(counters) > 1)
+        self.assertEqual(sum([c.counter_value for c in counters]), 40)
+        self.assertEqual(read("sharded_counter"), 40)
+
+        for x in range(0, 45):
+            decrease("sharded_counter")
+        # The counter does not become negative
+        self.assertEqual(read("sharded_counter"), 0)
+
+        increase("sharded_counter")
+        decrease("sharded_counter", allow_negative=True)
+        decrease("sharded_counter", allow_negative=True)
+        self.assertEqual(read("sharded_counter"), -1)
+
+        reset("sharded_counter")
+        self.assertEqual(read("sharded_counter"), 0)
+        self.app.config["PI_COUNTER_SHARDS"] = 1
+
+    def test_06_accumulated_increments(self):
+        self.app.config["PI_COUNTER_FLUSH_INTERVAL"] = 3600
+        r = increase("acc_counter")
+        self.assertEqual(r, None)
+        increase("acc_counter")
+        # The increments are not written to the database yet
+        counter = EventCounter.query.filter_by(counter_name="acc_counter").first()
+        self.assertEqual(counter, None)
+        # but they are taken into account when reading the counter
+        self.assertEqual(read("acc_counter"), 2)
+        counter = EventCounter.query.filter_by(counter_name="acc_counter").first()
+        self.assertEqual(counter.counter_value, 2)
+
+        increase("acc_counter")
+        increase("acc_counter")
+        flush_counters()
+        counter = EventCounter.query.filter_by(counter_name="acc_counter").first()
+        self.assertEqual(counter.counter_value, 4)
+        self.app.config["PI_COUNTER_FLUSH_INTERVAL"] = 0
+
+    def test_07_read_and_reset(self):
+        self.assertEqual(read_and_reset("unknown counter"), None)
+        increase("rr_counter")
+        increase("rr_counter")
+        self.assertEqual(read_and_reset("rr_counter"), 2)
+        self.assertEqual(read("rr_counter"), 0)
@@ -8,11 +8,14 @@ This test file tests the lib.importotp
 from .base import MyTestCase
 from privacyidea.lib.importotp import (parseOATHcsv, parseYubicoCSV,
                                        parseSafeNetXML, ImportException,
-                                       parsePSKCdata, GPGImport)
+                                       parsePSKCdata, GPGImport,
+                                       iterparsePSKCdata, iterparseSafeNetXML,
+                                       iterparse_token_file)
 from privacyidea.lib.token import remove_token
 from privacyidea.lib.token import init_token
-from privacyidea.lib.importotp import export_pskc
+from privacyidea.lib.importotp import export_pskc, PSKCWriter
 import binascii
+from io import BytesIO
 
 
 XML_PSKC_PASSWORD_PREFIX = """<?xml version="1.0" encoding="UTF-8"?>
@@ -627,6 +630,79 @@ class ImportOTPTestCase(MyTestCase):
         # password token
         self.assertEqual(tokens.get("t4").get("otpkey"), "lässig")
 
+    def test_07_iterparse(self):
+        # The incremental parsers return the same tokens
+        tokens = list(iterparseSafeNetXML(BytesIO(ALADDINXML)))
+        self.assertEqual(dict(tokens), parseSafeNetXML(ALADDINXML))
+        self.assertEqual(len(tokens), 2)
+        self.assertRaises(ImportException, list, iterparseSafeNetXML(
+            BytesIO(ALADDINXML_WITHOUT_TOKENS)))
+
+        tokens = dict(iterparsePSKCdata(BytesIO(XML_PSKC)))
+        self.assertEqual(tokens, parsePSKCdata(XML_PSKC))
+        self.assertEqual(tokens["2600135004013"].get("timeShift"), "-122")
+
+        # The XML declaration may follow whitespace and the end tag of the
+        # KeyContainer may be missing
+        with open("tests/testdata/pskc-password.xml") as f:
+            self.assertRaises(ImportException, list, iterparsePSKCdata(f))
+            f.seek(0)
+            tokens = dict(iterparsePSKCdata(f, password="qwerty"))
+        self.assertEqual(tokens["987654321"].get("otpkey"),
+                         binascii.hexlify("12345678901234567890"))
+        with open("tests/testdata/pskc-aes.xml") as f:
+            tokens = dict(iterparsePSKCdata(
+                f, preshared_key_hex="12345678901234567890123456789012"))
+        self.assertEqual(tokens["987654321"].get("otpkey"),
+                         "3132333435363738393031323334353637383930")
+
+        # Other errors are not accepted
+        self.assertRaises(ImportException, list, iterparsePSKCdata(
+            BytesIO(XML_PSKC_PASSWORD_PREFIX), password="qwerty"))
+        # Truncated files are not accepted
+        truncated = XML_PSKC[:XML_PSKC.index(b"</KeyPackage>")]
+        self.assertRaises(ImportException, list, iterparsePSKCdata(
+            BytesIO(truncated)))
+        # The broken file is detected, before the first token is returned
+        tokens = iterparse_token_file(BytesIO(truncated), "pskc")
+        self.assertRaises(ImportException, next, tokens)
+
+        tokens = iterparse_token_file(BytesIO(YUBIKEYCSV), "yubikeycsv")
+        self.assertEqual(dict(tokens), parseYubicoCSV(YUBIKEYCSV))
+        self.assertRaises(ImportException, iterparse_token_file,
+                          BytesIO(YUBIKEYCSV), "unknown")
+
+    def test_08_pskc_writer(self):
+        def generate_tokens():
+            for i in range(5):
+                yield init_token({"serial": "PSKC{0:d}".format(i),
+                                  "type": "totp" if i % 2 else "hotp",
+                                  "otpkey": self.otpkey})
+            yield init_token({"serial": "PSKCSPASS", "type": "spass"})
+
+        psk = "12345678901234567890123456789012"
+        writer = PSKCWriter(psk)
+        self.assertEqual(writer.get_psk(), psk)
+        output = BytesIO()
+        # The tokens are written one after another
+        self.assertEqual(writer.write(output, generate_tokens()), 5)
+        export = output.getvalue()
+        self.assertTrue(export.startswith(b"<KeyContainer"), export)
+        self.assertTrue(export.endswith(b"</KeyContainer>\n"), export)
+
+        # The file is a well-formed PSKC file
+        tokens = dict(iterparsePSKCdata(BytesIO(export),
+                                        preshared_key_hex=psk))
+        self.assertEqual(tokens, parsePSKCdata(export, preshared_key_hex=psk))
+        self.assertEqual(len(tokens), 5)
+        self.assertEqual(tokens["PSKC0"].get("type"), "hotp")
+        self.assertEqual(tokens["PSKC1"].get("type"), "totp")
+        self.assertEqual(tokens["PSKC1"].get("timeStep"), "30")
+        self.assertEqual(tokens["PSKC4"].get("otpkey"), self.otpkey)
+        for serial in ["PSKC0", "PSKC1", "PSKC2", "PSKC3", "PSKC4",
+                       "PSKCSPASS"]:
+            remove_token(serial)
+
 
 class GPGTestCase(MyTestCase):
 
@@ -169,4 +169,44 @@ class LdapMachineTestCase(MyTestCase):
         # We check that all Server objects were constructed with a non-None TLS context and use_ssl=True
         for _, kwargs in ldap3mock.get_server_mock().call_args_list:
             self.assertIsNotNone(kwargs['tls'])
-            self.assertTrue(kwargs['use_ssl'])
\ No newline at end of file
+            self.assertTrue(kwargs['use_ssl'])
+
+    @ldap3mock.activate
+    def test_10_cache_and_connection_reuse(self):
+        ldap3mock.setLDAPDirectory(LDAPDirectory)
+        config = MYCONFIG.copy()
+        config["BINDDN"] = "cn=admin,ou=example,o=test"
+        config["SEARCHFILTER"] = "(objectClass=*)"
+        reso1 = LdapMachineResolver("cacheResolver", config=config)
+        machines = reso1.get_machines(hostname="machine1.example.test")
+        self.assertEqual(len(machines), 1)
+        self.assertEqual(reso1.get_machine_id(hostname="machine4.example.test"),
+                         None)
+
+        # A second resolver object reuses the connection
+        reso2 = LdapMachineResolver("cacheResolver", config=config)
+        reso2._bind()
+        self.assertIs(reso2.l, reso1.l)
+
+        # The directory changes, but the results are read from the cache
+        directory = [entry for entry in LDAPDirectory
+                     if entry["dn"] != "cn=machine1,ou=example,o=test"]
+        directory.append({"dn": "cn=machine4,ou=example,o=test",
+                          "attributes": {"cn": "machine4",
+                                         "objectClass": "computer",
+                                         "dNSHostName": "machine4.example.test"}})
+        reso2.l.set_directory(directory)
+        machines = reso2.get_machines(hostname="machine1.example.test")
+        self.assertEqual(len(machines), 1)
+        self.assertEqual(machines[0].id, "cn=machine1,ou=example,o=test")
+        # ... also the search, which did not find a machine
+        self.assertEqual(reso2.get_machine_id(hostname="machine4.example.test"),
+                         None)
+
+        # Without the cache the directory is searched
+        config["CACHE_TIMEOUT"] = 0
+        reso3 = LdapMachineResolver("cacheResolver", config=config)
+        self.assertEqual(reso3.get_machines(hostname="machine1.example.test"),
+                         [])
+        self.assertEqual(reso3.get_machine_id(hostname="machine4.example.test"),
+                         "cn=machine4,ou=example,o=test")
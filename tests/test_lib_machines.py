@@ -10,9 +10,13 @@ lib.machines.hosts
 HOSTSFILE = "tests/testdata/hosts"
 from .base import MyTestCase
 from privacyidea.lib.machines import BaseMachineResolver
-from privacyidea.lib.machines.hosts import HostsMachineResolver
+from privacyidea.lib.machines.hosts import (HostsMachineResolver,
+                                            SubstringIndex)
 from privacyidea.lib.machines.base import Machine, MachineResolverError
 import netaddr
+import os
+import shutil
+import tempfile
 from privacyidea.lib.machineresolver import (get_resolver_list, save_resolver,
                                      delete_resolver, get_resolver_config,
                                      get_resolver_object, pretestresolver)
@@ -225,3 +229,30 @@ class HostsMachineTestCase(MyTestCase):
         self.assertRaises(MachineResolverError,
                           self.mreso.load_config,
                           {"name": "nothing"})
+
+    def test_06_substring_index(self):
+        index = SubstringIndex([("gandalf", 0), ("pippin", 1),
+                                ("rgandalf-old", 2)])
+        self.assertEqual(index.search("gandalf"), set([0, 2]))
+        self.assertEqual(index.search("pi"), set([1]))
+        self.assertEqual(index.search("old"), set([2]))
+        self.assertEqual(index.search("sauron"), set())
+
+    def test_07_reread_changed_file(self):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, "hosts")
+        try:
+            with open(filename, "w") as f:
+                f.write("192.168.0.1\tgandalf\n")
+            mreso = HostsMachineResolver("tmpResolver",
+                                         config={"filename": filename})
+            self.assertEqual(len(mreso.get_machines()), 1)
+            with open(filename, "a") as f:
+                f.write("192.168.0.2\tpippin\n")
+            machines = mreso.get_machines(hostname="pippin")
+            self.assertEqual(len(machines), 1)
+            self.assertEqual(machines[0].id, "192.168.0.2")
+            self.assertEqual(mreso.get_machine_id(ip="192.168.0.2"),
+                             "192.168.0.2")
+        finally:
+            shutil.rmtree(tmpdir)
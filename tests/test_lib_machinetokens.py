@@ -3,11 +3,12 @@ This test file tests the lib/machine.py for attaching and detaching tokens
 """
 
 HOSTSFILE = "tests/testdata/hosts"
+import mock
 from .base import MyTestCase
 from privacyidea.lib.machine import (attach_token, detach_token, add_option,
                                      delete_option, list_machine_tokens,
                                      list_token_machines, get_auth_items)
-from privacyidea.lib.token import init_token, get_tokens
+from privacyidea.lib.token import init_token, get_tokens, enable_token
 from privacyidea.lib.machineresolver import save_resolver
 
 
@@ -140,3 +141,58 @@ class MachineTokenTestCase(MyTestCase):
         sshkey_auth_items = ai.get("ssh")
         # None or an empty list
         self.assertFalse(sshkey_auth_items)
+
+    def test_11_auth_items_bulk(self):
+        serials = ["ssh1", "ssh2", "ssh3"]
+        for serial in serials:
+            init_token({"serial": serial, "type": "sshkey",
+                        "sshkey": sshkey})
+            attach_token(hostname="gandalf", serial=serial,
+                         application="ssh", options={"user": serial})
+        enable_token("ssh3", False)
+
+        ai = get_auth_items("gandalf", ip="192.168.0.1", application="ssh")
+        users = sorted([item.get("user") for item in ai.get("ssh")])
+        # The disabled token is not returned
+        self.assertEqual(users, ["ssh1", "ssh2", "testuser"])
+
+        ai = get_auth_items("gandalf", ip="192.168.0.1", application="ssh",
+                            filter_param={"user": "ssh2"})
+        self.assertEqual(len(ai.get("ssh")), 1)
+        self.assertEqual(ai.get("ssh")[0].get("user"), "ssh2")
+        enable_token("ssh3")
+
+    def test_12_auth_items_cache(self):
+        self.app.config["PI_MACHINE_AUTHITEM_CACHE"] = 60
+        try:
+            ai = get_auth_items("gandalf", ip="192.168.0.1",
+                                application="ssh")
+            self.assertEqual(len(ai.get("ssh")), 4)
+            # The cached response can not be changed by the caller
+            ai.get("ssh").pop()
+
+            # The response is cached
+            with mock.patch("privacyidea.lib.machine."
+                            "_get_machinetoken_rows") as mock_rows:
+                ai = get_auth_items("gandalf", ip="192.168.0.1",
+                                    application="ssh")
+                self.assertEqual(len(ai.get("ssh")), 4)
+                mock_rows.assert_not_called()
+
+            # Disabling a token clears the cache
+            enable_token("ssh3", False)
+            ai = get_auth_items("gandalf", ip="192.168.0.1",
+                                application="ssh")
+            self.assertEqual(len(ai.get("ssh")), 3)
+            enable_token("ssh3")
+
+            # Detaching a token clears the cache
+            get_auth_items("gandalf", ip="192.168.0.1", application="ssh")
+            detach_token("ssh2", "ssh", hostname="gandalf")
+            ai = get_auth_items("gandalf", ip="192.168.0.1",
+                                application="ssh")
+            self.assertEqual(len(ai.get("ssh")), 3)
+            self.assertNotIn("ssh2", [item.get("user")
+                                      for item in ai.get("ssh")])
+        finally:
+            self.app.config.pop("PI_MACHINE_AUTHITEM_CACHE", None)
@@ -0,0 +1,112 @@
+"""
+This file contains the tests for lib/metrics.py
+"""
+import os
+import shutil
+import tempfile
+
+from .base import MyTestCase
+from privacyidea.lib.metrics import (MetricsRegistry, MmapedValues, inc,
+                                     observe, timer, set_gauge,
+                                     generate_prometheus_text)
+
+
+class MetricsTestCase(MyTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.app.config.get("_app_local_store", {}).pop("metrics_registry", None)
+
+    def test_01_in_memory_registry(self):
+        registry = MetricsRegistry()
+        registry.inc("privacyidea_validate_requests_total",
+                     labels={"result": "accept"})
+        registry.inc("privacyidea_validate_requests_total", 2,
+                     labels={"result": "accept"})
+        registry.set("privacyidea_db_pool_size", 5)
+        registry.observe("privacyidea_audit_write_seconds", 0.02)
+        values = registry.collect()
+        self.assertEqual(
+            values[u'privacyidea_validate_requests_total{result="accept"}'], 3)
+        self.assertEqual(values[u"privacyidea_db_pool_size"], 5)
+        self.assertEqual(
+            values[u'privacyidea_audit_write_seconds_bucket{le="0.01"}'], 0)
+        self.assertEqual(
+            values[u'privacyidea_audit_write_seconds_bucket{le="0.025"}'], 1)
+        self.assertEqual(
+            values[u'privacyidea_audit_write_seconds_bucket{le="+Inf"}'], 1)
+        self.assertEqual(values[u"privacyidea_audit_write_seconds_count"], 1)
+
+    def test_02_mmaped_values(self):
+        filename = os.path.join(self.directory, "metrics_1.db")
+        values = MmapedValues(filename)
+        values.set(u"key1", 1.5)
+        # Add enough values to grow the file
+        for i in range(0, 3000):
+            values.set(u"a_long_key_name_{0!s}".format(i), i)
+        values.set(u"key1", 2.5)
+        self.assertEqual(values.get(u"key1"), 2.5)
+        values.close()
+
+        read_values = dict(MmapedValues.read_file(filename))
+        self.assertEqual(read_values[u"key1"], 2.5)
+        self.assertEqual(read_values[u"a_long_key_name_2999"], 2999)
+        self.assertEqual(len(read_values), 3001)
+
+        # Reopening the file continues with the stored values
+        values = MmapedValues(filename)
+        self.assertEqual(values.get(u"a_long_key_name_17"), 17)
+        values.close()
+
+    def test_03_aggregate_processes(self):
+        # The file of another, terminated process
+        other = MmapedValues(os.path.join(self.directory,
+                                          "metrics_999999999.db"))
+        other.set(u'privacyidea_validate_requests_total{result="reject"}', 4)
+        other.set(u"privacyidea_db_pool_size", 10)
+        other.close()
+
+        registry = MetricsRegistry(self.directory)
+        registry.inc("privacyidea_validate_requests_total",
+                     labels={"result": "reject"})
+        registry.set("privacyidea_db_pool_size", 5)
+        values = registry.collect()
+        self.assertEqual(
+            values[u'privacyidea_validate_requests_total{result="reject"}'], 5)
+        # gauges of terminated processes are ignored
+        self.assertEqual(values[u"privacyidea_db_pool_size"], 5)
+
+    def test_04_prometheus_text(self):
+        self.app.config["PI_METRICS_DIR"] = self.directory
+        inc("privacyidea_validate_requests_total", labels={"result": "accept"})
+        set_gauge("privacyidea_db_pool_checkedout", 2)
+        observe("privacyidea_resolver_request_seconds", 0.3,
+                labels={"resolver": "reso1"})
+        with timer("privacyidea_resolver_request_seconds",
+                   labels={"resolver": "reso1"}):
+            pass
+        text = generate_prometheus_text()
+        lines = text.splitlines()
+        self.assertIn(u"# TYPE privacyidea_validate_requests_total counter",
+                      lines)
+        self.assertIn(u'privacyidea_validate_requests_total{result="accept"} 1',
+                      lines)
+        self.assertIn(u"privacyidea_db_pool_checkedout 2", lines)
+        self.assertIn(u"# TYPE privacyidea_resolver_request_seconds histogram",
+                      lines)
+        self.assertIn(u'privacyidea_resolver_request_seconds_bucket'
+                      u'{le="0.005",resolver="reso1"} 1', lines)
+        self.assertIn(u'privacyidea_resolver_request_seconds_bucket'
+                      u'{le="+Inf",resolver="reso1"} 2', lines)
+        self.assertIn(u'privacyidea_resolver_request_seconds_count'
+                      u'{resolver="reso1"} 2', lines)
+        # Buckets are ordered by their upper bound
+        buckets = [l for l in lines if "_bucket" in l]
+        self.assertTrue(buckets[0].startswith(
+            u'privacyidea_resolver_request_seconds_bucket{le="0.005"'))
+        self.assertTrue(buckets[-1].startswith(
+            u'privacyidea_resolver_request_seconds_bucket{le="+Inf"'))
+        self.app.config.pop("PI_METRICS_DIR")
@@ -4,6 +4,8 @@ This test file tests the lib.policy.py
 
 The lib.policy.py only depends on the database model.
 """
+import mock
+
 from .base import MyTestCase, FakeFlaskG
 
 from privacyidea.lib.policy import (set_policy, delete_policy,
@@ -19,6 +21,7 @@ from privacyidea.lib.resolver import (save_resolver, get_resolver_list,
 from privacyidea.lib.error import ParameterError
 from privacyidea.lib.user import User
 import datetime
+from netaddr import AddrFormatError
 PWFILE = "tests/testdata/passwords"
 
 
@@ -223,6 +226,15 @@ class PolicyTestCase(MyTestCase):
         self.assertTrue(_check_policy_name("pol4", p), p)
         self.assertTrue(len(p) == 1, p)
 
+        # The client is only parsed, if a policy restricts the clients
+        set_policy(name="pol5", scope="t")
+        P = PolicyClass()
+        p = P.get_policies(scope="t", client="")
+        self.assertTrue(_check_policy_name("pol5", p), p)
+        self.assertRaises(AddrFormatError, P.get_policies, scope="s",
+                          client="")
+        delete_policy("pol5")
+
     def test_08_user_policies(self):
         set_policy(name="pol1", scope="s", user="*")
         set_policy(name="pol2", scope="s", user="admin, root, user1")
@@ -867,4 +879,49 @@ class PolicyTestCase(MyTestCase):
         # The audit_data contains act1 and act2
         self.assertTrue("act1" in audit_data.get("policies"))
         self.assertTrue("act2" in audit_data.get("policies"))
-        self.assertTrue("act3" not in audit_data.get("policies"))
\ No newline at end of file
+        self.assertTrue("act3" not in audit_data.get("policies"))
+    def test_26_rights_cache(self):
+        delete_all_policies()
+        set_policy("cacheadmin", scope=SCOPE.ADMIN,
+                   action="enrollHOTP, disable")
+        P = PolicyClass()
+        version = P.version
+        rights = P.ui_get_rights(SCOPE.ADMIN, "adminrealm", "admin",
+                                 "10.0.0.1")
+        self.assertEqual(set(rights), {"enrollHOTP", "disable"})
+        types = P.ui_get_enroll_tokentypes("10.0.0.1",
+                                           {"role": "admin",
+                                            "realm": "adminrealm",
+                                            "username": "admin"})
+        self.assertEqual(list(types), ["hotp"])
+
+        # The rights are read from the cache
+        with mock.patch.object(PolicyClass, "get_policies") as mock_pols:
+            self.assertEqual(P.ui_get_rights(SCOPE.ADMIN, "adminrealm",
+                                             "admin", "10.0.0.1"), rights)
+            self.assertEqual(P.ui_get_enroll_tokentypes(
+                "10.0.0.1", {"role": "admin", "realm": "adminrealm",
+                             "username": "admin"}), types)
+            self.assertEqual(mock_pols.call_count, 0)
+        # The caller gets a copy
+        rights.append("delete")
+        self.assertNotIn("delete", P.ui_get_rights(SCOPE.ADMIN, "adminrealm",
+                                                   "admin", "10.0.0.1"))
+
+        # A changed policy starts a new version
+        set_policy("cacheadmin", scope=SCOPE.ADMIN, action="enrollTOTP")
+        P = PolicyClass()
+        self.assertGreater(P.version, version)
+        self.assertEqual(P.ui_get_rights(SCOPE.ADMIN, "adminrealm", "admin",
+                                         "10.0.0.1"), ["enrollTOTP"])
+
+        # Policies with a time restriction are not cached
+        set_policy("cacheadmin", scope=SCOPE.ADMIN, action="enrollTOTP",
+                   time="Mon-Sun: 0-23:59")
+        P = PolicyClass()
+        P.ui_get_rights(SCOPE.ADMIN, "adminrealm", "admin", "10.0.0.1")
+        with mock.patch.object(PolicyClass, "get_policies") as mock_pols:
+            mock_pols.return_value = []
+            P.ui_get_rights(SCOPE.ADMIN, "adminrealm", "admin", "10.0.0.1")
+            self.assertEqual(mock_pols.call_count, 2)
+        delete_policy("cacheadmin")
@@ -5,7 +5,10 @@ from .base import MyTestCase
 from privacyidea.lib.error import ConfigAdminError, privacyIDEAError
 from privacyidea.lib.radiusserver import (add_radius, delete_radius,
                                           get_radiusservers, get_radius,
-                                          RADIUSServer, test_radius)
+                                          RADIUSServer, test_radius,
+                                          get_dictionary, get_client_pool,
+                                          get_server_health,
+                                          reset_radius_state, GROUP_MODE)
 from privacyidea.lib.config import set_privacyidea_config
 from . import radiusmock
 DICT_FILE = "tests/testdata/dictionary"
@@ -99,3 +102,97 @@ class RADIUSServerTestCase(MyTestCase):
                           identifier="myserver", server="1.2.3.4",
                           user="user", password="password",
                           secret="x" * 96, dictionary=DICT_FILE)
+
+    def test_07_dictionary_and_client_pool(self):
+        reset_radius_state()
+        d1 = get_dictionary(DICT_FILE)
+        d2 = get_dictionary(DICT_FILE)
+        # The dictionary is only parsed once
+        self.assertIs(d1, d2)
+
+        pool = get_client_pool("1.2.3.4", 1812, "testing123", DICT_FILE)
+        self.assertIs(pool, get_client_pool("1.2.3.4", 1812, "testing123",
+                                            DICT_FILE))
+        with pool.client() as client1:
+            with pool.client() as client2:
+                # concurrently used clients are different objects
+                self.assertIsNot(client1, client2)
+        with pool.client() as client3:
+            # an idle client is reused
+            self.assertIn(client3, [client1, client2])
+        self.assertIs(client3.dict, d1)
+        reset_radius_state()
+
+    @radiusmock.activate
+    def test_08_RADIUS_group_failover(self):
+        reset_radius_state()
+        add_radius(identifier="server1", server="1.1.1.1",
+                   secret="testing123", dictionary=DICT_FILE)
+        add_radius(identifier="server2", server="2.2.2.2",
+                   secret="testing123", dictionary=DICT_FILE)
+        configs = [get_radius("server1").config, get_radius("server2").config]
+
+        radiusmock.setdata(success=True, timeout_servers=["1.1.1.1"])
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.FAILOVER)
+        self.assertTrue(r)
+        self.assertEqual([c.request for c in radiusmock.calls],
+                         ["1.1.1.1", "2.2.2.2"])
+        self.assertFalse(get_server_health("1.1.1.1", 1812).is_available())
+        self.assertTrue(get_server_health("2.2.2.2", 1812).is_available())
+
+        # The server, that is down, is not asked first anymore
+        radiusmock.calls.reset()
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.FAILOVER)
+        self.assertTrue(r)
+        self.assertEqual([c.request for c in radiusmock.calls], ["2.2.2.2"])
+
+        # If no server responds, the request fails
+        radiusmock.setdata(success=True, timeout=True)
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.FAILOVER)
+        self.assertFalse(r)
+        delete_radius("server1")
+        delete_radius("server2")
+        reset_radius_state()
+
+    @radiusmock.activate
+    def test_09_RADIUS_group_race(self):
+        reset_radius_state()
+        add_radius(identifier="server1", server="1.1.1.1",
+                   secret="testing123", dictionary=DICT_FILE)
+        add_radius(identifier="server2", server="2.2.2.2",
+                   secret="testing123", dictionary=DICT_FILE)
+        configs = [get_radius("server1").config, get_radius("server2").config]
+
+        radiusmock.setdata(success=True, timeout_servers=["2.2.2.2"])
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.RACE)
+        self.assertTrue(r)
+
+        radiusmock.setdata(success=False)
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.RACE)
+        self.assertFalse(r)
+
+        # A fast Access-Reject does not win over a slower Access-Accept
+        reset_radius_state()
+        radiusmock.setdata(success=True, reject_servers=["1.1.1.1"],
+                           delays={"2.2.2.2": 0.2})
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.RACE)
+        self.assertTrue(r)
+        radiusmock.setdata(success=True, reject_servers=["1.1.1.1"],
+                           timeout_servers=["2.2.2.2"])
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.RACE)
+        self.assertFalse(r)
+
+        radiusmock.setdata(success=True, timeout=True)
+        r = RADIUSServer.request_group(configs, "user", "password",
+                                       mode=GROUP_MODE.RACE)
+        self.assertFalse(r)
+        delete_radius("server1")
+        delete_radius("server2")
+        reset_radius_state()
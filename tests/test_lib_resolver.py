@@ -203,6 +203,11 @@ class SQLResolverTestCase(MyTestCase):
         username = y.getUsername(user_id)
         self.assertTrue(username == "cornelius", username)
 
+        usernames = y.getUsernames([user_id, "1", 987654])
+        self.assertEqual(usernames[user_id], "cornelius")
+        self.assertTrue(usernames["1"])
+        self.assertEqual(usernames[987654], "")
+
     def test_01_where_tests(self):
         y = SQLResolver()
         d = self.parameters.copy()
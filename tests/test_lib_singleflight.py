@@ -0,0 +1,109 @@
+"""
+This file contains the tests for lib/singleflight.py
+"""
+import threading
+import time
+
+from .base import MyTestCase
+from privacyidea.lib.singleflight import SingleFlight, single_flight
+from privacyidea.lib.token import init_token, remove_token, check_serial_pass
+
+
+CALLS = []
+
+
+@single_flight("counted")
+def counted(value, options=None):
+    CALLS.append(value)
+    if value == "fail":
+        raise ValueError("failed")
+    return {"value": value, "call": len(CALLS)}
+
+
+class SingleFlightTestCase(MyTestCase):
+
+    def tearDown(self):
+        for key in ["PI_VALIDATE_COALESCE", "PI_VALIDATE_COALESCE_WINDOW"]:
+            self.app.config.pop(key, None)
+
+    def test_01_concurrent_calls(self):
+        flights = SingleFlight()
+        entered = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow(value):
+            calls.append(value)
+            entered.set()
+            release.wait(5)
+            return {"value": value}
+
+        results = []
+
+        def run():
+            results.append(flights.do("key", 0, slow, "hello"))
+
+        leader = threading.Thread(target=run)
+        leader.start()
+        entered.wait(5)
+        waiters = [threading.Thread(target=run) for _i in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        # Give the waiters the time to wait for the leader
+        time.sleep(0.2)
+        release.set()
+        for thread in [leader] + waiters:
+            thread.join(5)
+
+        # The function was only executed once
+        self.assertEqual(calls, ["hello"])
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertEqual(result, {"value": "hello"})
+        # Each caller gets its own copy
+        self.assertEqual(len(set(id(result) for result in results)), 4)
+
+        # The finished call is not reused without a window
+        flights.do("key", 0, slow, "again")
+        self.assertEqual(calls, ["hello", "again"])
+
+    def test_02_decorator(self):
+        # Without configuration the calls are not coalesced
+        self.app.config["PI_VALIDATE_COALESCE_WINDOW"] = 60
+        counted("a")
+        counted("a")
+        self.assertEqual(len(CALLS), 2)
+
+        # Within the window identical calls get the same result
+        self.app.config["PI_VALIDATE_COALESCE"] = True
+        r1 = counted("b", options={"g": object(), "clientip": "1.2.3.4"})
+        r2 = counted("b", options={"g": object(), "clientip": "1.2.3.4"})
+        self.assertEqual(len(CALLS), 3)
+        self.assertEqual(r1, r2)
+        # Other arguments are executed
+        counted("b", options={"clientip": "10.0.0.1"})
+        counted("c", options={"clientip": "1.2.3.4"})
+        self.assertEqual(len(CALLS), 5)
+
+        # Exceptions are shared, too
+        self.assertRaises(ValueError, counted, "fail")
+        self.assertRaises(ValueError, counted, "fail")
+        self.assertEqual(len(CALLS), 6)
+
+    def test_03_check_serial_pass(self):
+        init_token({"serial": "COALESCE1", "type": "hotp", "pin": "pin",
+                    "otpkey": self.otpkey})
+        # The retransmitted request gets the result of the first request
+        self.app.config["PI_VALIDATE_COALESCE"] = True
+        self.app.config["PI_VALIDATE_COALESCE_WINDOW"] = 60
+        options = {"clientip": "1.2.3.4"}
+        r1 = check_serial_pass("COALESCE1", "pin755224", options=options)
+        r2 = check_serial_pass("COALESCE1", "pin755224", options=options)
+        self.assertTrue(r1[0])
+        self.assertEqual(r1, r2)
+
+        # Without coalescing the OTP value can not be reused
+        self.app.config["PI_VALIDATE_COALESCE"] = False
+        r = check_serial_pass("COALESCE1", "pin755224", options=options)
+        self.assertFalse(r[0])
+        remove_token("COALESCE1")
@@ -0,0 +1,42 @@
+"""
+This tests the files
+  lib/task/challengecleanup.py
+"""
+
+from .base import MyTestCase
+from privacyidea.lib.error import ParameterError
+from privacyidea.models import Challenge
+
+from privacyidea.lib.task.challengecleanup import ChallengeCleanupTask
+from flask import current_app
+
+
+class TaskChallengeCleanupTestCase(MyTestCase):
+
+    def test_00_delete_expired_challenges(self):
+        for i in range(5):
+            Challenge("CLEAN1", transaction_id="expired{0!s}".format(i),
+                      validitytime=0).save()
+        Challenge("CLEAN1", transaction_id="valid", validitytime=100).save()
+
+        task = ChallengeCleanupTask(current_app.config)
+        self.assertEqual(task.identifier, "ChallengeCleanup")
+        self.assertIn("chunksize", task.options)
+
+        # Delete the expired challenges in chunks of two
+        r = task.do({"chunksize": "2"})
+        self.assertTrue(r)
+        self.assertEqual(Challenge.query.filter(
+            Challenge.transaction_id.like("expired%")).count(), 0)
+        self.assertEqual(Challenge.query.filter_by(
+            transaction_id="valid").count(), 1)
+
+        # The default chunksize
+        Challenge("CLEAN1", transaction_id="expired", validitytime=0).save()
+        task.do({})
+        self.assertEqual(Challenge.query.filter_by(serial="CLEAN1").count(), 1)
+
+        # Invalid chunksizes
+        self.assertRaises(ParameterError, task.do, {"chunksize": "many"})
+        self.assertRaises(ParameterError, task.do, {"chunksize": "0"})
+        Challenge.query.filter_by(serial="CLEAN1").delete()
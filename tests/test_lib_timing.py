@@ -0,0 +1,97 @@
+"""
+This file contains the tests for lib/timing.py
+"""
+from .base import MyTestCase, FakeAudit
+from privacyidea.lib.framework import get_request_local_store
+from privacyidea.lib.log import log_with
+from privacyidea.lib.timing import (start_request_timing, span,
+                                    get_request_timing, format_timing,
+                                    log_timing_to_audit,
+                                    add_server_timing_header)
+import logging
+log = logging.getLogger(__name__)
+
+
+class FakeResponse(object):
+
+    def __init__(self):
+        self.headers = {}
+
+
+@log_with(log, span="logged_function")
+def logged_function(a, b=1):
+    return a + b
+
+
+class TimingTestCase(MyTestCase):
+
+    def tearDown(self):
+        for key in ["PI_REQUEST_TIMING", "PI_REQUEST_TIMING_HEADER",
+                    "PI_REQUEST_TIMING_AUDIT_RATE"]:
+            self.app.config.pop(key, None)
+        start_request_timing()
+
+    def test_01_timing_disabled(self):
+        start_request_timing()
+        with span("phase1"):
+            pass
+        self.assertEqual(get_request_timing(), [])
+        response = add_server_timing_header(FakeResponse())
+        self.assertEqual(response.headers, {})
+        audit = FakeAudit()
+        log_timing_to_audit(audit)
+        self.assertEqual(audit.audit_data, {})
+
+    def test_02_spans(self):
+        self.app.config["PI_REQUEST_TIMING"] = True
+        start_request_timing()
+
+        @span("decorated")
+        def decorated(x):
+            return x * 2
+
+        with span("phase1"):
+            self.assertEqual(decorated(2), 4)
+        self.assertEqual(decorated(3), 6)
+        self.assertEqual(logged_function(1, b=2), 3)
+        self.assertEqual(logged_function.__name__, "logged_function")
+        # The function raises an exception, but the phase is measured
+        with span("failing"):
+            self.assertRaises(TypeError, logged_function, 1, b=None)
+        timings = get_request_timing()
+        # Phases are ordered by their first start and summed up
+        self.assertEqual([name for name, _duration in timings],
+                         ["phase1", "decorated", "logged_function", "failing"])
+        self.assertEqual(len(get_request_local_store()["request_timing"]), 6)
+        for _name, duration in timings:
+            self.assertTrue(duration >= 0)
+
+        # Starting a new request resets the timing
+        start_request_timing()
+        self.assertEqual(get_request_timing(), [])
+
+    def test_03_header_and_audit(self):
+        self.assertEqual(format_timing([("a", 1.234), ("b", 10)]),
+                         u"a;dur=1.2, b;dur=10.0")
+        self.app.config["PI_REQUEST_TIMING"] = True
+        self.app.config["PI_REQUEST_TIMING_HEADER"] = True
+        self.app.config["PI_REQUEST_TIMING_AUDIT_RATE"] = 1
+        start_request_timing()
+        with span("check_user_pass"):
+            pass
+        response = add_server_timing_header(FakeResponse())
+        self.assertTrue(response.headers.get("Server-Timing").startswith(
+            u"check_user_pass;dur="))
+        audit = FakeAudit()
+        log_timing_to_audit(audit)
+        self.assertTrue(audit.audit_data.get("timing").startswith(
+            u"check_user_pass="))
+
+        # No request is written to the audit log
+        self.app.config["PI_REQUEST_TIMING_AUDIT_RATE"] = 0
+        start_request_timing()
+        with span("check_user_pass"):
+            pass
+        audit = FakeAudit()
+        log_timing_to_audit(audit)
+        self.assertEqual(audit.audit_data, {})
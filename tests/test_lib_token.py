@@ -18,13 +18,16 @@ from .base import MyTestCase
 from privacyidea.lib.user import (User)
 from privacyidea.lib.tokenclass import TokenClass, TOKENKIND
 from privacyidea.lib.tokens.totptoken import TotpTokenClass
-from privacyidea.models import (Token, Challenge, TokenRealm)
+from privacyidea.models import (Token, Challenge, TokenRealm, db)
 from privacyidea.lib.config import (set_privacyidea_config, get_token_types)
 from privacyidea.lib.policy import set_policy, SCOPE, ACTION, delete_policy
 import datetime
 import hashlib
 import base64
 import binascii
+import threading
+import time
+import mock
 from privacyidea.lib.token import (create_tokenclass_object,
                                    get_tokens,
                                    get_token_type, check_serial,
@@ -53,18 +56,52 @@ from privacyidea.lib.token import (create_tokenclass_object,
                                    get_tokens_paginate,
                                    set_validity_period_end,
                                    set_validity_period_start, remove_token, delete_tokeninfo,
-                                   import_token, get_one_token, get_tokens_from_serial_or_user)
+                                   import_token, get_one_token, get_tokens_from_serial_or_user,
+                                   import_tokens, get_tokens_chunked,
+                                   get_orphaned_tokens, enable_tokens,
+                                   remove_tokens, mark_tokens)
 
 from privacyidea.lib.error import (TokenAdminError, ParameterError,
                                    privacyIDEAError, ResourceNotFoundError)
 from privacyidea.lib.tokenclass import DATE_FORMAT
 from dateutil.tz import tzlocal
+from privacyidea.lib.tokens.HMAC import HmacOtp
+from privacyidea.lib.importotp import ImportException
 
 PWFILE = "tests/testdata/passwords"
 OTPKEY = "3132333435363738393031323334353637383930"
 OTPKE2 = "31323334353637383930313233343536373839AA"
 
 
+def validate_concurrently(app, serial, passw, threads=10):
+    """
+    Validate the same password in several threads at the same time.
+
+    :return: list of the results. An exception, like a locked database,
+        is returned instead of the result.
+    """
+    start = threading.Event()
+    results = []
+
+    def validate():
+        with app.app_context():
+            start.wait(10)
+            try:
+                results.append(check_serial_pass(serial, passw)[0])
+            except Exception as exx:
+                results.append(exx)
+            finally:
+                db.session.remove()
+
+    workers = [threading.Thread(target=validate) for _i in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join(30)
+    return results
+
+
 class TokenTestCase(MyTestCase):
     """
     Test the lib.token on an interface level
@@ -1158,9 +1195,26 @@ class TokenTestCase(MyTestCase):
         self.assertEqual(len(r), 2)
 
         # Check the second response to the challenge, the second step in
-        # challenge response:
-        r, r_dict = check_token_list([token_a, token_b], "287082", user,
-                                     options={"transaction_id": transaction_id})
+        # challenge response. The authentication is committed once, the
+        # cleanup of the challenges follows after the commit.
+        calls = []
+        commit = db.session.commit
+
+        def record_commit():
+            calls.append("commit")
+            commit()
+
+        with mock.patch.object(db.session, "commit",
+                               side_effect=record_commit), \
+                mock.patch("privacyidea.lib.tokenclass."
+                           "cleanup_expired_challenges_limited",
+                           side_effect=lambda: calls.append("cleanup")):
+            r, r_dict = check_token_list(
+                [token_a, token_b], "287082", user,
+                options={"transaction_id": transaction_id})
+        self.assertEqual(calls.count("commit"), 1)
+        self.assertEqual(calls[0], "commit")
+        self.assertIn("cleanup", calls)
         # The response is successfull
         self.assertTrue(r)
         # The matching token was CR2B
@@ -1399,6 +1453,203 @@ class TokenTestCase(MyTestCase):
             get_tokens_from_serial_or_user(serial="S1", user=shadow)
         unassign_token(serial=None, user=user)
 
+    def test_55_get_tokens_paginate_query_count(self):
+        from sqlalchemy import event
+        users = [User(login, self.realm1) for login in
+                 ["cornelius", "selfservice", "usernotoken"]]
+        for i in range(20):
+            tok = init_token({"serial": "QCOUNT{0:02d}".format(i),
+                              "type": "hotp", "otpkey": self.otpkey},
+                             user=users[i % len(users)])
+            tok.add_tokeninfo("key{0:d}".format(i), "value")
+            tok.save()
+
+        statements = []
+
+        def count_statement(*args, **kwds):
+            statements.append(args[2])
+
+        def count_queries(psize):
+            del statements[:]
+            event.listen(db.engine, "before_cursor_execute", count_statement)
+            try:
+                tokens = get_tokens_paginate(serial="QCOUNT*", psize=psize)
+            finally:
+                event.remove(db.engine, "before_cursor_execute",
+                             count_statement)
+            return tokens, len(statements)
+
+        tokens5, queries5 = count_queries(5)
+        tokens20, queries20 = count_queries(20)
+        self.assertEqual(len(tokens5["tokens"]), 5)
+        self.assertEqual(len(tokens20["tokens"]), 20)
+        # The number of queries does not depend on the number of tokens
+        self.assertEqual(queries5, queries20)
+        # The page, the tokeninfo, the realms and the count of the tokens.
+        # The config is read by the resolver and the token classes.
+        token_queries = [statement for statement in statements
+                         if "FROM config" not in statement]
+        self.assertEqual(len(token_queries), 4)
+        for token in tokens20["tokens"]:
+            i = int(token["serial"][6:])
+            self.assertEqual(token["username"], users[i % len(users)].login)
+            self.assertEqual(token["user_realm"], self.realm1)
+            self.assertEqual(token["realms"], [self.realm1])
+            self.assertEqual(token["info"]["key{0:d}".format(i)], "value")
+
+        for i in range(20):
+            remove_token("QCOUNT{0:02d}".format(i))
+
+    def test_56_import_tokens(self):
+        tokens = [("IMPB01", {"type": "hotp", "otpkey": self.otpkey,
+                              "otplen": "8", "counter": "10",
+                              "description": "Vendor"}),
+                  ("IMPB02", {"type": "TOTP", "otpkey": self.otpkey,
+                              "timeStep": "60", "timeShift": "-12",
+                              "hashlib": "sha256"}),
+                  ("IMPB03", {"type": "totp", "otpkey": self.otpkey}),
+                  # Other types and existing tokens use import_token
+                  ("IMPB04", {"type": "pw", "otpkey": "secret",
+                              "otplen": "6"}),
+                  ("hotptoken", {"type": "hotp", "otpkey": self.otpkey,
+                                 "counter": "5"}),
+                  # The later definition of a serial wins
+                  ("IMPB01", {"type": "hotp", "otpkey": self.otpkey,
+                              "otplen": "8", "counter": "20",
+                              "description": "Vendor"})]
+        progress = []
+        serials = import_tokens(iter(tokens),
+                                tokenrealms=[self.realm1, "unknown"],
+                                batch_size=4, progress=progress.append)
+        self.assertEqual(serials, [serial for serial, _token in tokens])
+        self.assertEqual(progress, [4, 6])
+        self.assertEqual(get_tokens(serial="hotptoken")[0].token.count, 5)
+        self.assertEqual(get_tokens(serial="IMPB01")[0].token.count, 20)
+        self.assertEqual(get_tokens(serial="IMPB04")[0].type, "pw")
+
+        # The tokens are the same as the tokens of import_token
+        columns = ["tokentype", "description", "otplen", "count",
+                   "count_window", "maxfail", "sync_window", "active",
+                   "revoked", "locked", "failcount", "rollout_state",
+                   "resolver", "user_id"]
+
+        def get_token_data(tokenobject):
+            data = dict((column, getattr(tokenobject.token, column))
+                        for column in columns)
+            data["otpkey"] = tokenobject.token.get_otpkey().getKey()
+            data["info"] = tokenobject.get_tokeninfo()
+            data["realms"] = tokenobject.token.get_realms()
+            return data
+
+        for serial, token_dict in tokens[1:3] + tokens[5:]:
+            imported = get_token_data(get_tokens(serial=serial)[0])
+            remove_token(serial)
+            reference = import_token(serial, token_dict,
+                                     tokenrealms=[self.realm1, "unknown"])
+            self.assertEqual(imported, get_token_data(reference))
+        for serial in ["IMPB01", "IMPB02", "IMPB03", "IMPB04"]:
+            remove_token(serial)
+
+        # The batches before a failure stay imported
+        def broken_file():
+            for i in range(5):
+                yield "IMPF{0:02d}".format(i), {"type": "hotp",
+                                                "otpkey": self.otpkey}
+            raise ImportException("broken file")
+
+        with self.assertRaises(TokenAdminError) as cm:
+            import_tokens(broken_file(), batch_size=4)
+        self.assertIn("after 4 tokens", cm.exception.message)
+        self.assertEqual(len(get_tokens(serial="IMPF03")), 1)
+        self.assertEqual(get_tokens(serial="IMPF04"), [])
+        for i in range(4):
+            remove_token("IMPF{0:02d}".format(i))
+
+    def test_57_tokens_chunked(self):
+        serials = ["CHUNK{0:02d}".format(i) for i in range(5)]
+        for serial in serials:
+            init_token({"serial": serial, "type": "hotp",
+                        "otpkey": self.otpkey})
+            add_tokeninfo(serial, "chunktest", "1")
+        chunks = list(get_tokens_chunked(chunksize=2,
+                                         tokeninfo_keys=["chunktest"]))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([tokenobject.token.serial for chunk in chunks
+                          for tokenobject in chunk], serials)
+        self.assertEqual(list(get_tokens_chunked(
+            tokeninfo_keys=["chunktest"], serial_exact="CHUNK03"))[0][
+            0].token.serial, "CHUNK03")
+
+        # Orphaned tokens
+        user = User("cornelius", self.realm1)
+        assign_token("CHUNK00", user)
+        assign_token("CHUNK01", user)
+        tokenobject = get_tokens(serial="CHUNK01")[0]
+        tokenobject.token.user_id = "4711"
+        tokenobject.token.save()
+        tokenobj_list = chunks[0] + chunks[1]
+        orphaned = get_orphaned_tokens(tokenobj_list)
+        self.assertEqual([tokenobject.token.serial for tokenobject in
+                          orphaned], ["CHUNK01"])
+        self.assertEqual(orphaned[0].is_orphaned(), True)
+        self.assertEqual(tokenobj_list[0].is_orphaned(), False)
+
+        # Disable tokens in bulk
+        self.assertEqual(enable_tokens(serials[:2], enable=False), 2)
+        self.assertEqual(enable_tokens(serials[:2], enable=False), 0)
+        self.assertFalse(is_token_active("CHUNK00"))
+        self.assertTrue(is_token_active("CHUNK02"))
+        self.assertEqual(len(list(get_tokens_chunked(
+            tokeninfo_keys=["chunktest"], active=False))[0]), 2)
+
+        # Mark tokens in bulk. The tokeninfo is updated or inserted.
+        self.assertEqual(mark_tokens(serials[1:3], description="marked",
+                                     tokeninfo_key="chunktest",
+                                     tokeninfo_value="marked"), 2)
+        self.assertEqual(mark_tokens(serials[2:4], tokeninfo_key="janitor",
+                                     tokeninfo_value="1"), 2)
+        tokens = dict((serial, get_tokens(serial=serial)[0])
+                      for serial in serials)
+        self.assertEqual(tokens["CHUNK01"].token.description, "marked")
+        self.assertEqual(tokens["CHUNK01"].get_tokeninfo("chunktest"),
+                         "marked")
+        self.assertEqual(tokens["CHUNK00"].get_tokeninfo("chunktest"), "1")
+        self.assertEqual(tokens["CHUNK02"].get_tokeninfo("janitor"), "1")
+        self.assertEqual(tokens["CHUNK03"].get_tokeninfo("janitor"), "1")
+        self.assertEqual(tokens["CHUNK01"].get_tokeninfo("janitor"), None)
+        self.assertEqual(mark_tokens([], description="marked"), 0)
+
+        # Tokens can be removed while iterating over the chunks
+        removed = 0
+        for chunk in get_tokens_chunked(chunksize=2,
+                                        tokeninfo_keys=["chunktest"]):
+            removed += remove_tokens([tokenobject.token.serial
+                                      for tokenobject in chunk])
+        self.assertEqual(removed, 5)
+        for serial in serials:
+            self.assertFalse(token_exist(serial))
+        self.assertEqual(remove_tokens([]), 0)
+
+    def test_58_concurrent_validation(self):
+        # The same OTP value is only accepted once, even if it is
+        # validated concurrently
+        init_token({"serial": "CONCURRENT1", "type": "hotp",
+                    "otpkey": OTPKEY})
+        results = validate_concurrently(self.app, "CONCURRENT1", "755224")
+        self.assertEqual(len(results), 10)
+        self.assertEqual(results.count(True), 1, results)
+        self.assertEqual(get_tokens(serial="CONCURRENT1")[0].token.count, 1)
+        remove_token("CONCURRENT1")
+
+        init_token({"serial": "CONCURRENT2", "type": "totp",
+                    "otpkey": OTPKEY})
+        otp = HmacOtp(digits=6).generate(
+            counter=int(time.time() // 30), inc_counter=False,
+            key=binascii.unhexlify(OTPKEY))
+        results = validate_concurrently(self.app, "CONCURRENT2", otp)
+        self.assertEqual(results.count(True), 1, results)
+        remove_token("CONCURRENT2")
+
 class TokenFailCounterTestCase(MyTestCase):
     """
     Test the lib.token on an interface level
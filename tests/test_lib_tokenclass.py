@@ -443,6 +443,12 @@ class TokenBaseTestCase(MyTestCase):
         token.inc_otp_counter(counter=20)
         self.assertTrue(token.token.count == 21, token.token.count)
 
+        # A concurrent request already increased the counter
+        Token.query.filter_by(serial=self.serial1).update({"count": 30})
+        self.assertEqual(token.inc_otp_counter(counter=20), -1)
+        self.assertEqual(token.token.count, 30)
+        self.assertEqual(token.inc_otp_counter(counter=30), 31)
+
     def test_13_check_otp(self):
         db_token = Token.query.filter_by(serial=self.serial1).first()
         token = TokenClass(db_token)
@@ -880,3 +886,26 @@ class TokenBaseTestCase(MyTestCase):
         # sha512
         r = TokenClass.get_import_csv(["ser1", geturandom(64, True), "totp", "8"])
         self.assertEqual(r["hashlib"], "sha512")
+
+    def test_42_tokeninfo_dict(self):
+        db_token = Token("TINFO1", tokentype="hotp")
+        db_token.save()
+        token = TokenClass(db_token)
+        token.add_tokeninfo("key1", "value1")
+        info = token.get_tokeninfo()
+        self.assertEqual(info.get("key1"), "value1")
+        # The returned dictionary is a copy
+        info["key1"] = "changed"
+        self.assertEqual(token.get_tokeninfo("key1"), "value1")
+        # The dictionary is built again after changes of the token info
+        token.add_tokeninfo("key2", "secret", value_type="password")
+        self.assertEqual(token.get_tokeninfo("key2"), "secret")
+        token.del_tokeninfo("key1")
+        self.assertEqual(token.get_tokeninfo("key1", "default"), "default")
+        token.set_tokeninfo({"key3": "value3"})
+        self.assertEqual(token.get_tokeninfo(), {"key3": "value3"})
+        # Another object of the same token sees the changes
+        token2 = TokenClass(db_token)
+        token.add_tokeninfo("key4", "value4")
+        self.assertEqual(token2.get_tokeninfo("key4"), "value4")
+        token.delete_token()
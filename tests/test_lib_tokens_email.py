@@ -9,7 +9,8 @@ from privacyidea.lib.user import (User)
 from privacyidea.lib.utils import is_true
 from privacyidea.lib.tokenclass import DATE_FORMAT
 from privacyidea.lib.tokens.emailtoken import EmailTokenClass, EMAILACTION
-from privacyidea.models import (Token, Config, Challenge)
+from privacyidea.models import (Token, Config, Challenge, db,
+                                single_transaction)
 from privacyidea.lib.config import (set_privacyidea_config, set_prepend_pin,
                                     delete_privacyidea_config)
 from privacyidea.lib.policy import set_policy, SCOPE, PolicyClass
@@ -357,6 +358,28 @@ class EmailTokenTestCase(MyTestCase):
         r = token.check_challenge_response(passw=otp)
         self.assertTrue(r, r)
 
+        # Within a transaction the challenge is committed before the email
+        # is sent
+        counter = token.get_otp_count()
+        calls = []
+        commit = db.session.commit
+
+        def record_commit():
+            calls.append("commit")
+            commit()
+
+        with mock.patch.object(db.session, "commit",
+                               side_effect=record_commit), \
+                mock.patch.object(EmailTokenClass, "_compose_email",
+                                  side_effect=lambda **kwds: calls.append(
+                                      "send") or (True, kwds["message"])):
+            with single_transaction():
+                c = token.create_challenge(transactionid)
+                self.assertTrue(c[0], c)
+                self.assertEqual(calls, ["commit", "send"])
+        self.assertEqual(calls, ["commit", "send", "commit"])
+        token.set_otp_count(counter)
+
     @smtpmock.activate
     def test_18a_challenge_request_dynamic(self):
         smtpmock.setdata(response={"pi_tester@privacyidea.org": (200, 'OK')})
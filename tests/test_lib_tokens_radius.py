@@ -173,3 +173,23 @@ class RadiusTokenTestCase(MyTestCase):
         self.assertEqual(r[0], True)
         self.assertEqual(r[1], 0)
         self.assertEqual(r[2].get("message"), "matching 1 tokens")
+
+    @radiusmock.activate
+    def test_12_RADIUS_group(self):
+        set_privacyidea_config("radius.dictfile", DICT_FILE)
+        add_radius(identifier="group1", server="1.1.1.1",
+                   secret="testing123", dictionary=DICT_FILE)
+        add_radius(identifier="group2", server="2.2.2.2",
+                   secret="testing123", dictionary=DICT_FILE)
+        token = init_token({"type": "radius",
+                            "radius.identifier": "group1, group2",
+                            "radius.user": "user1"})
+        # The first server does not respond, the second one grants access
+        radiusmock.setdata(success=True, timeout_servers=["1.1.1.1"])
+        r = token.authenticate("radiuspassword")
+        self.assertEqual(r[0], True)
+        self.assertEqual(r[1], 0)
+
+        radiusmock.setdata(success=True, timeout=True)
+        r = token.authenticate("radiuspassword")
+        self.assertEqual(r[1], -1)
@@ -10,7 +10,9 @@ from privacyidea.lib.user import (User)
 from privacyidea.lib.utils import is_true
 from privacyidea.lib.tokenclass import DATE_FORMAT
 from privacyidea.lib.tokens.smstoken import SmsTokenClass, SMSACTION
-from privacyidea.models import (Token, Config, Challenge)
+from privacyidea.models import (Token, Config, Challenge, db,
+                                single_transaction)
+from privacyidea.lib.tokens.hotptoken import HotpTokenClass
 from privacyidea.lib.config import (set_privacyidea_config, set_prepend_pin)
 from privacyidea.lib.policy import set_policy, SCOPE, PolicyClass
 from privacyidea.lib import _
@@ -385,6 +387,27 @@ class SMSTokenTestCase(MyTestCase):
                                                         transactionid})
         self.assertTrue(r, r)
 
+        # Within a transaction the counter is committed before the SMS is sent
+        counter = token.get_otp_count()
+        calls = []
+        commit = db.session.commit
+
+        def record_commit():
+            calls.append("commit")
+            commit()
+
+        with mock.patch.object(db.session, "commit",
+                               side_effect=record_commit), \
+                mock.patch.object(SmsTokenClass, "_send_sms",
+                                  side_effect=lambda message: calls.append(
+                                      "send") or (True, message)):
+            with single_transaction():
+                c = token.create_challenge(transactionid)
+                self.assertTrue(c[0], c)
+                self.assertEqual(calls, ["commit", "send"])
+        self.assertEqual(calls, ["commit", "send", "commit"])
+        token.set_otp_count(counter)
+
     @responses.activate
     def test_18a_challenge_request_dynamic(self):
         # Send a challenge request for an SMS token with a dynamic phone number
@@ -471,6 +494,15 @@ class SMSTokenTestCase(MyTestCase):
         r = token.check_otp("287922", options=options)
         self.assertTrue(r > 0, r)
 
+        # Within a transaction the SMS is sent after the commit
+        sent = len(responses.calls)
+        with mock.patch.object(HotpTokenClass, "check_otp", return_value=3):
+            with single_transaction():
+                r = token.check_otp("123456", options=options)
+                self.assertEqual(r, 3)
+                self.assertEqual(len(responses.calls), sent)
+        self.assertEqual(len(responses.calls), sent + 1)
+
     def test_21_failed_loading(self):
         transactionid = "123456098712"
         set_privacyidea_config("sms.providerConfig", "noJSON")
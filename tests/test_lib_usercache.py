@@ -11,7 +11,8 @@ from privacyidea.lib.error import UserError
 from .base import MyTestCase
 from privacyidea.lib.resolver import (save_resolver, delete_resolver, get_resolver_object)
 from privacyidea.lib.realm import (set_realm, delete_realm)
-from privacyidea.lib.user import (User, get_username, create_user)
+from privacyidea.lib.user import (User, get_username, get_usernames,
+                                   create_user)
 from privacyidea.lib.usercache import (get_cache_time,
                                        cache_username, delete_user_cache,
                                        EXPIRATION_SECONDS, retrieve_latest_entry, is_cache_enabled)
@@ -453,6 +454,26 @@ class UserCacheTestCase(MyTestCase):
         delete_resolver('reso_a')
         delete_resolver('reso_b')
 
+    def test_13_get_usernames(self):
+        self._create_realm()
+        delete_user_cache()
+        # The usernames are fetched from the resolver and added to the cache
+        usernames = get_usernames([self.uid, "1009"], self.resolvername1)
+        self.assertEqual(usernames, {self.uid: self.username,
+                                     "1009": "cornelius"})
+        self.assertEqual(UserCache.query.count(), 2)
+        self._delete_realm()
+
+        # The usernames are fetched from the cache
+        UserCache(self.username, self.resolvername1, self.uid,
+                  datetime.now()).save()
+        UserCache("cornelius", self.resolvername1, "1009",
+                  datetime.now()).save()
+        usernames = get_usernames([self.uid, "1009"], self.resolvername1)
+        self.assertEqual(usernames, {self.uid: self.username,
+                                     "1009": "cornelius"})
+        delete_user_cache()
+
     def test_99_unset_config(self):
         # Test early exit!
         # Assert that the function `retrieve_latest_entry` is called if the cache is enabled
@@ -16,7 +16,8 @@ from privacyidea.lib.utils import (parse_timelimit,
                                    check_sha, otrs_sha256, parse_int, check_crypt,
                                    convert_column_to_unicode, censor_connect_string,
                                    truncate_comma_list, check_pin_policy,
-                                   get_module_class)
+                                   get_module_class, get_time_range,
+                                   get_client_matcher)
 from datetime import timedelta, datetime
 from netaddr import IPAddress, IPNetwork, AddrFormatError
 from dateutil.tz import tzlocal, tzoffset
@@ -532,3 +533,28 @@ class UtilsTestCase(MyTestCase):
         with self.assertRaises(ImportError):
             get_module_class("privacyidea.lib.auditmodules.doesnotexist", "Aduit")
 
+
+    def test_22_compiled_matchers(self):
+        # The time range is parsed once
+        time_range = get_time_range("Mon-Fri: 09:00-17:30, Sun: 10-12")
+        self.assertIs(get_time_range("Mon-Fri: 09:00-17:30, Sun: 10-12"),
+                      time_range)
+        # April 5th, 2016 is a Tuesday, April 10th is a Sunday
+        self.assertTrue(time_range.match(datetime(2016, 4, 5, 17, 30)))
+        self.assertFalse(time_range.match(datetime(2016, 4, 5, 17, 31)))
+        self.assertTrue(time_range.match(datetime(2016, 4, 10, 11, 0)))
+        self.assertFalse(time_range.match(datetime(2016, 4, 9, 11, 0)))
+        # An unknown end day does not match
+        self.assertFalse(get_time_range("Mon-Wrong: 9-17").match(
+            datetime(2016, 4, 5, 10, 0)))
+
+        clients = ["10.0.0.0/8", "-10.0.0.1", "!10.1.0.0/16", "192.168.0.1"]
+        matcher = get_client_matcher(clients)
+        self.assertIs(get_client_matcher(list(clients)), matcher)
+        self.assertTrue(matcher.match("10.0.0.2"))
+        self.assertTrue(matcher.match(IPAddress("192.168.0.1")))
+        self.assertFalse(matcher.match("10.0.0.1"))
+        self.assertFalse(matcher.match("10.1.2.3"))
+        self.assertFalse(matcher.match("192.168.0.2"))
+        self.assertFalse(matcher.match("::1"))
+        self.assertRaises(AddrFormatError, get_client_matcher, ["10.0.0.1/x"])